@@ -1,61 +1,268 @@
 import os
+import sys
 import zipfile
 import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from flask import Flask, render_template, request, redirect, flash, session, send_from_directory, abort
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, Field, File, Data, Epilogue
 from werkzeug.utils import secure_filename
 
+try:
+    # shared with the SCE-Unina servers in backend/ (importable as is with `python -m deus.deus_server` from there)
+    from sce_unina_metrics import Metrics, StageTimer
+except ImportError:
+    # started as a script from backend/deus: the shared modules are one folder up
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from sce_unina_metrics import Metrics, StageTimer
+
 ALLOWED_EXTENSIONS = {".py", ".java", ".c", ".cpp", ".m", ".h", ".makefile"}
 
 app = Flask(__name__)
 app.secret_key = "sce-unina-secret-key"
 
+# Prometheus metrics at /metrics, slow requests logged on 'sce_unina.slow'
+METRICS = Metrics("deus_server")
+METRICS.init_app(app)
+
 DOWNLOAD_DIR = os.path.join(os.getcwd(), "download")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+UPLOAD_DIR = "uploads"
+
+# Body read size, largest text field and most parts accepted from the submission form
+READ_SIZE = 64 * 1024
+MAX_FIELD_SIZE = 1024
+MAX_PARTS = 100
+# Largest submission and source file accepted (larger ones get 413), and size above which
+# a source is spooled to a temporary file instead of being kept in memory
+MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+MAX_FILE_SIZE = 20 * 1024 * 1024
+SPOOL_SIZE = 1024 * 1024
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+
+COMPRESSION_METHODS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+# Zip building settings, overridable from the command line
+ZIP_COMPRESSION = "deflated"
+ZIP_COMPRESSLEVEL = 6
+ZIP_WORKERS = os.cpu_count() or 1
+# Submissions allowed to wait for a free worker before new ones are turned away
+ZIP_QUEUE_SIZE = 4 * ZIP_WORKERS
+ZIP_QUEUE_TIMEOUT = 30
+ZIP_JOB_TIMEOUT = 120
+
+_zip_pool = None
+_zip_slots = None
+_zip_pool_lock = threading.Lock()
+
 def allowed_file(filename):
     return os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS
 
 def sanitize_field(value: str) -> str:
     return value.strip().replace(" ", "_")
 
+class MultipartError(ValueError):
+    pass
+
+def discard_spooled(files):
+    """Remove the temporary files read_form() spooled sources to."""
+    for _, content in files:
+        if isinstance(content, str):
+            try:
+                os.unlink(content)
+            except FileNotFoundError:
+                pass
+
+def read_form(stream, content_type, stages):
+    """
+    Decode the submission form as its body is read from `stream`.
+
+    Returns (fields, files): the text fields by name, and (filename, content)
+    for every part named "files". Content is the source as bytes, or the path
+    of a temporary file once it grows past SPOOL_SIZE (the caller removes it
+    with discard_spooled()); the content of files build_zip() won't take is
+    skipped (None). Raises MultipartError on a malformed body and
+    RequestEntityTooLarge for a source over MAX_FILE_SIZE.
+    """
+    mimetype, options = parse_options_header(content_type or "")
+    if mimetype != "multipart/form-data" or not options.get("boundary"):
+        raise MultipartError("not a multipart/form-data body")
+    decoder = MultipartDecoder(options["boundary"].encode("latin-1"),
+                               max_form_memory_size=4 * READ_SIZE, max_parts=MAX_PARTS)
+    fields, files = {}, []
+    part, buffer, spool, size = None, None, None, 0
+    try:
+        while True:
+            with stages("receive"):
+                data = stream.read(READ_SIZE)
+            with stages("parse"):
+                try:
+                    decoder.receive_data(data or None)
+                except RequestEntityTooLarge as e:
+                    raise MultipartError("oversized multipart chunk") from e
+                while True:
+                    event = decoder.next_event()
+                    if event is NEED_DATA:
+                        break
+                    if isinstance(event, Epilogue):
+                        return fields, files
+                    if isinstance(event, (Field, File)):
+                        part, spool, size = event, None, 0
+                        keep = isinstance(event, Field) or (
+                            event.name == "files" and (event.filename == "Makefile" or allowed_file(event.filename)))
+                        buffer = bytearray() if keep else None
+                    elif isinstance(event, Data):
+                        size += len(event.data)
+                        if isinstance(part, Field) and size > MAX_FIELD_SIZE:
+                            raise MultipartError(f"field {part.name} too long")
+                        if size > MAX_FILE_SIZE:
+                            raise RequestEntityTooLarge(f"{part.filename} is larger than {MAX_FILE_SIZE} bytes")
+                        if spool is not None:
+                            spool.write(event.data)
+                        elif buffer is not None:
+                            buffer += event.data
+                            if len(buffer) > SPOOL_SIZE:
+                                spool = tempfile.NamedTemporaryFile(prefix="deus-", suffix=".part", delete=False)
+                                spool.write(buffer)
+                                buffer = None
+                        if event.more_data:
+                            continue
+                        if isinstance(part, Field):
+                            fields[part.name] = buffer.decode("utf-8", "replace")
+                        elif part.name == "files":
+                            if spool is not None:
+                                spool.close()
+                                files.append((part.filename, spool.name))
+                            else:
+                                files.append((part.filename, bytes(buffer) if buffer is not None else None))
+                        spool = None
+            if not data:
+                raise MultipartError("truncated body")
+    except BaseException as e:
+        if spool is not None:
+            spool.close()
+            files.append((part.filename, spool.name))
+        discard_spooled(files)
+        if isinstance(e, ValueError) and not isinstance(e, MultipartError):
+            raise MultipartError(str(e) or "malformed body") from e
+        raise
+
+def build_zip(upload_dir, zip_name, members, compression, compresslevel):
+    """
+    Write `members` ((arcname, content) pairs, content as bytes or the path
+    of a file) into upload_dir/zip_name.
+
+    Runs in a worker process. The archive is written to a hidden temporary
+    file in upload_dir and renamed into place only when complete.
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w", COMPRESSION_METHODS[compression],
+                                                       compresslevel=compresslevel) as zipf:
+            for arcname, content in members:
+                if isinstance(content, str):
+                    zipf.write(content, arcname)
+                else:
+                    zipf.writestr(arcname, content)
+        os.replace(tmp_path, os.path.join(upload_dir, zip_name))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return zip_name
+
+def zip_pool():
+    """Process pool doing the compression, with a bounded number of queued jobs."""
+    global _zip_pool, _zip_slots
+    with _zip_pool_lock:
+        if _zip_pool is None:
+            _zip_pool = ProcessPoolExecutor(max_workers=ZIP_WORKERS)
+            _zip_slots = threading.BoundedSemaphore(ZIP_WORKERS + ZIP_QUEUE_SIZE)
+        return _zip_pool, _zip_slots
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
-        nome = sanitize_field(request.form.get("nome", ""))
-        cognome = sanitize_field(request.form.get("cognome", ""))
-        matricola = request.form.get("matricola", "").strip()
-        docente = sanitize_field(request.form.get("docente", ""))
+        stages = StageTimer()
+        try:
+            # decoded while it arrives: only sources past SPOOL_SIZE go to a temporary file
+            fields, files = read_form(request.stream, request.content_type, stages)
+        except MultipartError as e:
+            METRICS.record_stages(stages)
+            app.logger.warning("malformed submission: %s", e)
+            flash("Richiesta non valida, riprovare", "danger")
+            return redirect("/")
+        except RequestEntityTooLarge:
+            METRICS.record_stages(stages)
+            raise
 
-        files = request.files.getlist("files")
+        submitted = False
+        try:
+            nome = sanitize_field(fields.get("nome", ""))
+            cognome = sanitize_field(fields.get("cognome", ""))
+            matricola = fields.get("matricola", "").strip()
+            docente = sanitize_field(fields.get("docente", ""))
 
-        if not all([nome, cognome, matricola, docente]):
-            flash("Compilare tutti i campi", "danger")
-            return redirect("/")
+            if not all([nome, cognome, matricola, docente]):
+                flash("Compilare tutti i campi", "danger")
+                return redirect("/")
 
-        if not files or files[0].filename == "":
-            flash("Caricare almeno un file sorgente", "danger")
-            return redirect("/")
+            if not files or files[0][0] == "":
+                flash("Caricare almeno un file sorgente", "danger")
+                return redirect("/")
 
-        zip_name = f"{nome}_{cognome}_{matricola}_{docente}.zip"
+            zip_name = f"{nome}_{cognome}_{matricola}_{docente}.zip"
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            zip_path = os.path.join(tmpdir, zip_name)
+            members = []
+            for filename, content in files:
+                if content is not None:
+                    members.append((secure_filename(filename), content))
+                else:
+                    flash(f"Estensione non supportata: {filename}", "warning")
 
-            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                for file in files:
-                    if file.filename in "Makefile" or allowed_file(file.filename):
-                        filename = secure_filename(file.filename)
-                        file_path = os.path.join(tmpdir, filename)
-                        file.save(file_path)
-                        zipf.write(file_path, arcname=filename)
-                    else:
-                        flash(f"Estensione non supportata: {file.filename}", "warning")
+            # compression is CPU-bound: run it in the process pool, off the GIL
+            pool, slots = zip_pool()
+            with stages("queue"):
+                acquired = slots.acquire(timeout=ZIP_QUEUE_TIMEOUT)
+            if not acquired:
+                flash("Server occupato, riprovare tra qualche secondo", "danger")
+                return redirect("/")
+            try:
+                with stages("zip"):
+                    try:
+                        future = pool.submit(build_zip, UPLOAD_DIR, zip_name, members, ZIP_COMPRESSION, ZIP_COMPRESSLEVEL)
+                    except BaseException:
+                        slots.release()
+                        raise
+                    submitted = True
 
-            os.makedirs("uploads", exist_ok=True)
-            os.replace(zip_path, os.path.join("uploads", zip_name))
+                    # the slot and the spooled sources are freed when the job ends,
+                    # even if we stopped waiting for it: it still holds a worker
+                    def done(_):
+                        discard_spooled(files)
+                        slots.release()
+
+                    future.add_done_callback(done)
+                    future.result(timeout=ZIP_JOB_TIMEOUT)
+            except Exception:
+                app.logger.exception("could not build %s", zip_name)
+                flash("Errore durante il salvataggio della consegna, riprovare", "danger")
+                return redirect("/")
+        finally:
+            if not submitted:
+                discard_spooled(files)
+            METRICS.record_stages(stages)
 
         session["submitted"] = True
-        session["uploaded_files"] = [f.filename for f in files if f.filename]
+        session["uploaded_files"] = [filename for filename, _ in files if filename]
 
         flash("Consegna effettuata con successo!", "success")
         return redirect("/")
@@ -87,7 +294,23 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--upload-dir", type=str, default=UPLOAD_DIR, help="Folder the submission zips are saved to")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_METHODS), default=ZIP_COMPRESSION,
+                        help="Compression method of the submission zips")
+    parser.add_argument("--compresslevel", type=int, default=ZIP_COMPRESSLEVEL,
+                        help="Compression level (0-9 for deflated, 1-9 for bzip2, ignored otherwise)")
+    parser.add_argument("--zip-workers", type=int, default=ZIP_WORKERS,
+                        help="Processes used to build submission zips")
+    parser.add_argument("--slow-request-threshold", type=float, default=2.0,
+                        help="Log requests taking longer than this many seconds")
     args = parser.parse_args()
 
+    UPLOAD_DIR = args.upload_dir
+    ZIP_COMPRESSION = args.compression
+    ZIP_COMPRESSLEVEL = args.compresslevel
+    ZIP_WORKERS = args.zip_workers
+    ZIP_QUEUE_SIZE = 4 * ZIP_WORKERS
+    METRICS.slow_threshold = args.slow_request_threshold
+
     app.run(host="0.0.0.0", port=args.port, threaded=True)
 
@@ -14,12 +14,102 @@ import shutil
 import mimetypes
 import re
 import time
+import tempfile
 import zipfile
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 
 ALLOWED_EXTENSIONS = {".py", ".java", ".txt", ".md", ".c", ".cpp", ".m"}
 
+# The upload body is read in blocks of READ_SIZE bytes and never held whole in memory
+READ_SIZE = 64 * 1024
+MAX_FILE_SIZE = 50 * 1024 * 1024   # per uploaded file
+MAX_FIELD_SIZE = 1024              # per text field (nome, cognome, ...)
+MAX_HEADER_SIZE = 8 * 1024         # headers of a single part
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class MultipartParser:
+    """
+    Incremental multipart/form-data parser. Iterating yields the headers of
+    each part; read_body() then streams the part's content to a callback,
+    so at most a block plus a boundary is buffered at any time. A part whose
+    body isn't read is skipped.
+    """
+
+    def __init__(self, rfile, boundary, length):
+        self.rfile = rfile
+        self.remaining = length
+        self.delimiter = b"\r\n--" + boundary
+        # the first boundary isn't preceded by a line break
+        self.buffer = bytearray(b"\r\n")
+        self.in_body = False
+
+    def _fill(self):
+        if not self.remaining:
+            return False
+        chunk = self.rfile.read(min(READ_SIZE, self.remaining))
+        if not chunk:
+            raise MultipartError("Upload interrupted")
+        self.remaining -= len(chunk)
+        self.buffer += chunk
+        return True
+
+    def read_body(self, write=None, limit=None):
+        """Pass the content of the current part to write() (dropped if None); returns its size."""
+        self.in_body = False
+        size = 0
+        # a delimiter may be split between two blocks: keep its possible start in the buffer
+        keep = len(self.delimiter) - 1
+        while True:
+            i = self.buffer.find(self.delimiter)
+            end = i if i >= 0 else max(len(self.buffer) - keep, 0)
+            if end:
+                size += end
+                if limit is not None and size > limit:
+                    raise MultipartError(f"Part larger than {limit} bytes")
+                if write is not None:
+                    write(bytes(self.buffer[:end]))
+                del self.buffer[:end]
+            if i >= 0:
+                del self.buffer[:len(self.delimiter)]
+                return size
+            if not self._fill():
+                raise MultipartError("Malformed multipart body")
+
+    def __iter__(self):
+        self.read_body()  # preamble
+        while True:
+            while len(self.buffer) < 2:
+                if not self._fill():
+                    raise MultipartError("Malformed multipart body")
+            if self.buffer[:2] == b"--":
+                return
+            while True:
+                i = self.buffer.find(b"\r\n\r\n")
+                if i >= 0:
+                    break
+                if len(self.buffer) > MAX_HEADER_SIZE or not self._fill():
+                    raise MultipartError("Malformed multipart body")
+            headers = bytes(self.buffer[2:i]).decode(errors='ignore')
+            del self.buffer[:i + 4]
+            self.in_body = True
+            yield headers
+            if self.in_body:
+                self.read_body()
+
+    def drain(self):
+        """Read and discard the rest of the body, so the client gets the response."""
+        while self.remaining:
+            chunk = self.rfile.read(min(READ_SIZE, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+
+
 class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     server_version = "FancyHTTPWithUploadZip/" + __version__
 
@@ -59,68 +149,67 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         content_type = self.headers['content-type']
         if not content_type:
             return (False, "Missing Content-Type header")
-        boundary = content_type.split("=")[1].encode()
-        remainbytes = int(self.headers['content-length'])
-
-        data = self.rfile.read(remainbytes)
-        parts = data.split(b"--" + boundary)
+        boundary_match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not boundary_match:
+            return (False, "Expected a multipart/form-data request")
+        try:
+            remainbytes = int(self.headers['content-length'])
+        except (TypeError, ValueError):
+            return (False, "Missing Content-Length header")
+        parser = MultipartParser(self.rfile, boundary_match.group(1).encode(), remainbytes)
 
         fields = {"nome": "", "cognome": "", "matricola": "", "docente": ""}
-        files = []
-
-        for part in parts:
-            if b'Content-Disposition' in part:
-                headers, _, content = part.partition(b"\r\n\r\n")
-                content = content.rstrip(b"\r\n")
-                disp = headers.decode(errors='ignore')
-                name_match = re.search(r'name="([^"]+)"', disp)
-                if not name_match:
-                    continue
-                name = name_match.group(1)
-                if 'filename="' in disp:
-                    filename_match = re.search(r'filename="([^"]+)"', disp)
-                    if filename_match:
-                        filename = filename_match.group(1)
-                        ext = os.path.splitext(filename)[1].lower()
-                        files.append((filename, content))
-                elif name in fields:
-                    fields[name] = content.decode(errors='ignore')
+        names = set()
+
+        # files go straight into the zip, named once all the fields are known
+        base_dir = os.getcwd()
+        fd, tmp_path = tempfile.mkstemp(prefix=".upload-", suffix=".zip", dir=base_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out, zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for headers in parser:
+                    name_match = re.search(r'name="([^"]+)"', headers)
+                    if not name_match:
+                        continue
+                    name = name_match.group(1)
+                    if 'filename="' in headers:
+                        filename_match = re.search(r'filename="([^"]+)"', headers)
+                        if filename_match:
+                            fname = os.path.basename(filename_match.group(1).replace('\\', '/'))
+                            arcname = fname
+                            base, ext = os.path.splitext(fname)
+                            counter = 1
+                            while arcname in names:
+                                arcname = f"{base}_{counter}{ext}"
+                                counter += 1
+                            names.add(arcname)
+                            with zf.open(arcname, 'w') as member:
+                                parser.read_body(member.write, MAX_FILE_SIZE)
+                    elif name in fields:
+                        value = bytearray()
+                        parser.read_body(value.extend, MAX_FIELD_SIZE)
+                        fields[name] = value.decode(errors='ignore')
+        except MultipartError as e:
+            os.remove(tmp_path)
+            parser.drain()
+            return (False, str(e))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
         if not all(fields.values()):
+            os.remove(tmp_path)
             return (False, "All fields must be filled")
 
-        if not files:
+        if not names:
+            os.remove(tmp_path)
             return (False, "No valid files uploaded")
 
-        base_dir = os.getcwd()
         safe_prefix = f"{fields['cognome']}_{fields['nome']}_{fields['matricola']}_{fields['docente']}"
         ip = self.client_address[0].replace('.', '_')
         port = str(self.client_address[1])
         zip_filename = f"{safe_prefix}_{ip}_{port}.zip"
         zip_path = os.path.join(base_dir, zip_filename)
-
-        project_dir = os.path.join(base_dir, f"{safe_prefix}_upload")
-        os.makedirs(project_dir, exist_ok=True)
-
-        for fname, content in files:
-            uploaded_file_path = os.path.join(project_dir, fname)
-            base, ext = os.path.splitext(fname)
-            counter = 1
-            while os.path.exists(uploaded_file_path):
-                new_fname = f"{base}_{counter}{ext}"
-                uploaded_file_path = os.path.join(project_dir, new_fname)
-                counter += 1
-            with open(uploaded_file_path, 'wb') as out_file:
-                out_file.write(content)
-
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for root, _, files in os.walk(project_dir):
-                for file in files:
-                    full_path = os.path.join(root, file)
-                    arcname = os.path.relpath(full_path, project_dir)
-                    zf.write(full_path, arcname)
-
-        shutil.rmtree(project_dir)
+        os.replace(tmp_path, zip_path)
         return (True, f"Project files zipped as {zip_filename}")
 
     def send_head(self):
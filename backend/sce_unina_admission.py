@@ -0,0 +1,107 @@
+"""
+Admission control for upload requests.
+
+At the deadline every student uploads at once; letting each request write to
+disk in its own thread makes them all slow together. Admission lets at most
+`max_active` uploads run at a time, queues up to `max_queued` more (for at most
+`queue_timeout` seconds each) and caps how many of them may come from one
+client address. Requests that cannot be admitted are rejected right away with
+a Retry-After estimate, before their body is read.
+"""
+
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """An upload turned away by admission control, with the HTTP status and Retry-After to send."""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Admission:
+    def __init__(self, max_active=8, max_queued=64, queue_timeout=30.0, per_client=4):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.per_client = per_client
+        self.active = 0
+        self.queued = 0
+        self._clients = {}          # address -> active + queued requests
+        self._cond = threading.Condition()
+        self._avg_duration = 1.0    # moving average of how long an upload holds its slot
+
+    @property
+    def enabled(self):
+        return self.max_active > 0
+
+    def retry_after(self):
+        """Seconds a rejected client should wait: roughly the time to drain the current backlog."""
+        backlog = (self.active + self.queued) / max(self.max_active, 1)
+        estimate = self._avg_duration * max(backlog, 1)
+        # spread the retries so that rejected clients don't all come back together
+        return min(60, math.ceil(estimate * random.uniform(1.0, 1.5)))
+
+    def acquire(self, client):
+        """
+        Wait for an upload slot for `client` and return the time it was granted.
+
+        Raises Overloaded (429 when `client` is over its own cap, 503 when the
+        queue is full or the wait times out). Every successful acquire() must
+        be paired with release().
+        """
+        if not self.enabled:
+            return time.monotonic()
+
+        with self._cond:
+            if self.per_client and self._clients.get(client, 0) >= self.per_client:
+                raise Overloaded("Too many concurrent uploads from this address", 429, self.retry_after())
+            if self.active >= self.max_active and self.queued >= self.max_queued:
+                raise Overloaded("Server busy, retry later", 503, self.retry_after())
+
+            self._clients[client] = self._clients.get(client, 0) + 1
+            self.queued += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.max_active:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._release_client(client)
+                        raise Overloaded("Server busy, retry later", 503, self.retry_after())
+                    self._cond.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.active += 1
+            return time.monotonic()
+
+    def release(self, client, granted):
+        if not self.enabled:
+            return
+        with self._cond:
+            self.active -= 1
+            self._release_client(client)
+            self._avg_duration = 0.9 * self._avg_duration + 0.1 * (time.monotonic() - granted)
+            self._cond.notify()
+
+    @contextmanager
+    def admit(self, client):
+        """Hold an upload slot for the duration of the `with` block."""
+        granted = self.acquire(client)
+        try:
+            yield
+        finally:
+            self.release(client, granted)
+
+    def _release_client(self, client):
+        count = self._clients.get(client, 0) - 1
+        if count > 0:
+            self._clients[client] = count
+        else:
+            self._clients.pop(client, None)
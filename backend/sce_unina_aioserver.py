@@ -0,0 +1,341 @@
+#! /usr/bin/env python3
+"""
+asyncio variant of sce_unina_server.py for exam rooms with many slow clients.
+
+Serves the same /upload and /get_exam endpoints with the same filename and
+channel parsing and the same on-disk layout, but every connection is a
+coroutine instead of an OS thread: a client trickling its upload over weak
+Wi-Fi costs a few kilobytes of buffers, not a thread. Request bodies go
+through the same sans-IO MultipartUpload as the Flask server; anything that
+touches the disk (spilled upload chunks, the commit into the blob store and
+the index) runs in a small thread pool so the event loop never blocks on it.
+
+Only the standard library and Werkzeug (for conditional/range responses) are
+used. The resumable and delta upload endpoints are served by sce_unina_server.py only.
+"""
+
+import io
+import os
+import asyncio
+import logging
+import argparse
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request
+
+import sce_unina_server as server
+from sce_unina_server import EXAM_CACHE, MultipartUpload, UploadError, format_upload_message, exam_response
+from sce_unina_sendfile import FileBody, FileSender, MODES as FILE_DELIVERY_MODES
+from sce_unina_durability import Durability, MODES as DURABILITY_MODES
+from sce_unina_sessions import start_session
+from sce_unina_storage import StorageError, open_storage, write_session
+
+log = logging.getLogger(__name__)
+
+# Longest accepted request line + headers
+MAX_HEADER_SIZE = 64 * 1024
+# Seconds to wait for the headers of a request, for each body chunk, and between keep-alive requests
+HEADER_TIMEOUT = 30.0
+BODY_TIMEOUT = 60.0
+KEEPALIVE_TIMEOUT = 15.0
+# Responses are written in pieces of this size, waiting for each to drain
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class HTTPRequest:
+    """Request line and headers of one request on a connection."""
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.version = version
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = parts.query
+        self.headers = headers      # lower-case name -> value
+
+    @classmethod
+    def parse(cls, data):
+        lines = data.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise UploadError("Malformed request line", 400)
+        if not version.startswith('HTTP/1.'):
+            raise UploadError("Unsupported HTTP version", 400)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise UploadError("Malformed header", 400)
+            headers[name.strip().lower()] = value.strip()
+        return cls(method, target, version, headers)
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def environ(self, peer):
+        """A minimal WSGI environ, enough for Werkzeug's conditional and range handling."""
+        environ = {
+            'REQUEST_METHOD': self.method,
+            'PATH_INFO': self.path,
+            'QUERY_STRING': self.query,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': self.version,
+            'REMOTE_ADDR': peer,
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(),
+        }
+        for name, value in self.headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value
+        return environ
+
+
+class UploadServer:
+    def __init__(self, disk_threads=4, max_upload_size=None):
+        self.max_upload_size = max_upload_size
+        self.disk = ThreadPoolExecutor(max_workers=disk_threads, thread_name_prefix='sce-unina-disk')
+
+    async def handle(self, reader, writer):
+        peer = (writer.get_extra_info('peername') or ('', 0))[0]
+        timeout = HEADER_TIMEOUT
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 431, "Request headers too large", keep_alive=False)
+                    return
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    return
+                try:
+                    req = HTTPRequest.parse(head)
+                except UploadError as e:
+                    await self.respond(writer, e.status, e.message, keep_alive=False)
+                    return
+
+                if not await self.dispatch(req, reader, writer, peer):
+                    return
+                timeout = KEEPALIVE_TIMEOUT
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            log.exception("error while handling a connection from %s", peer)
+        finally:
+            writer.close()
+
+    async def dispatch(self, req, reader, writer, peer):
+        """Serve one request; returns whether the connection can be reused."""
+        if req.path == '/upload':
+            if req.method != 'POST':
+                return await self.respond(writer, 405, "Method not allowed", req.keep_alive and not self.has_body(req),
+                                          {'Allow': 'POST'})
+            return await self.upload(req, reader, writer)
+
+        if self.has_body(req):
+            # not worth reading a body nobody asked for: just drop the connection afterwards
+            keep_alive = False
+        else:
+            keep_alive = req.keep_alive
+
+        if req.path == '/get_exam':
+            if req.method not in ('GET', 'HEAD'):
+                return await self.respond(writer, 405, "Method not allowed", keep_alive, {'Allow': 'GET, HEAD'})
+            return await self.get_exam(req, writer, peer, keep_alive)
+        return await self.respond(writer, 404, "Not found", keep_alive)
+
+    @staticmethod
+    def has_body(req):
+        length = req.headers.get('content-length', '0')
+        return 'transfer-encoding' in req.headers or not length.isdigit() or int(length) > 0
+
+    async def upload(self, req, reader, writer):
+        """Same behavior as sce_unina_server.upload(), with non-blocking network reads."""
+        if 'transfer-encoding' in req.headers:
+            return await self.respond(writer, 411, "Content-Length required", keep_alive=False)
+        try:
+            remaining = int(req.headers.get('content-length', ''))
+        except ValueError:
+            return await self.respond(writer, 411, "Content-Length required", keep_alive=False)
+        if self.max_upload_size is not None and remaining > self.max_upload_size:
+            return await self.respond(writer, 413, "Uploaded file is too large", keep_alive=False)
+
+        if req.headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        loop = asyncio.get_running_loop()
+        receiver = None
+        try:
+            receiver = MultipartUpload(req.headers.get('content-type'), self.max_upload_size)
+            while not receiver.complete:
+                chunk = b''
+                if remaining:
+                    chunk = await asyncio.wait_for(reader.read(min(server.UPLOAD_CHUNK_SIZE, remaining)),
+                                                   BODY_TIMEOUT)
+                    if not chunk:
+                        # client went away mid-upload
+                        return False
+                    remaining -= len(chunk)
+                if self.touches_disk(receiver, chunk):
+                    await loop.run_in_executor(self.disk, receiver.feed, chunk or None)
+                else:
+                    receiver.feed(chunk or None)
+            await loop.run_in_executor(self.disk, receiver.writer.commit)
+        except UploadError as e:
+            # the rest of the body is unread: the connection can't carry another request
+            return await self.respond(writer, e.status, e.message, keep_alive=False)
+        finally:
+            if receiver is not None:
+                await loop.run_in_executor(self.disk, receiver.close)
+
+        # leftover epilogue bytes after the closing boundary
+        keep_alive = req.keep_alive and remaining <= server.UPLOAD_CHUNK_SIZE
+        if keep_alive and remaining:
+            await asyncio.wait_for(reader.readexactly(remaining), BODY_TIMEOUT)
+
+        return await self.respond(writer, 200, format_upload_message(receiver.filename, receiver.channel),
+                                  keep_alive, {'X-Upload-SHA256': receiver.writer.sha256.hexdigest()})
+
+    @staticmethod
+    def touches_disk(receiver, chunk):
+        """Whether feeding `chunk` may write to disk (an upload spilled, or about to spill, out of memory)."""
+        upload = receiver.writer
+        if upload is None:
+            # the first file chunk can't exceed the spool size, headers included
+            return len(chunk) > server.UPLOAD_SPOOL_SIZE
+        return upload.file is not None or upload.size + len(chunk) > server.UPLOAD_SPOOL_SIZE
+
+    async def get_exam(self, req, writer, peer, keep_alive):
+        environ = req.environ(peer)
+        try:
+            # the exam is cached in memory: building the response never blocks
+            response = exam_response(Request(environ))
+        except HTTPException as e:
+            response = e.get_response(environ)
+        try:
+            headers = response.headers.to_wsgi_list()
+            if isinstance(response.response, FileBody):
+                # --file-delivery sendfile: headers first, then the file from the page cache
+                await self.send(writer, response.status_code, headers, b'', keep_alive)
+                if req.method != 'HEAD' and response.status_code in (200, 206):
+                    body = response.response
+                    await asyncio.get_running_loop().sendfile(writer.transport, body.file, body.start,
+                                                              body.stop - body.start)
+                return keep_alive
+            body = b'' if req.method == 'HEAD' else b''.join(response.iter_encoded())
+            return await self.send(writer, response.status_code, headers, body, keep_alive)
+        finally:
+            response.close()
+
+    async def respond(self, writer, status, message, keep_alive, headers=None):
+        body = message.encode('utf-8')
+        header_list = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))]
+        header_list += list((headers or {}).items())
+        return await self.send(writer, status, header_list, body, keep_alive)
+
+    async def send(self, writer, status, headers, body, keep_alive):
+        head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+        head += [f"{name}: {value}" for name, value in headers]
+        head.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        # a slow reader must not make us buffer the whole exam for it
+        view = memoryview(body)
+        for start in range(0, len(view), WRITE_CHUNK_SIZE):
+            writer.write(view[start:start + WRITE_CHUNK_SIZE])
+            await asyncio.wait_for(writer.drain(), BODY_TIMEOUT)
+        await asyncio.wait_for(writer.drain(), BODY_TIMEOUT)
+        return keep_alive
+
+
+def raise_fd_limit():
+    """Thousands of open connections need as many file descriptors as the system allows."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+async def main(host, port, disk_threads, max_upload_size):
+    upload_server = UploadServer(disk_threads, max_upload_size)
+    tcp_server = await asyncio.start_server(upload_server.handle, host, port,
+                                            limit=MAX_HEADER_SIZE, backlog=4096)
+    log.info("Serving on %s", ', '.join(str(s.getsockname()) for s in tcp_server.sockets))
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCE-Unina asyncio upload server')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Host IP address')
+    parser.add_argument('--port', type=int, default=5001, help='Port number')
+    parser.add_argument('--file', type=str, default='traccia.pdf', help='Path to exam file')
+    parser.add_argument('--upload-folder', type=str, default='uploads', help='Folder to store uploaded files')
+    parser.add_argument('--session', type=str, default=None,
+                        help='Exam session the uploads go to, a folder inside the upload folder (default: today\'s date)')
+    parser.add_argument('--fanout', type=int, default=0,
+                        help='Hex digits of the filename hash used as sub-folder of each channel, for new sessions (0 = none)')
+    parser.add_argument('--storage', type=str, default=None,
+                        help='Commit submissions to a shared object store, s3://bucket/prefix[?endpoint_url=URL] (default: the upload folder)')
+    parser.add_argument('--max-upload-size', type=int, default=200, help='Maximum size of an upload request in MB')
+    parser.add_argument('--gzip-exam', action='store_true', help='Also keep a gzip-compressed copy of the exam file for clients that accept it')
+    parser.add_argument('--disk-threads', type=int, default=4,
+                        help='Threads doing disk writes (and waiting for the group commit: at most this many uploads per batch)')
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default='none',
+                        help="When an upload is answered: 'none' right away, 'file' after flushing it to disk, "
+                             "'group' after flushing it with the uploads of the same few milliseconds")
+    parser.add_argument('--group-commit-interval', type=float, default=5.0,
+                        help='Milliseconds the group committer waits for more uploads before flushing (durability group)')
+    parser.add_argument('--file-delivery', choices=FILE_DELIVERY_MODES, default='python',
+                        help="How the exam is sent: 'sendfile' from the page cache, or headers for a front proxy (nginx, Apache)")
+    parser.add_argument('--accel-prefix', type=str, default='/_sce_files/',
+                        help='Internal nginx location serving absolute paths (x-accel-redirect mode)')
+    parser.add_argument('--spool-size', type=int, default=64,
+                        help='KB of each upload kept in memory before spilling to disk (bounds memory with many clients)')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    # the upload helpers read their settings from sce_unina_server's globals
+    server.FILE_PATH = args.file
+    try:
+        server.UPLOAD_FOLDER = start_session(args.upload_folder, args.session, args.fanout)
+        if args.storage:
+            server.STORAGE = open_storage(args.storage)
+            write_session(server.STORAGE, os.path.basename(server.UPLOAD_FOLDER))
+    except (ValueError, RuntimeError, StorageError) as e:
+        parser.error(str(e))
+    server.UPLOAD_SPOOL_SIZE = args.spool_size * 1024
+    server.FILE_SENDER = FileSender(args.file_delivery, args.accel_prefix)
+    server.DURABILITY = Durability(args.durability, args.group_commit_interval / 1000)
+    os.makedirs(server.UPLOAD_FOLDER, exist_ok=True)
+    repaired = server.replay_journal()
+    if repaired:
+        log.warning("recovered %d submissions from the journal after an unclean shutdown", repaired)
+
+    EXAM_CACHE.gzip_enabled = args.gzip_exam
+    EXAM_CACHE.get(args.file)
+    raise_fd_limit()
+
+    try:
+        asyncio.run(main(args.host, args.port, args.disk_threads, args.max_upload_size * 1024 * 1024))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,406 @@
+#! /usr/bin/env python3
+"""
+Exam-day load test for the SCE-Unina backends.
+
+Starts local instances of sce_unina_server.py, sce_unina_dashboard.py and
+deus/deus_server.py on free ports (or targets already running ones) and
+replays the bursts of an exam session:
+
+- download: every student fetches /get_exam at the same time;
+- upload:   every student POSTs a zip to /upload at the deadline, optionally
+            through a bandwidth-limited (slow Wi-Fi) connection, while a few
+            dashboards poll /dashboard;
+- deus:     every student submits the deus web form with a few source files.
+
+For each scenario it reports throughput, p50/p95/p99 latency, error rate and
+the peak RSS of the server processes, and can save everything as JSON so that
+runs of different versions can be compared.
+
+Only the standard library is needed on the client side.
+"""
+
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_zip(size):
+    """A zip of roughly `size` bytes (incompressible content, stored)."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr('main.c', os.urandom(max(size - 200, 0)))
+    return buf.getvalue()
+
+
+def multipart(fields, files):
+    """Encode a multipart/form-data body; files are (field, filename, bytes) triples."""
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for name, value in fields.items():
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                  f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        out.write(data)
+        out.write(b'\r\n')
+    out.write(f'--{boundary}--\r\n'.encode())
+    return out.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+def throttled(body, bandwidth, chunk_size=16 * 1024):
+    """Yield `body` in chunks paced to `bandwidth` bytes/s (no pacing if 0)."""
+    start = time.monotonic()
+    for offset in range(0, len(body), chunk_size):
+        yield body[offset:offset + chunk_size]
+        if bandwidth:
+            ahead = (offset + chunk_size) / bandwidth - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class Stats:
+    """Latencies, errors and transferred bytes of one scenario."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, latency, status, sent, received):
+        with self._lock:
+            if 200 <= status < 400:
+                self.latencies.append(latency)
+            else:
+                self.errors[str(status)] = self.errors.get(str(status), 0) + 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def summary(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        ok = len(self.latencies)
+        total = ok + sum(self.errors.values())
+        return {
+            'scenario': self.name,
+            'requests': total,
+            'ok': ok,
+            'errors': self.errors,
+            'error_rate': (total - ok) / total if total else 0.0,
+            'elapsed_s': elapsed,
+            'throughput_rps': ok / elapsed if elapsed else 0.0,
+            'sent_mb_s': self.bytes_sent / elapsed / 1e6 if elapsed else 0.0,
+            'received_mb_s': self.bytes_received / elapsed / 1e6 if elapsed else 0.0,
+            'latency_ms': {p: (percentile(self.latencies, int(p[1:])) or 0) * 1000
+                           for p in ('p50', 'p95', 'p99')},
+        }
+
+
+def request(url, method='GET', body=None, headers=None, bandwidth=0, timeout=120):
+    """Issue one HTTP request; returns (status, bytes sent, bytes received). Network errors map to status 0."""
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    try:
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+        conn.putrequest(method, path)
+        for key, value in headers.items():
+            conn.putheader(key, value)
+        conn.endheaders()
+        if body is not None:
+            for chunk in throttled(body, bandwidth):
+                conn.send(chunk)
+        response = conn.getresponse()
+        received = len(response.read())
+        return response.status, len(body or b''), received
+    except (OSError, http.client.HTTPException):
+        return 0, 0, 0
+    finally:
+        conn.close()
+
+
+def timed(stats, *args, **kwargs):
+    start = time.monotonic()
+    status, sent, received = request(*args, **kwargs)
+    stats.add(time.monotonic() - start, status, sent, received)
+
+
+def run_burst(name, clients, job):
+    """Run job(i, stats) for every client at once."""
+    stats = Stats(name)
+    stats.started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(lambda i: job(i, stats), range(clients)))
+    stats.finished = time.monotonic()
+    return stats
+
+
+def download_burst(server_url, clients, repeat):
+    def job(i, stats):
+        for _ in range(repeat):
+            timed(stats, f'{server_url}/get_exam')
+    return run_burst('download', clients, job)
+
+
+def upload_burst(server_url, clients, zip_size, bandwidth, channels):
+    payload = make_zip(zip_size)
+
+    def job(i, stats):
+        channel = channels[i % len(channels)]
+        body, content_type = multipart({}, [('file', f'Student{i}_Bench_N{i:05d}_{channel}.zip', payload)])
+        # spread the start over the first second, like a real deadline
+        time.sleep(random.random())
+        timed(stats, f'{server_url}/upload', 'POST', body, {'Content-Type': content_type}, bandwidth=bandwidth)
+    return run_burst('upload', clients, job)
+
+
+def deus_burst(deus_url, clients, files, file_size):
+    def job(i, stats):
+        sources = [('files', f'file{n}.c', os.urandom(file_size)) for n in range(files)]
+        body, content_type = multipart({'nome': f'Student{i}', 'cognome': 'Bench', 'matricola': f'N{i:05d}',
+                                        'docente': 'Bench'}, sources)
+        timed(stats, f'{deus_url}/', 'POST', body, {'Content-Type': content_type})
+    return run_burst('deus', clients, job)
+
+
+def poll_dashboard(dashboard_url, pollers, interval, stop):
+    """Keep `pollers` dashboards refreshing until `stop` is set."""
+    stats = Stats('dashboard')
+    stats.started = time.monotonic()
+
+    def poller():
+        while not stop.is_set():
+            timed(stats, f'{dashboard_url}/dashboard')
+            stop.wait(interval)
+
+    threads = [threading.Thread(target=poller, daemon=True) for _ in range(pollers)]
+    for t in threads:
+        t.start()
+    return stats, threads
+
+
+def process_tree_rss(pid):
+    """Resident memory (bytes) of a process and its descendants; None where /proc is unavailable."""
+    if not os.path.isdir('/proc'):
+        return None
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [p for p, pp in parents.items() if pp == parent and p not in tree]
+        tree.update(children)
+        frontier.extend(children)
+    rss = 0
+    for p in tree:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return rss
+
+
+class ServerProcess:
+    """A backend started for the benchmark, with peak-RSS sampling."""
+
+    def __init__(self, name, cmd, cwd, port):
+        self.name = name
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        self.log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, cwd=cwd, stdout=self.log, stderr=subprocess.STDOUT)
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._wait_ready()
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _wait_ready(self, timeout=20):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                self.log.seek(0)
+                raise RuntimeError(f'{self.name} exited:\n{self.log.read().decode(errors="replace")}')
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f'{self.name} did not start listening on port {self.port}')
+
+    def _sample(self):
+        while not self._stop.wait(0.25):
+            rss = process_tree_rss(self.proc.pid)
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss, rss)
+
+    def reset_peak(self):
+        self.peak_rss = process_tree_rss(self.proc.pid) or 0
+
+    def stop(self):
+        self._stop.set()
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def print_summary(summary):
+    lat = summary['latency_ms']
+    rss = summary.get('server_peak_rss_mb')
+    print(f"{summary['scenario']:>10}: {summary['requests']:6d} req  {summary['throughput_rps']:8.1f} req/s  "
+          f"p50 {lat['p50']:8.1f} ms  p95 {lat['p95']:8.1f} ms  p99 {lat['p99']:8.1f} ms  "
+          f"errors {summary['error_rate']:6.1%}" + (f"  peak RSS {rss:7.1f} MB" if rss else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SCE-Unina exam-day load test')
+    parser.add_argument('--scenarios', type=str, default='download,upload,deus',
+                        help='Comma-separated scenarios to run: download, upload, deus')
+    parser.add_argument('--clients', type=int, default=200, help='Simulated students')
+    parser.add_argument('--downloads-per-client', type=int, default=1, help='/get_exam requests per student')
+    parser.add_argument('--exam-size', type=int, default=2 * 1024 * 1024, help='Size of the generated exam file in bytes')
+    parser.add_argument('--zip-size', type=int, default=512 * 1024, help='Size of each uploaded zip in bytes')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Per-client upload bandwidth in bytes/s (0 = unlimited)')
+    parser.add_argument('--channels', type=str, default='Tramontana,Natella,Cotroneo', help='Channels to spread uploads over')
+    parser.add_argument('--dashboard-pollers', type=int, default=3, help='Dashboards polling during the upload burst')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds between dashboard refreshes')
+    parser.add_argument('--deus-files', type=int, default=3, help='Source files per deus submission')
+    parser.add_argument('--deus-file-size', type=int, default=20 * 1024, help='Size of each deus source file in bytes')
+    parser.add_argument('--server-args', type=str, default='', help='Extra arguments for sce_unina_server.py, e.g. "--mode prefork"')
+    parser.add_argument('--server-url', type=str, help='Use a running upload server instead of starting one')
+    parser.add_argument('--dashboard-url', type=str, help='Use a running dashboard instead of starting one')
+    parser.add_argument('--deus-url', type=str, help='Use a running deus server instead of starting one')
+    parser.add_argument('--label', type=str, default='', help='Free-form label stored in the results (e.g. git revision)')
+    parser.add_argument('--output', type=str, help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    workdir = tempfile.TemporaryDirectory(prefix='sce-unina-bench-')
+    upload_folder = os.path.join(workdir.name, 'uploads')
+    os.makedirs(upload_folder)
+    exam_path = os.path.join(workdir.name, 'traccia.pdf')
+    with open(exam_path, 'wb') as f:
+        f.write(b'%PDF-1.4\n' + os.urandom(args.exam_size))
+
+    servers = {}
+    try:
+        server_url, dashboard_url, deus_url = args.server_url, args.dashboard_url, args.deus_url
+        if not server_url and {'download', 'upload'} & set(scenarios):
+            port = free_port()
+            servers['server'] = ServerProcess('sce_unina_server', [
+                sys.executable, os.path.join(BACKEND_DIR, 'sce_unina_server.py'), '--host', '127.0.0.1',
+                '--port', str(port), '--file', exam_path, '--upload-folder', upload_folder
+            ] + args.server_args.split(), workdir.name, port)
+            server_url = servers['server'].url
+        if not dashboard_url and 'upload' in scenarios and args.dashboard_pollers:
+            port = free_port()
+            servers['dashboard'] = ServerProcess('sce_unina_dashboard', [
+                sys.executable, os.path.join(BACKEND_DIR, 'sce_unina_dashboard.py'), '--host', '127.0.0.1',
+                '--port', str(port), '--upload-folder', upload_folder
+            ], workdir.name, port)
+            dashboard_url = servers['dashboard'].url
+        if not deus_url and 'deus' in scenarios:
+            port = free_port()
+            servers['deus'] = ServerProcess('deus_server', [
+                sys.executable, os.path.join(BACKEND_DIR, 'deus', 'deus_server.py'), '--port', str(port)
+            ], workdir.name, port)
+            deus_url = servers['deus'].url
+
+        def finish(stats, server):
+            summary = stats.summary()
+            if server in servers:
+                summary['server_peak_rss_mb'] = servers[server].peak_rss / 1e6
+            print_summary(summary)
+            return summary
+
+        results = []
+        for scenario in scenarios:
+            for server in servers.values():
+                server.reset_peak()
+
+            if scenario == 'download':
+                results.append(finish(download_burst(server_url, args.clients, args.downloads_per_client), 'server'))
+            elif scenario == 'upload':
+                stop = threading.Event()
+                pollers = None
+                if dashboard_url and args.dashboard_pollers:
+                    pollers, threads = poll_dashboard(dashboard_url, args.dashboard_pollers, args.poll_interval, stop)
+                stats = upload_burst(server_url, args.clients, args.zip_size, args.bandwidth,
+                                     args.channels.split(','))
+                stop.set()
+                results.append(finish(stats, 'server'))
+                if pollers is not None:
+                    for t in threads:
+                        t.join()
+                    pollers.finished = time.monotonic()
+                    results.append(finish(pollers, 'dashboard'))
+            elif scenario == 'deus':
+                results.append(finish(deus_burst(deus_url, args.clients, args.deus_files, args.deus_file_size), 'deus'))
+            else:
+                parser.error(f'unknown scenario: {scenario}')
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({
+                    'label': args.label,
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                             'cpus': os.cpu_count()},
+                    'config': vars(args),
+                    'results': results,
+                }, f, indent=2)
+            print(f'Results written to {args.output}')
+    finally:
+        for server in servers.values():
+            server.stop()
+        workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Content-addressed storage of submissions.
+
+Every accepted upload is stored once under <upload folder>/.blobs/<aa>/<sha256>,
+whatever its name: identical re-uploads only cost a lookup. The usual layout
+uploads/<channel>/<filename> is kept as the "latest" pointer, a hard link to
+the current blob swapped in with a single os.replace(), so the dashboard and
+downloads keep working unchanged. The pointer's mtime is the submission
+time, so content another student already submitted gets a copy instead of
+a link. Each student/channel file also gets an append-only version log in
+.versions/<channel>/<filename>.jsonl.
+"""
+
+import json
+import os
+import secrets
+import shutil
+import time
+
+from sce_unina_storage import LOCAL
+
+BLOBS_DIR = '.blobs'
+VERSIONS_DIR = '.versions'
+
+
+class BlobStore:
+    def __init__(self, upload_folder):
+        self.upload_folder = upload_folder
+        self.root = os.path.join(upload_folder, BLOBS_DIR)
+        self.versions_root = os.path.join(upload_folder, VERSIONS_DIR)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def has(self, sha256):
+        return os.path.exists(self.blob_path(sha256))
+
+    def locate(self, sha256):
+        """(storage, key) to read a blob through, like ObjectBlobStore.locate()."""
+        return LOCAL, self.blob_path(sha256)
+
+    def tmp_dir(self):
+        """Scratch directory on the same filesystem as the blobs, for in-progress uploads."""
+        path = os.path.join(self.root, 'tmp')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def put(self, source, sha256):
+        """
+        Store content under its SHA-256.
+
+        `source` is either the path of a fully written temporary file (moved
+        into the store, or deleted if the content is already there) or the
+        content itself as bytes. Returns (blob path, True if newly stored).
+        """
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            if isinstance(source, str):
+                os.unlink(source)
+            return path, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(source, str):
+            tmp = source
+        else:
+            tmp = os.path.join(self.tmp_dir(), f'{sha256}.{secrets.token_hex(4)}')
+            with open(tmp, 'wb') as f:
+                f.write(source)
+        # blobs are shared by hard links: never modify them in place
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+        return path, True
+
+    def publish(self, sha256, dest, mtime=None):
+        """
+        Point `dest` at a blob (hard link, or copy where links are unsupported)
+        in one atomic step, stamped with the submission time `mtime` (default:
+        now), which is what the dashboard and the index show.
+
+        A blob already published under another name is copied instead: its
+        inode's mtime is that submission's time, and touching it would move it.
+        """
+        blob = self.blob_path(sha256)
+        try:
+            st = os.stat(dest)
+            if os.path.samestat(st, os.stat(blob)):
+                # already the latest version: just mark the resubmission time
+                if st.st_nlink <= 2:
+                    os.utime(dest, None if mtime is None else (mtime, mtime))
+                    return
+        except FileNotFoundError:
+            pass
+
+        tmp = os.path.join(os.path.dirname(dest), f'.{os.path.basename(dest)}.{secrets.token_hex(4)}.link')
+        try:
+            os.link(blob, tmp)
+            if os.stat(tmp).st_nlink > 2:
+                # the blob and this link are not alone: some other file shares the inode
+                os.unlink(tmp)
+                shutil.copyfile(blob, tmp)
+        except OSError:
+            shutil.copyfile(blob, tmp)
+        os.utime(tmp, None if mtime is None else (mtime, mtime))
+        os.replace(tmp, dest)
+        try:
+            # rename() is a no-op when both names are links to the same blob,
+            # which happens if an identical upload raced us
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+
+    def _versions_path(self, channel, filename):
+        return os.path.join(self.versions_root, channel, filename + '.jsonl')
+
+    def record_version(self, channel, filename, sha256, size, mtime=None):
+        path = self._versions_path(channel, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        line = json.dumps({'time': time.time() if mtime is None else mtime, 'sha256': sha256, 'size': size}) + '\n'
+        # a single O_APPEND write: concurrent writers never interleave lines
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def versions(self, channel, filename):
+        """Submitted versions of a file, oldest first."""
+        try:
+            with open(self._versions_path(channel, filename)) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
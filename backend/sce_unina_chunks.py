@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+"""
+Content-defined chunking of submissions, for delta re-uploads.
+
+A zip is cut into chunks where a rolling hash of its bytes hits a pattern,
+so boundaries depend only on the bytes around them: when one source file
+changes, only the chunks covering its compressed data and the central
+directory change, and every other chunk of the previous submission can be
+reused. The server keeps the chunk list (manifest) of each stored content in
+<upload folder>/.chunks/, computed the first time a delta is asked against
+it; a client sends the manifest of its new zip and then only the chunks the
+server doesn't have (see /upload/delta in sce_unina_server.py).
+
+Chunking, which clients must reproduce exactly:
+
+- gear[b] is the first 4 bytes, little endian, of SHA-256(bytes([b]));
+- h = ((h << 1) + gear[byte]) mod 2**32 over the whole file, starting at 0;
+- a chunk ends after a byte where h & MASK == 0, as long as the chunk is at
+  least MIN_SIZE bytes; chunks are cut at MAX_SIZE bytes regardless;
+- a chunk is identified by the first 16 bytes of its SHA-256, in hex.
+
+Since h only depends on the last 32 bytes, the hash of every position can be
+computed at once: NumPy does that when available, a pure Python loop (same
+boundaries, only slower) otherwise.
+
+    python sce_unina_chunks.py upload --server http://127.0.0.1:5001 ROSSI_MARIO_N12345_Tramontana.zip
+"""
+
+import os
+import sys
+import json
+import struct
+import hashlib
+import argparse
+import urllib.error
+import urllib.request
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNKS_DIR = '.chunks'
+
+# 8 KiB chunks on average, never smaller than 2 KiB (but the last) nor larger than 64 KiB
+MIN_SIZE = 2 * 1024
+MAX_SIZE = 64 * 1024
+MASK = (1 << 13) - 1
+DIGEST_SIZE = 16
+
+GEAR = [int.from_bytes(hashlib.sha256(bytes([b])).digest()[:4], 'little') for b in range(256)]
+_WINDOW = 32
+# NumPy works on blocks of this many bytes, so memory stays bounded for large files
+_BLOCK = 4 * 1024 * 1024
+
+_ENTRY = struct.Struct(f'<{DIGEST_SIZE}sI')
+
+
+def _candidates_numpy(data):
+    """End offsets of the chunks allowed by the hash alone (positions where h & MASK == 0), plus one."""
+    gear = np.array(GEAR, dtype=np.uint32)
+    view = np.frombuffer(data, dtype=np.uint8)
+    result = []
+    for start in range(0, len(view), _BLOCK):
+        # the block plus the 31 bytes before it, which still weigh on its first hashes
+        lead = min(start, _WINDOW - 1)
+        g = gear[view[start - lead:start + _BLOCK]]
+        h = g.copy()
+        for k in range(1, _WINDOW):
+            h[k:] += g[:-k] << np.uint32(k)
+        hits = np.flatnonzero((h[lead:] & np.uint32(MASK)) == 0)
+        result.append(hits + (start + 1))
+    return np.concatenate(result).tolist() if result else []
+
+
+def _candidates_python(data):
+    h = 0
+    result = []
+    for i, byte in enumerate(data):
+        h = ((h << 1) + GEAR[byte]) & 0xFFFFFFFF
+        if not h & MASK:
+            result.append(i + 1)
+    return result
+
+
+def boundaries(data):
+    """End offset of every chunk of `data`."""
+    candidates = _candidates_numpy(data) if np is not None else _candidates_python(data)
+    ends = []
+    start = 0
+    for end in candidates:
+        while end - start > MAX_SIZE:
+            start += MAX_SIZE
+            ends.append(start)
+        if end - start >= MIN_SIZE:
+            ends.append(end)
+            start = end
+    while len(data) - start > MAX_SIZE:
+        start += MAX_SIZE
+        ends.append(start)
+    if start < len(data):
+        ends.append(len(data))
+    return ends
+
+
+def chunk_digest(chunk):
+    return hashlib.sha256(chunk).hexdigest()[:DIGEST_SIZE * 2]
+
+
+def manifest(data):
+    """[(chunk digest, size)] of `data`, in order."""
+    result = []
+    start = 0
+    view = memoryview(data)
+    for end in boundaries(data):
+        result.append((chunk_digest(view[start:end]), end - start))
+        start = end
+    return result
+
+
+class ManifestStore:
+    """Manifests of stored contents, cached on disk by SHA-256."""
+
+    def __init__(self, upload_folder):
+        self.root = os.path.join(upload_folder, CHUNKS_DIR, f'gear-{MIN_SIZE}-{MASK + 1}-{MAX_SIZE}')
+
+    def _path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def get(self, sha256):
+        try:
+            with open(self._path(sha256), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return [(d.hex(), size) for d, size in _ENTRY.iter_unpack(data)]
+
+    def put(self, sha256, chunks):
+        path = self._path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(_ENTRY.pack(bytes.fromhex(d), size) for d, size in chunks))
+        os.replace(tmp, path)
+
+    def load(self, sha256, storage, key):
+        """Manifest of the content stored at `key` of `storage`, chunked now if it isn't cached yet."""
+        chunks = self.get(sha256)
+        if chunks is None:
+            with storage.open(key) as f:
+                chunks = manifest(f.read())
+            self.put(sha256, chunks)
+        return chunks
+
+
+def delta_plan(chunks, base_chunks):
+    """
+    How to build a file made of `chunks` from a base file made of
+    `base_chunks`: a list of ('base', offset, size) copies (adjacent ones
+    merged) and ('new', index, size) chunks to be received, in file order.
+    """
+    known = {}
+    offset = 0
+    for d, size in base_chunks:
+        known.setdefault((d, size), offset)
+        offset += size
+
+    steps = []
+    for i, (d, size) in enumerate(chunks):
+        offset = known.get((d, size))
+        if offset is None:
+            steps.append(('new', i, size))
+        elif steps and steps[-1][0] == 'base' and steps[-1][1] + steps[-1][2] == offset:
+            steps[-1] = ('base', steps[-1][1], steps[-1][2] + size)
+        else:
+            steps.append(('base', offset, size))
+    return steps
+
+
+def valid_manifest(chunks, size):
+    """Whether `chunks` (as decoded from JSON) is a well-formed manifest of a `size`-byte file."""
+    if not isinstance(chunks, list):
+        return False
+    total = 0
+    for entry in chunks:
+        if (not isinstance(entry, list) or len(entry) != 2 or not isinstance(entry[0], str)
+                or len(entry[0]) != DIGEST_SIZE * 2 or not isinstance(entry[1], int) or not 0 < entry[1] <= MAX_SIZE):
+            return False
+        try:
+            bytes.fromhex(entry[0])
+        except ValueError:
+            return False
+        total += entry[1]
+    return total == size
+
+
+def upload(server, path):
+    """
+    Send the zip at `path` to `server` as a delta against the previous
+    submission of the same file. Returns (bytes sent, server message), or None
+    if the server has no previous version (use a plain /upload then).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    chunks = manifest(data)
+    request = {'filename': os.path.basename(path), 'size': len(data),
+               'sha256': hashlib.sha256(data).hexdigest(), 'chunks': chunks}
+    body = json.dumps(request).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(
+                f'{server}/upload/delta', body, {'Content-Type': 'application/json'})) as response:
+            delta = json.load(response)
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+
+    offsets = [0]
+    for _, size in chunks:
+        offsets.append(offsets[-1] + size)
+    missing = b''.join(data[offsets[i]:offsets[i + 1]] for i in delta['missing'])
+    with urllib.request.urlopen(urllib.request.Request(
+            f"{server}/upload/delta/{delta['delta_id']}", missing,
+            {'Content-Type': 'application/octet-stream'})) as response:
+        message = response.read().decode()
+    return len(body) + len(missing), message
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCE-Unina delta uploads')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    manifest_parser = subparsers.add_parser('manifest', help='Print the chunks of a file')
+    manifest_parser.add_argument('file')
+    upload_parser = subparsers.add_parser('upload', help='Re-upload a submission sending only the changed chunks')
+    upload_parser.add_argument('--server', type=str, default='http://127.0.0.1:5001', help='Upload server URL')
+    upload_parser.add_argument('file')
+    args = parser.parse_args()
+
+    if args.command == 'manifest':
+        with open(args.file, 'rb') as f:
+            for d, size in manifest(f.read()):
+                print(d, size)
+    elif args.command == 'upload':
+        try:
+            result = upload(args.server.rstrip('/'), args.file)
+        except urllib.error.HTTPError as e:
+            sys.exit(f"{e.code}: {e.read().decode(errors='replace')}")
+        if result is None:
+            sys.exit("No previous submission of this file on the server: upload it normally first")
+        sent, message = result
+        print(f"{message} ({sent} of {os.path.getsize(args.file)} bytes sent)")
+    sys.exit(0)
@@ -1,80 +1,683 @@
-from flask import Flask, render_template_string, send_file, request, abort, send_from_directory
+from flask import Flask, Response, send_file, request, abort, jsonify, redirect, stream_with_context
 import os
+import re
+import sys
+import json
+import time
 import datetime
+import threading
+import zipfile
+import hashlib
 import argparse
+from collections import OrderedDict, namedtuple
+
+from werkzeug.datastructures import ContentRange
+from werkzeug.utils import safe_join
+
+from sce_unina_index import SubmissionIndex, SubmissionRegistry, IndexWatcher
+from sce_unina_export import ZipStream
+from sce_unina_blobs import BlobStore
+from sce_unina_metrics import Metrics
+from sce_unina_validation import ValidationQueue, Validator
+from sce_unina_grading import GradingResults, Grader, Recipes, load_recipes
+from sce_unina_similarity import SimilarityIndex, Signer
+from sce_unina_sendfile import FileSender, MODES as FILE_DELIVERY_MODES
+from sce_unina_storage import ObjectBlobStore, StorageError, open_storage, read_session
+import sce_unina_sessions as sessions
+from sce_unina_zipindex import listing, read_member, MemberError, MemberNotFound
 
 app = Flask(__name__)
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Exam session shown (a folder of UPLOAD_FOLDER); None follows the one the upload server is using
+SESSION = None
+
+# Object store the upload servers commit to (--storage); None when they write to UPLOAD_FOLDER.
+# The index, validation results and signatures stay in UPLOAD_FOLDER/<session>/ either way.
+STORAGE = None
+# How long the active session read from the object store is trusted
+REMOTE_SESSION_TTL = 5.0
+
+# Rows shown per dashboard page
+PAGE_SIZE = 100
+
+# How often live-update streams look for new submissions, and send keep-alives
+LIVE_POLL_INTERVAL = 1.0
+LIVE_KEEPALIVE = 15.0
+
+# Largest archive member shown inline by the zip browser
+PREVIEW_MAX_SIZE = 1024 * 1024
+
+# highlight.js language of the source files students submit
+HIGHLIGHT_LANGUAGES = {
+    '.py': 'python', '.java': 'java', '.c': 'c', '.h': 'c', '.cpp': 'cpp', '.hpp': 'cpp',
+    '.m': 'matlab', '.makefile': 'makefile', '.txt': 'plaintext', '.md': 'markdown',
+}
+
+# Processes validating new submissions in the background (0 = leave it to sce_unina_validation.py)
+VALIDATE_WORKERS = 2
+
+# Build and test recipe of each channel (see sce_unina_grading.py), and processes grading
+# new submissions with them in the background (0 = leave it to sce_unina_grading.py).
+# Without either the Build/Test column stays empty and no result is ever read.
+RECIPES = None
+GRADE_WORKERS = 0
+
+# Processes signing new submissions for the similarity report in the background
+# (0 = leave it to sce_unina_similarity.py: the report shows the signatures already stored)
+SIMILARITY_WORKERS = 1
+
+# Keep the session's index and validation results in memory, shared with an upload server
+# in the same process (sce_unina_unified.py)
+IN_MEMORY_INDEX = False
+
+# How submission downloads are sent (see sce_unina_sendfile.py); 'python' keeps send_file()
+FILE_SENDER = FileSender()
+
+# Prometheus metrics at /metrics; the live-update streams are long by design, keep them out of the slow log
+METRICS = Metrics('sce_unina_dashboard', slow_exclude={'/api/events', '/api/changes'})
+METRICS.init_app(app)
+
+_index = None
+_validation = None
+_grading = None
+_similarity = None
+_workers = []
+_index_lock = threading.Lock()
+
+
+_remote_session = (None, 0.0)
+
+
+def remote_session():
+    """The session the upload servers write to in the object store, re-read every REMOTE_SESSION_TTL seconds."""
+    global _remote_session
+    name, checked = _remote_session
+    if time.monotonic() - checked > REMOTE_SESSION_TTL:
+        try:
+            name = read_session(STORAGE) or sessions.default_session_name()
+        except StorageError:
+            # keep showing the last known session while the store is unreachable
+            name = name or sessions.default_session_name()
+        _remote_session = (name, time.monotonic())
+    return name
+
+
+def session_folder():
+    """Folder of the session on display: only that one is ever scanned or indexed."""
+    if STORAGE is not None:
+        return os.path.join(UPLOAD_FOLDER, SESSION or remote_session())
+    return sessions.session_folder(UPLOAD_FOLDER, SESSION)
+
+
+def remote_store():
+    """The ObjectBlobStore of the session on display, None without --storage."""
+    if STORAGE is None:
+        return None
+    return ObjectBlobStore(STORAGE, os.path.basename(session_folder()))
+
+
+def open_index(folder):
+    # results can only be kept in memory if this process is the one producing them
+    validation = ValidationQueue(folder, exclusive=IN_MEMORY_INDEX and VALIDATE_WORKERS > 0)
+    remote = remote_store()
+    index_class = SubmissionRegistry if IN_MEMORY_INDEX else SubmissionIndex
+    index = index_class(folder, remote, validation.enqueue if remote is not None else None)
+    return index, validation
+
+
+def submission_index():
+    """The index of the current session, created (with its watcher, validator, grader and signer) on first use."""
+    global _index, _validation, _grading, _similarity, _workers
+    folder = session_folder()
+    with _index_lock:
+        if _index is None or _index.upload_folder != folder:
+            # a new session was started: stop watching the previous one
+            for worker in _workers:
+                worker.stop()
+            _index, _validation = open_index(folder)
+            _grading = None
+            if GRADE_WORKERS > 0 or RECIPES is not None:
+                # with a grader, this process produces every result: they are kept in memory
+                _grading = GradingResults(folder, exclusive=GRADE_WORKERS > 0)
+            _similarity = SimilarityIndex(folder, remote=_index.remote)
+            _index.rebuild()
+            _workers = [IndexWatcher(_index)]
+            if VALIDATE_WORKERS > 0:
+                _workers.append(Validator(_validation, VALIDATE_WORKERS, blobs=_index.remote))
+            if GRADE_WORKERS > 0:
+                _workers.append(Grader(_index, _grading, RECIPES or Recipes(), GRADE_WORKERS, blobs=_index.remote))
+            if SIMILARITY_WORKERS > 0:
+                _workers.append(Signer(_index, _similarity, SIMILARITY_WORKERS))
+            for worker in _workers:
+                worker.start()
+        return _index
+
+
+def validation_queue():
+    submission_index()
+    return _validation
+
+
+def grading_results():
+    """Build and test results of the session on display, None if this dashboard doesn't show them."""
+    submission_index()
+    return _grading
+
+
+def grading_status(channel, sha256):
+    """Build and test outcome of a submission for display: {'status': ..., 'problems': [...]}, plus the full 'result'."""
+    results = grading_results()
+    if not sha256 or results is None:
+        return {'status': 'unknown', 'problems': [], 'result': None}
+    result = results.result(sha256, (RECIPES or Recipes()).for_channel(channel)[0])
+    if result is None:
+        return {'status': 'pending' if GRADE_WORKERS > 0 else 'unknown', 'problems': [], 'result': None}
+    problems = list(result.get('problems', []))
+    for step in ('build', 'test'):
+        outcome = result.get(step)
+        if outcome is not None:
+            problems.append(f"{step}: {outcome['status']} ({outcome['seconds']} s)")
+            if outcome['status'] != 'ok':
+                # the end of the compiler or test output says what went wrong
+                problems.extend(outcome['output'].strip().splitlines()[-5:])
+    return {'status': result['status'], 'problems': problems, 'result': result}
+
+
+_similarity_seen = (None, None)
+_similarity_lock = threading.Lock()
+
+
+def similarity_index():
+    """The similarity index of the session on display; its Signer keeps it up to date, nothing is signed here."""
+    global _similarity_seen
+    index = submission_index()
+    similarity = _similarity
+    if SIMILARITY_WORKERS > 0:
+        return similarity
+    with _similarity_lock:
+        # no signer: pick up the signatures stored by sce_unina_similarity.py
+        seen = (similarity, index.version())
+        if seen != _similarity_seen:
+            similarity.update(index.query('teacher', 'asc'))
+            _similarity_seen = seen
+        return similarity
+
 @app.route('/uploads/<path:filepath>')
 def download_file(filepath):
-    return send_from_directory(UPLOAD_FOLDER, filepath, as_attachment=True)
+    # only submissions: never the store's own files (.blobs, .index.sqlite3, .resumable, .journal...)
+    if any(part.startswith('.') for part in filepath.split('/')):
+        abort(404)
+    channel, _, filename = filepath.partition('/')
+    if not filename or '/' in filename:
+        abort(404)
+    path = submission_file(channel, filename)
+    if STORAGE is not None:
+        # the client fetches the object straight from the store
+        return redirect(STORAGE.url(path, filename))
+    if FILE_SENDER.offloaded:
+        return FILE_SENDER.send(request, path, download_name=os.path.basename(path))
+    return send_file(path, as_attachment=True)
 
 
-@app.route('/dashboard')
-def dashboard():
-    sort_by = request.args.get('sort', 'timestamp')
-    order = request.args.get('order', 'desc')
+@app.route('/api/versions/<channel>/<filename>')
+def api_versions(channel, filename):
+    """Every version submitted for uploads/<channel>/<filename>, oldest first."""
+    if channel.startswith('.') or filename.startswith('.'):
+        abort(404)
+    versions = (remote_store() or BlobStore(session_folder())).versions(channel, filename)
+    for v in versions:
+        v['download_path'] = f"{request.script_root}/versions/{v['sha256']}/{filename}"
+    return jsonify(channel=channel, filename=filename, versions=versions)
+
+
+@app.route('/versions/<sha256>/<filename>')
+def download_version(sha256, filename):
+    """Download a specific (possibly superseded) version of a submission from the blob store."""
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        abort(404)
+    if STORAGE is not None:
+        storage, key = remote_store().locate(sha256)
+        if not storage.exists(key):
+            abort(404)
+        return redirect(storage.url(key, filename))
+    path = BlobStore(session_folder()).blob_path(sha256)
+    if not os.path.isfile(path):
+        abort(404)
+    if FILE_SENDER.offloaded:
+        return FILE_SENDER.send(request, path, download_name=filename)
+    return send_file(path, as_attachment=True, download_name=filename)
+
+
+def submission_file(channel, filename):
+    """Path of uploads/<channel>/<filename> (its key in the object store), or 404 if it isn't a submission."""
+    if channel.startswith('.') or filename.startswith('.'):
+        abort(404)
+    if STORAGE is not None:
+        if '/' in channel or '/' in filename:
+            abort(404)
+        key = remote_store().submission_key(channel, filename)
+        if not STORAGE.exists(key):
+            abort(404)
+        return key
+    folder = session_folder()
+    if safe_join(folder, channel, filename) is None:
+        abort(404)
+    path = sessions.submission_path(folder, channel, filename)
+    if not os.path.isfile(path):
+        abort(404)
+    return path
+
+
+# Pages compiled once at import, like DASHBOARD_TEMPLATE: the file list of browse_submission()
+BROWSE_TEMPLATE = app.jinja_env.from_string("""
+    <!DOCTYPE html>
+    <html>
+    <head>
+      <title>{{ filename }} - SCE-UNINA Dashboard</title>
+      <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+    </head>
+    <body class="bg-light">
+      <div class="container mt-5">
+        <h1 class="mb-4">{{ filename }}</h1>
+        <p>
+          <a href="{{ root }}/dashboard">&laquo; Dashboard</a> &middot;
+          <a href="{{ root }}/uploads/{{ channel }}/{{ filename }}" download>Download archive</a>
+        </p>
+        <table class="table table-striped table-bordered align-middle">
+          <thead class="table-dark">
+            <tr><th>File</th><th>Size</th><th>Modified</th></tr>
+          </thead>
+          <tbody>
+            {% for m in members %}
+            <tr>
+              <td><a href="{{ root }}/browse/{{ channel }}/{{ filename }}/{{ m.name|urlencode }}">{{ m.name }}</a></td>
+              <td>{{ m.size }}</td>
+              <td>{{ '%04d-%02d-%02d %02d:%02d:%02d' % m.date_time }}</td>
+            </tr>
+            {% endfor %}
+          </tbody>
+        </table>
+        {% if not members %}<p class="text-muted">The archive is empty.</p>{% endif %}
+      </div>
+    </body>
+    </html>
+    """)
+
+
+@app.route('/browse/<channel>/<filename>')
+def browse_submission(channel, filename):
+    """List the files inside a submitted zip (from its cached central directory)."""
+    path = submission_file(channel, filename)
+    try:
+        members = [m for m in listing(path, STORAGE).values() if not m.is_dir]
+    except (zipfile.BadZipFile, OSError):
+        abort(422, description="Not a readable zip archive.")
+
+    return BROWSE_TEMPLATE.render(root=request.script_root, channel=channel, filename=filename, members=members)
+
+
+# One file of an archive, highlighted (browse_member())
+MEMBER_TEMPLATE = app.jinja_env.from_string("""
+    <!DOCTYPE html>
+    <html>
+    <head>
+      <title>{{ member }} - {{ filename }}</title>
+      <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+      <link href="https://cdn.jsdelivr.net/gh/highlightjs/cdn-release@11.9.0/build/styles/github.min.css" rel="stylesheet">
+      <script src="https://cdn.jsdelivr.net/gh/highlightjs/cdn-release@11.9.0/build/highlight.min.js"></script>
+      <script src="https://cdn.jsdelivr.net/gh/highlightjs/cdn-release@11.9.0/build/languages/matlab.min.js"></script>
+    </head>
+    <body class="bg-light">
+      <div class="container mt-5">
+        <h1 class="h3 mb-3">{{ member }}</h1>
+        <p>
+          <a href="{{ root }}/browse/{{ channel }}/{{ filename }}">&laquo; {{ filename }}</a> &middot;
+          <a href="?raw=1">Download file</a>
+        </p>
+        {% if binary %}
+        <p class="text-muted">Binary file ({{ size }} bytes), not shown.</p>
+        {% else %}
+        <pre><code class="{{ 'language-' + language if language else '' }}">{{ text }}</code></pre>
+        <script>if (window.hljs) hljs.highlightAll();</script>
+        {% endif %}
+      </div>
+    </body>
+    </html>
+    """)
+
+
+@app.route('/browse/<channel>/<filename>/<path:member>')
+def browse_member(channel, filename, member):
+    """Show one file of a submitted zip with syntax highlighting (?raw=1 downloads it)."""
+    path = submission_file(channel, filename)
+    try:
+        data = read_member(path, member, PREVIEW_MAX_SIZE, STORAGE)
+    except (zipfile.BadZipFile, OSError):
+        abort(422, description="Not a readable zip archive.")
+    except MemberNotFound as e:
+        abort(404, description=str(e))
+    except MemberError as e:
+        abort(422, description=str(e))
+
+    if request.args.get('raw'):
+        response = Response(data, mimetype='application/octet-stream')
+        response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(member))
+        return response
+
+    binary = b'\0' in data[:8192]
+    ext = os.path.splitext(member)[1].lower()
+    if os.path.basename(member).lower() == 'makefile':
+        ext = '.makefile'
+
+    return MEMBER_TEMPLATE.render(
+        root=request.script_root,
+        channel=channel,
+        filename=filename,
+        member=member,
+        binary=binary,
+        size=len(data),
+        language=HIGHLIGHT_LANGUAGES.get(ext),
+        text='' if binary else data.decode('utf-8', errors='replace')
+    )
 
-    records = []
 
-    for teacher in os.listdir(UPLOAD_FOLDER):
-        teacher_path = os.path.join(UPLOAD_FOLDER, teacher)
+def parse_time_filter(value):
+    """Accept an ISO date/datetime or a UNIX timestamp; None if empty."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromtimestamp(float(value))
+    except ValueError:
+        return datetime.datetime.fromisoformat(value)
+
 
-        if not os.path.isdir(teacher_path):
+def export_archive(index, channel, since=None, until=None, students=None):
+    """
+    ZipStream of the current submissions of `channel`, optionally limited to a
+    time window and/or a set of student IDs. None if nothing matches.
+    """
+    files = []
+    for r in index.query('timestamp', 'asc', teacher=channel):
+        if since is not None and r['timestamp'] < since:
             continue
+        if until is not None and r['timestamp'] > until:
+            continue
+        if students and r['student_id'] not in students:
+            continue
+        files.append((r['filename'], index.file_path(r['teacher'], r['filename'])))
+    return ZipStream(files, index.remote.storage if index.remote is not None else None) if files else None
+
 
-        for filename in os.listdir(teacher_path):
-            if not filename.endswith('.zip'):
-                continue
-
-            file_path = os.path.join(teacher_path, filename)
-            if not os.path.isfile(file_path):
-                continue
-
-            stat = os.stat(file_path)
-            timestamp = datetime.datetime.fromtimestamp(stat.st_mtime)
-
-            base = filename[:-4]
-            parts = base.split('_')
-            if len(parts) < 3:
-                continue
-
-            surname = parts[0]
-            name = parts[1]
-            student_id = parts[2]
-
-            records.append({
-                'timestamp': timestamp,
-                'surname': surname,
-                'name': name,
-                'student_id': student_id,
-                'teacher': teacher,
-                'filename': filename,
-                'download_path': f"{teacher}/{filename}"
-            })
-
-    reverse = (order == 'desc')
+@app.route('/export/<channel>.zip')
+def export_channel(channel):
+    """
+    Stream every submission of a channel as one stored zip, generated on the fly.
+
+    Optional filters: ?since= / ?until= (ISO datetime or UNIX time) and
+    ?students=ID1,ID2. The response has an exact Content-Length and supports
+    Range / If-Range, so an interrupted download can be resumed.
+    """
     try:
-        records.sort(
-            key=lambda x: x[sort_by].lower() if isinstance(x[sort_by], str) else x[sort_by],
-            reverse=reverse
-        )
-    except KeyError:
-        pass
+        since = parse_time_filter(request.args.get('since'))
+        until = parse_time_filter(request.args.get('until'))
+    except ValueError:
+        abort(400, description="Invalid since/until value.")
+    students = {x.strip() for x in request.args.get('students', '').split(',') if x.strip()}
 
-    def sort_url(field):
-        new_order = 'asc' if (sort_by != field or order == 'desc') else 'desc'
-        return f"/dashboard?sort={field}&order={new_order}"
+    try:
+        archive = export_archive(submission_index(), channel, since, until, students)
+    except ValueError as e:
+        abort(413, description=str(e))
+    if archive is None:
+        abort(404, description="No submissions match this export.")
 
-    html = """
+    response = Response(mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{channel}.zip"'
+    response.accept_ranges = 'bytes'
+    response.set_etag(archive.etag)
+
+    if request.if_none_match.contains(archive.etag):
+        response.status_code = 304
+        return response
+
+    start, stop = 0, archive.size
+    if_range = request.if_range
+    # a date-based If-Range can't be checked against a generated archive: send it all
+    range_valid = (if_range.etag is None and if_range.date is None) or if_range.etag == archive.etag
+    if request.range and range_valid:
+        byte_range = request.range.range_for_length(archive.size)
+        if byte_range is None:
+            response.status_code = 416
+            response.content_range = ContentRange('bytes', None, None, archive.size)
+            return response
+        start, stop = byte_range
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, archive.size)
+
+    response.response = archive.iter_bytes(start, stop)
+    response.content_length = stop - start
+    return response
+
+
+def record_json(record):
+    """JSON-friendly view of an index record, as used by the API and the live page."""
+    return {
+        'validation': validation_queue().status(record['sha256']),
+        'grading': {k: v for k, v in grading_status(record['teacher'], record['sha256']).items() if k != 'result'},
+        'sha256': record['sha256'],
+        'seq': record['seq'],
+        'deleted': record['deleted'],
+        'timestamp': record['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+        'surname': record['surname'],
+        'name': record['name'],
+        'student_id': record['student_id'],
+        'teacher': record['teacher'],
+        'filename': record['filename'],
+        'size': record['size'],
+        'download_path': record['download_path']
+    }
+
+
+@app.route('/api/grading/<channel>/<sha256>')
+def api_grading(channel, sha256):
+    """Build and test result of a submitted content with its channel's recipe (outputs included), or its status."""
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        abort(404)
+    return jsonify(grading_status(channel, sha256))
+
+
+@app.route('/api/validation/<sha256>')
+def api_validation(sha256):
+    """Validation result of a submitted content, or its status while it is pending."""
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        abort(404)
+    queue = validation_queue()
+    return jsonify(queue.result(sha256) or queue.status(sha256))
+
+
+def similarity_threshold():
+    threshold = request.args.get('threshold', 0.5, type=float)
+    return min(max(threshold, 0.0), 1.0)
+
+
+@app.route('/api/similarity')
+def api_similarity():
+    """Pairs of submissions with an estimated similarity of at least ?threshold= (0-1, default 0.5)."""
+    threshold = similarity_threshold()
+    similarity = similarity_index()
+    return jsonify(threshold=threshold, pending=similarity.pending, pairs=[
+        {'similarity': round(score, 3), 'a': record_json(a), 'b': record_json(b)}
+        for score, a, b in similarity.pairs(threshold)
+    ])
+
+
+# Pairs of similar submissions (similarity_report())
+SIMILARITY_TEMPLATE = app.jinja_env.from_string("""
+    <!DOCTYPE html>
+    <html>
+    <head>
+      <title>Similarity - SCE-UNINA Dashboard</title>
+      <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+    </head>
+    <body class="bg-light">
+      <div class="container mt-5">
+        <h1 class="mb-4">Similar submissions</h1>
+        <form class="row g-2 align-items-center mb-3">
+          <div class="col-auto"><a href="{{ root }}/dashboard">&laquo; Dashboard</a></div>
+          <div class="col-auto"><label for="threshold" class="col-form-label">Minimum similarity</label></div>
+          <div class="col-auto">
+            <input id="threshold" name="threshold" type="number" min="0" max="1" step="0.05" value="{{ threshold }}" class="form-control form-control-sm">
+          </div>
+          <div class="col-auto"><button class="btn btn-sm btn-primary">Update</button></div>
+        </form>
+        {% if pending %}
+        <p class="text-muted">{{ pending }} submission(s) not analysed yet: reload in a moment.</p>
+        {% endif %}
+        {% if pairs %}
+        <table class="table table-striped table-bordered align-middle">
+          <thead class="table-dark">
+            <tr><th>Similarity</th><th>Submission</th><th>Submission</th></tr>
+          </thead>
+          <tbody>
+            {% for score, a, b in pairs %}
+            <tr>
+              <td>{{ '%.0f' % (score * 100) }}%</td>
+              {% for r in (a, b) %}
+              <td>
+                {{ r.surname }} {{ r.name }} ({{ r.student_id }}), {{ r.teacher }}
+                <a href="{{ root }}/browse/{{ r.download_path }}" class="btn btn-sm btn-outline-primary ms-2">Browse</a>
+              </td>
+              {% endfor %}
+            </tr>
+            {% endfor %}
+          </tbody>
+        </table>
+        {% else %}
+        <p class="text-muted">No pair of submissions above this similarity.</p>
+        {% endif %}
+      </div>
+    </body>
+    </html>
+    """)
+
+
+@app.route('/similarity')
+def similarity_report():
+    """Similar submissions across all channels, most similar first."""
+    threshold = similarity_threshold()
+    similarity = similarity_index()
+    pairs = similarity.pairs(threshold)
+
+    return SIMILARITY_TEMPLATE.render(root=request.script_root, pairs=pairs, threshold=threshold,
+                                      pending=similarity.pending)
+
+
+@app.route('/api/submissions')
+def api_submissions():
+    """Current submissions as JSON, with the same sort/order/page parameters as the dashboard."""
+    sort_by = request.args.get('sort', 'timestamp')
+    order = request.args.get('order', 'desc')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', PAGE_SIZE, type=int), 1), 1000)
+
+    index = submission_index()
+    version = index.version()
+    return jsonify(
+        version=version,
+        total=index.count(),
+        page=page,
+        per_page=per_page,
+        records=[record_json(r) for r in index.query(sort_by, order, limit=per_page, offset=(page - 1) * per_page)]
+    )
+
+
+@app.route('/api/changes')
+def api_changes():
+    """
+    Long-poll for changes: returns the submissions added, replaced or removed
+    after ?since=<cursor>, waiting up to ?timeout= seconds (max 60) for at least one.
+    """
+    since = request.args.get('since', 0, type=int)
+    timeout = min(max(request.args.get('timeout', 25, type=float), 0), 60)
+
+    index = submission_index()
+    deadline = time.monotonic() + timeout
+    changes = index.changes(since)
+    while not changes and time.monotonic() < deadline:
+        time.sleep(LIVE_POLL_INTERVAL)
+        changes = index.changes(since)
+
+    cursor = changes[-1]['seq'] if changes else since
+    return jsonify(cursor=cursor, changes=[record_json(r) for r in changes])
+
+
+@app.route('/api/events')
+def api_events():
+    """
+    Server-Sent Events feed of submission changes after ?since=<cursor> (or the
+    Last-Event-ID header on reconnect). Each event carries one changed record;
+    its id is the new cursor.
+    """
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+
+    index = submission_index()
+
+    def stream():
+        cursor = since
+        last_sent = time.monotonic()
+        yield 'retry: 3000\n\n'
+        while True:
+            changes = index.changes(cursor)
+            for record in changes:
+                cursor = record['seq']
+                yield f"id: {cursor}\nevent: submission\ndata: {json.dumps(record_json(record))}\n\n"
+            now = time.monotonic()
+            if changes:
+                last_sent = now
+            elif now - last_sent >= LIVE_KEEPALIVE:
+                last_sent = now
+                yield ': keep-alive\n\n'
+            time.sleep(LIVE_POLL_INTERVAL)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Badge class and label of each validation status
+VALIDATION_BADGES = {
+    'ok': ('bg-success', 'OK'),
+    'warning': ('bg-warning text-dark', 'Warning'),
+    'error': ('bg-danger', 'Error'),
+    'pending': ('bg-secondary', 'Checking...'),
+    'unknown': ('bg-light text-dark', '-'),
+}
+
+# Badge class and label of each build and test outcome
+GRADING_BADGES = {
+    'passed': ('bg-success', 'Passed'),
+    'built': ('bg-success', 'Built'),
+    'test-failed': ('bg-warning text-dark', 'Tests failed'),
+    'build-failed': ('bg-danger', 'Build failed'),
+    'timeout': ('bg-danger', 'Timeout'),
+    'skipped': ('bg-light text-dark', 'Skipped'),
+    'error': ('bg-danger', 'Error'),
+    'pending': ('bg-secondary', 'Building...'),
+    'unknown': ('bg-light text-dark', '-'),
+}
+
+
+# Compiled once: rendering the dashboard must not re-parse it on every refresh
+DASHBOARD_TEMPLATE = app.jinja_env.from_string("""
     <!DOCTYPE html>
     <html>
     <head>
       <title>SCE-UNINA Dashboard</title>
-      <meta http-equiv="refresh" content="5">
+      <noscript><meta http-equiv="refresh" content="5"></noscript>
       <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
       <style>
         th a {
@@ -84,13 +687,28 @@ def dashboard():
         th a:hover {
           text-decoration: underline;
         }
+        .validation { cursor: help; }
+        tr.updated td {
+          animation: flash 2s;
+        }
+        @keyframes flash {
+          from { background-color: #fff3cd; }
+        }
       </style>
     </head>
     <body class="bg-light">
       <div class="container mt-5">
         <h1 class="mb-4">Uploaded Exam Projects</h1>
-        {% if records %}
-        <table class="table table-striped table-bordered align-middle">
+        <p>{% if session %}Session <strong>{{ session }}</strong> &middot; {% endif %}<a href="{{ root }}/similarity">Similarity report</a></p>
+        {% if channels %}
+        <div class="mb-3">
+          Download all:
+          {% for c in channels %}
+          <a href="{{ root }}/export/{{ c }}.zip" class="btn btn-sm btn-outline-secondary" download>{{ c }}</a>
+          {% endfor %}
+        </div>
+        {% endif %}
+        <table id="submissions" class="table table-striped table-bordered align-middle{% if not records %} d-none{% endif %}">
           <thead class="table-dark">
             <tr>
               <th><a href="{{ sort_url('timestamp') }}">Timestamp{% if sort_by == 'timestamp' %} {{ '↑' if order == 'asc' else '↓' }}{% endif %}</a></th>
@@ -98,37 +716,248 @@ def dashboard():
               <th><a href="{{ sort_url('name') }}">Name{% if sort_by == 'name' %} {{ '↑' if order == 'asc' else '↓' }}{% endif %}</a></th>
               <th><a href="{{ sort_url('student_id') }}">Student ID{% if sort_by == 'student_id' %} {{ '↑' if order == 'asc' else '↓' }}{% endif %}</a></th>
               <th><a href="{{ sort_url('teacher') }}">Teacher{% if sort_by == 'teacher' %} {{ '↑' if order == 'asc' else '↓' }}{% endif %}</a></th>
+              <th>Status</th>
+              <th>Build/Test</th>
               <th>Download</th>
             </tr>
           </thead>
           <tbody>
             {% for r in records %}
-            <tr>
+            {% set v = validation[r.sha256] %}
+            {% set g = grading[r.download_path] %}
+            <tr data-key="{{ r.download_path }}" data-teacher="{{ r.teacher }}" data-sha256="{{ r.sha256 or '' }}" data-validation="{{ v.status }}" data-grading="{{ g.status }}">
               <td>{{ r.timestamp.strftime('%Y-%m-%d %H:%M:%S') }}</td>
               <td>{{ r.surname }}</td>
               <td>{{ r.name }}</td>
               <td>{{ r.student_id }}</td>
               <td>{{ r.teacher }}</td>
-              <td><a href="/uploads/{{ r.download_path }}" class="btn btn-sm btn-primary" download>Download</a></td>
+              <td><span class="badge validation {{ badges[v.status][0] }}" title="{{ v.problems|join('\\n') }}">{{ badges[v.status][1] }}</span></td>
+              <td>{% if g.result %}<a href="{{ root }}/api/grading/{{ r.teacher }}/{{ r.sha256 }}">{% endif %}<span class="badge validation {{ grading_badges[g.status][0] }}" title="{{ g.problems|join('\\n') }}">{{ grading_badges[g.status][1] }}</span>{% if g.result %}</a>{% endif %}</td>
+              <td>
+                <a href="{{ root }}/uploads/{{ r.download_path }}" class="btn btn-sm btn-primary" download>Download</a>
+                <a href="{{ root }}/browse/{{ r.download_path }}" class="btn btn-sm btn-outline-primary">Browse</a>
+              </td>
             </tr>
             {% endfor %}
           </tbody>
         </table>
-        {% else %}
-          <p class="text-muted">No ZIP files uploaded yet.</p>
+        {% if pages > 1 %}
+        <nav>
+          <ul class="pagination">
+            <li class="page-item{% if page == 1 %} disabled{% endif %}"><a class="page-link" href="{{ page_url(page - 1) }}">&laquo;</a></li>
+            <li class="page-item disabled"><span class="page-link">Page {{ page }} of {{ pages }} ({{ total }} projects)</span></li>
+            <li class="page-item{% if page == pages %} disabled{% endif %}"><a class="page-link" href="{{ page_url(page + 1) }}">&raquo;</a></li>
+          </ul>
+        </nav>
         {% endif %}
+        <p id="empty" class="text-muted{% if records %} d-none{% endif %}">No ZIP files uploaded yet.</p>
       </div>
+      <script>
+        // Live updates: apply submission changes pushed by /api/events to the table in place
+        (function () {
+          const root = {{ root|tojson }};
+          const sortBy = {{ sort_by|tojson }}, order = {{ order|tojson }}, firstPage = {{ (page == 1)|tojson }};
+          const fields = ['timestamp', 'surname', 'name', 'student_id', 'teacher'];
+          const badges = {{ badges|tojson }}, gradingBadges = {{ grading_badges|tojson }};
+          const table = document.getElementById('submissions'), body = table.tBodies[0];
+          const empty = document.getElementById('empty');
+
+          function findRow(key) {
+            return Array.from(body.rows).find(row => row.dataset.key === key);
+          }
+
+          function fillValidation(row, v) {
+            row.dataset.validation = v.status;
+            const badge = document.createElement('span');
+            badge.className = 'badge validation ' + badges[v.status][0];
+            badge.title = v.problems.join('\\n');
+            badge.textContent = badges[v.status][1];
+            row.cells[fields.length].replaceChildren(badge);
+          }
+
+          function fillGrading(row, g) {
+            row.dataset.grading = g.status;
+            const badge = document.createElement('span');
+            badge.className = 'badge validation ' + gradingBadges[g.status][0];
+            badge.title = g.problems.join('\\n');
+            badge.textContent = gradingBadges[g.status][1];
+            let content = badge;
+            if (g.status !== 'pending' && g.status !== 'unknown') {
+              content = document.createElement('a');
+              content.href = root + '/api/grading/' + row.dataset.teacher + '/' + row.dataset.sha256;
+              content.append(badge);
+            }
+            row.cells[fields.length + 1].replaceChildren(content);
+          }
+
+          function fillRow(row, r) {
+            row.dataset.key = r.download_path;
+            row.dataset.teacher = r.teacher;
+            row.dataset.sha256 = r.sha256 || '';
+            row.innerHTML = '';
+            fields.forEach(field => row.insertCell().textContent = r[field]);
+            row.insertCell();
+            fillValidation(row, r.validation);
+            row.insertCell();
+            fillGrading(row, r.grading);
+            const link = document.createElement('a');
+            link.href = root + '/uploads/' + r.download_path;
+            link.className = 'btn btn-sm btn-primary';
+            link.setAttribute('download', '');
+            link.textContent = 'Download';
+            const browse = document.createElement('a');
+            browse.href = root + '/browse/' + r.download_path;
+            browse.className = 'btn btn-sm btn-outline-primary';
+            browse.textContent = 'Browse';
+            const actions = row.insertCell();
+            actions.append(link, ' ', browse);
+            row.classList.remove('updated');
+            void row.offsetWidth;
+            row.classList.add('updated');
+          }
+
+          function sortValue(row) {
+            const value = row.cells[fields.indexOf(sortBy)].textContent;
+            return sortBy === 'timestamp' ? value : value.toLowerCase();
+          }
+
+          function place(row) {
+            const value = sortValue(row);
+            const before = Array.from(body.rows).find(other => other !== row &&
+              (order === 'asc' ? sortValue(other) > value : sortValue(other) < value));
+            body.insertBefore(row, before || null);
+          }
+
+          function apply(r) {
+            let row = findRow(r.download_path);
+            if (r.deleted) {
+              if (row) row.remove();
+            } else if (row) {
+              fillRow(row, r);
+              place(row);
+            } else if (firstPage) {
+              row = document.createElement('tr');
+              fillRow(row, r);
+              place(row);
+            }
+            const hasRows = body.rows.length > 0;
+            table.classList.toggle('d-none', !hasRows);
+            empty.classList.toggle('d-none', hasRows);
+          }
+
+          // validation and grading run in the background: refresh the rows still waiting for them
+          setInterval(() => {
+            Array.from(body.rows).filter(row => row.dataset.validation === 'pending').forEach(row =>
+              fetch(root + '/api/validation/' + row.dataset.sha256)
+                .then(response => response.json())
+                .then(v => { if (v.status !== 'pending') fillValidation(row, v); })
+                .catch(() => {}));
+            Array.from(body.rows).filter(row => row.dataset.grading === 'pending').forEach(row =>
+              fetch(root + '/api/grading/' + row.dataset.teacher + '/' + row.dataset.sha256)
+                .then(response => response.json())
+                .then(g => { if (g.status !== 'pending') fillGrading(row, g); })
+                .catch(() => {}));
+          }, 5000);
+
+          if (!window.EventSource) {
+            setTimeout(() => location.reload(), 5000);
+            return;
+          }
+          const events = new EventSource(root + '/api/events?since={{ version }}');
+          events.addEventListener('submission', e => apply(JSON.parse(e.data)));
+        })();
+      </script>
     </body>
     </html>
-    """
+    """)
+
+
+# Rendered dashboard pages kept per (sort, order, page), least recently used dropped first
+DASHBOARD_CACHE_SIZE = 64
+
+RenderedPage = namedtuple('RenderedPage', 'version waiting grading etag body')
+
+_dashboard_cache = OrderedDict()
+_dashboard_lock = threading.Lock()
+
+
+def dashboard_response(rendered):
+    """The rendered page, or a 304 with no body if the browser already has it."""
+    response = Response(rendered.body, mimetype='text/html')
+    response.set_etag(rendered.etag)
+    # always revalidate: an unchanged page then costs a 304, a changed one is never stale
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/dashboard')
+def dashboard():
+    sort_by = request.args.get('sort', 'timestamp')
+    order = request.args.get('order', 'desc')
+
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    index = submission_index()
+    queue = validation_queue()
+    # read the cursor first: changes racing with the query are replayed, not lost
+    version = index.version()
+
+    key = (request.script_root, index.upload_folder, sort_by, order, page)
+    with _dashboard_lock:
+        cached = _dashboard_cache.get(key)
+        if cached is not None:
+            _dashboard_cache.move_to_end(key)
+    if (cached is not None and cached.version == version
+            and all(queue.status(sha256)['status'] == status for sha256, status in cached.waiting)
+            and all(grading_status(channel, sha256)['status'] == status for channel, sha256, status in cached.grading)):
+        return dashboard_response(cached)
 
-    return render_template_string(
-        html,
+    total = index.count()
+    pages = max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+    page = min(page, pages)
+    records = index.query(sort_by, order, limit=PAGE_SIZE, offset=(page - 1) * PAGE_SIZE)
+    statuses = {r['sha256']: queue.status(r['sha256']) for r in records}
+    grading = {r['download_path']: grading_status(r['teacher'], r['sha256']) for r in records}
+
+    def sort_url(field):
+        new_order = 'asc' if (sort_by != field or order == 'desc') else 'desc'
+        return f"{request.script_root}/dashboard?sort={field}&order={new_order}"
+
+    channels = index.channels()
+
+    def page_url(number):
+        return f"{request.script_root}/dashboard?sort={sort_by}&order={order}&page={number}"
+
+    body = DASHBOARD_TEMPLATE.render(
+        root=request.script_root,
         records=records,
         sort_by=sort_by,
         order=order,
-        sort_url=sort_url
+        sort_url=sort_url,
+        page=page,
+        pages=pages,
+        total=total,
+        page_url=page_url,
+        version=version,
+        channels=channels,
+        session=os.path.basename(index.upload_folder) if index.upload_folder != UPLOAD_FOLDER else None,
+        validation=statuses,
+        grading=grading,
+        badges=VALIDATION_BADGES,
+        grading_badges=GRADING_BADGES
     )
+    # statuses that can still change without a new submission: the page is stale once they do
+    waiting = tuple((sha256, v['status']) for sha256, v in statuses.items()
+                    if sha256 and v['status'] in ('pending', 'unknown'))
+    # and so can the builds this process is running (results from sce_unina_grading.py show up on the next change)
+    grading_waiting = tuple((r['teacher'], r['sha256'], 'pending') for r in records
+                            if grading[r['download_path']]['status'] == 'pending')
+    rendered = RenderedPage(version, waiting, grading_waiting, hashlib.sha256(body.encode()).hexdigest(), body)
+    with _dashboard_lock:
+        _dashboard_cache[key] = rendered
+        while len(_dashboard_cache) > DASHBOARD_CACHE_SIZE:
+            _dashboard_cache.popitem(last=False)
+    return dashboard_response(rendered)
 
 
 if __name__ == '__main__':
@@ -136,7 +965,71 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='SCE-Unina Dashboard Server')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host IP address')
     parser.add_argument('--port', type=int, default=5002, help='Port number')
+    parser.add_argument('--upload-folder', type=str, default=UPLOAD_FOLDER, help='Folder where the upload server stores files')
+    parser.add_argument('--session', type=str, default=SESSION,
+                        help='Exam session to show (default: the one the upload server is using)')
+    parser.add_argument('--storage', type=str, default=None,
+                        help='Object store the upload servers commit to, s3://bucket/prefix[?endpoint_url=URL] (default: the upload folder)')
+    parser.add_argument('--slow-request-threshold', type=float, default=2.0, help='Log requests taking longer than this many seconds')
+    parser.add_argument('--file-delivery', choices=FILE_DELIVERY_MODES, default=FILE_SENDER.mode,
+                        help="How downloads are sent: 'sendfile' from the page cache, or headers for a front proxy (nginx, Apache)")
+    parser.add_argument('--accel-prefix', type=str, default=FILE_SENDER.accel_prefix,
+                        help='Internal nginx location serving absolute paths (x-accel-redirect mode)')
+    parser.add_argument('--validate-workers', type=int, default=VALIDATE_WORKERS,
+                        help='Processes validating new submissions in the background (0 = none)')
+    parser.add_argument('--recipes', type=str, default=None,
+                        help='JSON file with the build and test recipe of each channel (see sce_unina_grading.py)')
+    parser.add_argument('--grade-workers', type=int, default=GRADE_WORKERS,
+                        help='Processes building and testing new submissions in the background (0 = none)')
+    parser.add_argument('--similarity-workers', type=int, default=SIMILARITY_WORKERS,
+                        help='Processes signing new submissions for the similarity report in the background (0 = none)')
+
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help='Write all submissions of a channel to a single zip and exit')
+    export_parser.add_argument('channel', help='Channel (teacher) to export')
+    export_parser.add_argument('-o', '--output', type=str, help='Output file (default: <channel>.zip, - for stdout)')
+    export_parser.add_argument('--since', type=str, help='Only submissions at or after this time (ISO format)')
+    export_parser.add_argument('--until', type=str, help='Only submissions at or before this time (ISO format)')
+    export_parser.add_argument('--students', type=str, default='', help='Comma-separated student IDs to include')
 
     args = parser.parse_args()
+    UPLOAD_FOLDER = args.upload_folder
+    SESSION = args.session
+    if SESSION is not None and not sessions.valid_session_name(SESSION):
+        parser.error(f"Invalid session name: {SESSION}")
+    if args.storage:
+        try:
+            STORAGE = open_storage(args.storage)
+        except (ValueError, RuntimeError) as e:
+            parser.error(str(e))
+    if args.recipes is not None:
+        try:
+            RECIPES = load_recipes(args.recipes)
+        except ValueError as e:
+            parser.error(str(e))
+    METRICS.slow_threshold = args.slow_request_threshold
+    VALIDATE_WORKERS = args.validate_workers
+    GRADE_WORKERS = args.grade_workers
+    SIMILARITY_WORKERS = args.similarity_workers
+    FILE_SENDER = FileSender(args.file_delivery, args.accel_prefix)
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+    if args.command == 'export':
+        index, _ = open_index(session_folder())
+        index.sync_teacher(args.channel)
+        students = {x.strip() for x in args.students.split(',') if x.strip()}
+        archive = export_archive(index, args.channel, parse_time_filter(args.since),
+                                 parse_time_filter(args.until), students)
+        if archive is None:
+            sys.exit(f"No submissions to export for channel '{args.channel}'")
+
+        output = args.output or f"{args.channel}.zip"
+        if output == '-':
+            archive.write_to(sys.stdout.buffer)
+        else:
+            with open(output, 'wb') as f:
+                archive.write_to(f)
+            print(f"Exported {len(archive.entries)} submissions ({archive.size} bytes) to {output}")
+        sys.exit(0)
 
     app.run(host=args.host, port=args.port, threaded=True, debug=True)
@@ -0,0 +1,274 @@
+"""
+Durability of accepted submissions.
+
+A rename is atomic but not durable: until the data and the directory entries
+reach the disk, a power cut can lose a submission the student was told had
+been received. The upload server can be run in one of three modes:
+
+- 'none':  leave it to the OS (writes reach the disk within ~30 s);
+- 'file':  fsync every new blob, its directory and the journal before
+           answering, one upload at a time;
+- 'group': hand them to a committer thread that waits a few milliseconds for
+           other uploads, fsyncs each distinct file and directory of the batch
+           once and then releases all of them: at the deadline, when hundreds
+           of uploads arrive together, the disk sees a few flushes per batch
+           instead of a few per upload.
+
+In the last two modes every accepted submission is first appended to a
+journal in the session folder (.journal.<pid>.jsonl, one per server process),
+which is durable together with the blob before the response goes out. The
+rest (the channel link, the version log, the index) is derived state: it
+isn't flushed per upload, and replay_journal() in sce_unina_server.py redoes
+whatever of it a crash lost when the server starts again. Every
+CHECKPOINT_INTERVAL seconds each process waits for its commits in progress,
+sets its journal aside, flushes everything with sync() and deletes it: a
+restart only replays the submissions of the last few seconds.
+"""
+
+import os
+import json
+import time
+import secrets
+import threading
+from contextlib import contextmanager
+
+MODES = ('none', 'file', 'group')
+
+# Journals are named .journal.<pid>.jsonl; one set aside by a checkpoint gets a .<token>.checkpoint suffix
+JOURNAL_PREFIX = '.journal'
+
+# How long the group committer waits for more uploads before flushing a batch
+GROUP_COMMIT_INTERVAL = 0.005
+
+# How often a process retires its journal, once the derived state it protects is on disk
+CHECKPOINT_INTERVAL = 30.0
+
+
+def fsync_path(path):
+    """fsync a file or directory by path (directories can't be opened on Windows: skipped there)."""
+    if os.name == 'nt' and os.path.isdir(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """Append-only log of the submissions accepted by this process in one session folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, f'{JOURNAL_PREFIX}.{os.getpid()}.jsonl')
+
+    def append(self, sha256, channel, filename, size):
+        line = json.dumps({'time': time.time(), 'sha256': sha256, 'channel': channel,
+                           'filename': filename, 'size': size}) + '\n'
+        # a single O_APPEND write: concurrent threads never interleave lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def set_aside(self):
+        """Move the journal out of the way of new appends; returns its new path, None if there was none."""
+        aside = f'{self.path}.{secrets.token_hex(4)}.checkpoint'
+        try:
+            os.rename(self.path, aside)
+        except FileNotFoundError:
+            return None
+        return aside
+
+    @staticmethod
+    def paths(folder):
+        """Every journal in `folder`: of any process, live or set aside."""
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(folder, name) for name in sorted(names) if name.startswith(JOURNAL_PREFIX + '.')]
+
+    @classmethod
+    def entries(cls, folder):
+        """Journaled submissions of `folder`, oldest first; a line torn by a crash is skipped."""
+        result = []
+        for path in cls.paths(folder):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            result.append(json.loads(line))
+                        except ValueError:
+                            continue
+            except FileNotFoundError:
+                pass
+        result.sort(key=lambda entry: entry.get('time', 0))
+        return result
+
+    @classmethod
+    def truncate(cls, folder):
+        for path in cls.paths(folder):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class Checkpointer(threading.Thread):
+    """Daemon thread retiring the journals of this process once what they record is on disk."""
+
+    def __init__(self, interval=CHECKPOINT_INTERVAL):
+        super().__init__(daemon=True, name='sce-unina-checkpoint')
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._active = 0
+        self._holding = False
+        self._journals = {}     # path -> Journal appended to since the last checkpoint
+
+    @contextmanager
+    def commit(self, journal):
+        """Wrap a commit from its journal line to its last piece of derived state."""
+        with self._cond:
+            while self._holding:
+                self._cond.wait()
+            self._active += 1
+            self._journals[journal.path] = journal
+        try:
+            yield journal
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def checkpoint(self):
+        with self._cond:
+            if not self._journals:
+                return
+            # no commit may be half done when the journal is set aside: hold new ones back until then
+            self._holding = True
+            try:
+                while self._active:
+                    self._cond.wait()
+                aside = [journal.set_aside() for journal in self._journals.values()]
+                self._journals.clear()
+            finally:
+                self._holding = False
+                self._cond.notify_all()
+        os.sync()
+        for path in aside:
+            if path is not None:
+                os.unlink(path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.checkpoint()
+            except OSError:
+                # the journals stay: the next checkpoint, or a restart, takes care of them
+                continue
+
+
+class _Waiter:
+    __slots__ = ('paths', 'done', 'error')
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitter(threading.Thread):
+    """Daemon thread flushing the files and directories of every upload that arrived in the last `interval` seconds."""
+
+    def __init__(self, interval=GROUP_COMMIT_INTERVAL):
+        super().__init__(daemon=True, name='sce-unina-group-commit')
+        self.interval = interval
+        self._pending = []
+        self._cond = threading.Condition()
+
+    def sync(self, paths):
+        waiter = _Waiter(paths)
+        with self._cond:
+            self._pending.append(waiter)
+            self._cond.notify()
+        waiter.done.wait()
+        if waiter.error is not None:
+            raise waiter.error
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self.interval)
+            with self._cond:
+                batch, self._pending = self._pending, []
+
+            # every waiter is released only after the whole batch: the flush order doesn't matter
+            paths = list(dict.fromkeys(p for w in batch for p in w.paths))
+            failed = {}
+            for path in paths:
+                try:
+                    fsync_path(path)
+                except OSError as e:
+                    failed[path] = e
+            for waiter in batch:
+                waiter.error = next((failed[p] for p in waiter.paths if p in failed), None)
+                waiter.done.set()
+
+
+class Durability:
+    """How (and whether) commit_submission() waits for accepted submissions to be on disk."""
+
+    def __init__(self, mode='none', interval=GROUP_COMMIT_INTERVAL, checkpoint_interval=CHECKPOINT_INTERVAL):
+        if mode not in MODES:
+            raise ValueError(f"Unknown durability mode: {mode}")
+        self.mode = mode
+        self.interval = interval
+        self.checkpoint_interval = checkpoint_interval
+        self._committer = None
+        self._checkpointer = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.mode != 'none'
+
+    def _threads(self):
+        # one committer and checkpointer per process: prefork workers start their own after the fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._committer = GroupCommitter(self.interval) if self.mode == 'group' else None
+                self._checkpointer = Checkpointer(self.checkpoint_interval)
+                if self._committer is not None:
+                    self._committer.start()
+                if hasattr(os, 'sync'):
+                    # elsewhere the journals are only retired by the next startup
+                    self._checkpointer.start()
+                self._pid = os.getpid()
+            return self._committer, self._checkpointer
+
+    @contextmanager
+    def commit(self, folder):
+        """
+        Wrap a commit to session `folder`: yields the Journal to append it to
+        (None when disabled), kept until everything the commit derives from it
+        has been written.
+        """
+        if not self.enabled:
+            yield None
+            return
+        with self._threads()[1].commit(Journal(folder)) as journal:
+            yield journal
+
+    def sync(self, paths):
+        """Return once every file and directory in `paths` is on disk; raises OSError otherwise."""
+        if self.mode == 'file':
+            for path in paths:
+                fsync_path(path)
+        elif self.mode == 'group':
+            self._threads()[0].sync(paths)
@@ -0,0 +1,199 @@
+"""
+Streaming zip export of submissions.
+
+ZipStream builds a zip archive of files on disk on the fly, without staging
+anything: entries are STORED (submissions are already zips, re-compressing
+them is wasted CPU) and each entry's CRC-32 goes in a data descriptor written
+after its bytes, so every file is read exactly once while it is sent. Since
+the layout only depends on names and sizes, the total length is known before
+the first byte is sent and any byte range can be regenerated, which is what
+lets an interrupted download resume. Files can also be objects of a storage
+backend (sce_unina_storage.py), read with ranged GETs.
+"""
+
+import hashlib
+import os
+import struct
+import threading
+import time
+import zlib
+
+READ_SIZE = 256 * 1024
+
+# Zip64 is not implemented: exports are limited to the classic zip format
+MAX_ARCHIVE_SIZE = 0xFFFFFFFF
+MAX_ENTRIES = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+
+# general purpose flags: 0x08 = sizes/CRC in data descriptor, 0x800 = UTF-8 names
+_FLAGS = 0x0808
+
+# CRC-32 of already streamed files, keyed by (path, size, mtime_ns), so that
+# resumed downloads don't have to re-read the part of the archive they skip
+_crc_cache = {}
+_crc_lock = threading.Lock()
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class _Entry:
+    def __init__(self, arcname, path, storage=None):
+        self.arcname = arcname
+        self.name = arcname.encode('utf-8')
+        self.path = path
+        self.storage = storage
+        if storage is None:
+            st = os.stat(path)
+            self.size, self.mtime_ns, mtime = st.st_size, st.st_mtime_ns, st.st_mtime
+        else:
+            info = storage.stat(path)
+            self.size, self.mtime_ns, mtime = info.size, int(info.mtime * 1e9), info.mtime
+            self.etag = info.etag
+        self.dos_time, self.dos_date = _dos_datetime(mtime)
+        self.offset = 0
+
+    @property
+    def key(self):
+        return (self.path, self.size, self.mtime_ns)
+
+    def local_header(self):
+        return _LOCAL_HEADER.pack(0x04034b50, 20, _FLAGS, 0, self.dos_time, self.dos_date,
+                                  0, 0, 0, len(self.name), 0) + self.name
+
+    def crc(self):
+        with _crc_lock:
+            crc = _crc_cache.get(self.key)
+        if crc is None:
+            crc = 0
+            with self.open() as f:
+                for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+            self._remember(crc)
+        return crc
+
+    def _remember(self, crc):
+        with _crc_lock:
+            if len(_crc_cache) > 100000:
+                _crc_cache.clear()
+            _crc_cache[self.key] = crc
+
+    def open(self):
+        if self.storage is not None:
+            f = self.storage.open(self.path)
+            if self.storage.stat(self.path).etag != self.etag:
+                f.close()
+                raise RuntimeError(f"{self.path} changed while being exported")
+            return f
+        f = open(self.path, 'rb')
+        st = os.fstat(f.fileno())
+        if (st.st_size, st.st_mtime_ns) != (self.size, self.mtime_ns):
+            f.close()
+            raise RuntimeError(f"{self.path} changed while being exported")
+        return f
+
+    def data_descriptor(self):
+        return _DATA_DESCRIPTOR.pack(0x08074b50, self.crc(), self.size, self.size)
+
+    def central_header(self):
+        return _CENTRAL_HEADER.pack(0x02014b50, 20, 20, _FLAGS, 0, self.dos_time, self.dos_date,
+                                    self.crc(), self.size, self.size, len(self.name), 0, 0, 0, 0,
+                                    0o100644 << 16, self.offset) + self.name
+
+
+class ZipStream:
+    """
+    A STORED zip archive of `files` ((arcname, path) pairs, paths being keys
+    of `storage` if given), generated lazily.
+
+    `size` is the exact archive length and `etag` identifies its content
+    (names, sizes and mtimes of the members); iter_bytes(start, stop) yields
+    any byte range of it.
+    """
+
+    def __init__(self, files, storage=None):
+        self.entries = [_Entry(arcname, path, storage) for arcname, path in sorted(files)]
+        if len(self.entries) > MAX_ENTRIES:
+            raise ValueError("Too many files for a single export")
+
+        # (length, producer) segments; producer(offset, length) yields bytes
+        self._segments = []
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            header = entry.local_header()
+            self._add_bytes(header)
+            self._segments.append((entry.size, self._file_producer(entry)))
+            self._segments.append((_DATA_DESCRIPTOR.size, self._lazy_producer(entry.data_descriptor)))
+            offset += len(header) + entry.size + _DATA_DESCRIPTOR.size
+
+        self._central_offset = offset
+        self._central_size = sum(_CENTRAL_HEADER.size + len(e.name) for e in self.entries)
+        self._segments.append((self._central_size, self._lazy_producer(self._central_directory)))
+        self._segments.append((_END_RECORD.size, self._lazy_producer(self._end_record)))
+        self.size = offset + self._central_size + _END_RECORD.size
+        if self.size > MAX_ARCHIVE_SIZE:
+            raise ValueError("Export too large for a single zip, narrow the selection")
+
+        manifest = '\n'.join(f"{e.arcname}\0{e.size}\0{e.mtime_ns}" for e in self.entries)
+        self.etag = hashlib.sha256(manifest.encode('utf-8')).hexdigest()
+
+    def _add_bytes(self, data):
+        self._segments.append((len(data), lambda offset, length: iter([data[offset:offset + length]])))
+
+    @staticmethod
+    def _lazy_producer(build):
+        return lambda offset, length: iter([build()[offset:offset + length]])
+
+    @staticmethod
+    def _file_producer(entry):
+        def produce(offset, length):
+            # only a full, front-to-back read can feed the CRC
+            crc = 0 if offset == 0 and length == entry.size else None
+            with entry.open() as f:
+                f.seek(offset)
+                remaining = length
+                while remaining:
+                    chunk = f.read(min(READ_SIZE, remaining))
+                    if not chunk:
+                        raise RuntimeError(f"{entry.path} shrank while being exported")
+                    if crc is not None:
+                        crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    yield chunk
+            if crc is not None:
+                entry._remember(crc)
+        return produce
+
+    def _central_directory(self):
+        return b''.join(e.central_header() for e in self.entries)
+
+    def _end_record(self):
+        count = len(self.entries)
+        return _END_RECORD.pack(0x06054b50, 0, 0, count, count, self._central_size, self._central_offset, 0)
+
+    def iter_bytes(self, start=0, stop=None):
+        """Yield the archive bytes in [start, stop)."""
+        stop = self.size if stop is None else min(stop, self.size)
+        position = 0
+        for length, produce in self._segments:
+            segment_end = position + length
+            if segment_end > start and position < stop:
+                offset = max(start - position, 0)
+                yield from produce(offset, min(segment_end, stop) - position - offset)
+            position = segment_end
+            if position >= stop:
+                break
+
+    def write_to(self, f):
+        for chunk in self.iter_bytes():
+            f.write(chunk)
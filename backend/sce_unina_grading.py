@@ -0,0 +1,433 @@
+#! /usr/bin/env python3
+"""
+Build and test committed submissions, in parallel and cached by content.
+
+A recipe says how the projects of a channel are graded: a `build` and an
+optional `test` shell command, run in the unpacked submission, with limits.
+Recipes are read from a JSON file keyed by channel ("*" for the others):
+
+    {
+      "Tramontana": {"build": "make", "test": "make test", "timeout": 60},
+      "*": {"build": "auto"}
+    }
+
+"auto" (the default for channels without a recipe) picks the build from the
+files in each archive: `make` if there is a Makefile, otherwise gcc, g++,
+javac or compileall for the C, C++, Java and Python sources the DEUS form
+accepts; MATLAB projects are skipped.
+
+Every submission is graded in a worker of a bounded process pool: the
+archive is unpacked (within the validation's zip bomb limits) in a temporary
+folder, and each command runs in its own process group with a clean
+environment, CPU time, memory and file size limits, and is killed with all
+its children after `timeout` seconds. That contains runaway or broken
+projects; it is not a security sandbox, so run the grader as an unprivileged
+user (or in a container) for code you don't trust.
+
+Results go to <upload folder>/.grading/results/<aa>/<sha256>.<recipe id>.json:
+an unchanged resubmission is never rebuilt, and editing a channel's recipe
+grades its submissions again. The dashboard grades new submissions in the
+background with --grade-workers and shows the outcome per row; a whole
+session can also be graded at once:
+
+    python sce_unina_grading.py --upload-folder uploads --recipes recipes.json
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import signal
+import zipfile
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:
+    # Windows: commands still get the timeout, not the CPU and memory limits
+    resource = None
+
+from sce_unina_blobs import BlobStore
+from sce_unina_index import SubmissionIndex
+from sce_unina_sessions import session_folder
+from sce_unina_validation import MAX_MEMBERS, MAX_UNCOMPRESSED_SIZE
+
+log = logging.getLogger(__name__)
+
+GRADING_DIR = '.grading'
+
+# Limits of every command of a recipe, unless the recipe sets its own
+DEFAULT_RECIPE = {
+    'build': 'auto',
+    'test': None,
+    'timeout': 120,     # wall clock seconds
+    'cpu': 60,          # CPU seconds
+    'memory': 2048,     # MB of address space (the JVM reserves a lot of it)
+}
+
+# Output of a command kept in the result (its tail), and the largest file it may write
+OUTPUT_LIMIT = 16 * 1024
+MAX_FILE_SIZE = 256 * 1024 * 1024
+
+# Final outcomes; anything else means "not graded (yet)"
+STATUSES = ('passed', 'built', 'test-failed', 'build-failed', 'timeout', 'skipped', 'error')
+
+# How long a shared GradingResults trusts that a submission hasn't been graded before looking again
+MISS_TTL = 30.0
+
+
+def load_recipes(path=None):
+    """The recipes in the JSON file at `path` (none: "auto" for every channel); raises ValueError if malformed."""
+    recipes = {}
+    if path is not None:
+        try:
+            with open(path) as f:
+                recipes = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Can't read recipes from {path}: {e}") from e
+        if not isinstance(recipes, dict):
+            raise ValueError(f"{path} must map channel names to recipes")
+    return Recipes(recipes)
+
+
+class Recipes:
+    """Recipe (with defaults filled in) and recipe id of each channel."""
+
+    def __init__(self, recipes=None):
+        self._recipes = {}
+        for channel, recipe in (recipes or {}).items():
+            if not isinstance(recipe, dict):
+                raise ValueError(f"Recipe of {channel} must be an object")
+            unknown = recipe.keys() - DEFAULT_RECIPE.keys()
+            if unknown:
+                raise ValueError(f"Unknown recipe keys for {channel}: {', '.join(sorted(unknown))}")
+            for key in ('build', 'test'):
+                if recipe.get(key) is not None and not isinstance(recipe[key], str):
+                    raise ValueError(f"{key} of {channel} must be a command")
+            for key in ('timeout', 'cpu', 'memory'):
+                if key in recipe and (not isinstance(recipe[key], (int, float)) or recipe[key] <= 0):
+                    raise ValueError(f"{key} of {channel} must be a positive number")
+            self._recipes[channel] = {**DEFAULT_RECIPE, **recipe}
+        self._default = self._recipes.pop('*', dict(DEFAULT_RECIPE))
+
+    @staticmethod
+    def recipe_id(recipe):
+        return hashlib.sha256(json.dumps(recipe, sort_keys=True).encode()).hexdigest()[:12]
+
+    def for_channel(self, channel):
+        recipe = self._recipes.get(channel, self._default)
+        return self.recipe_id(recipe), recipe
+
+
+def _unpack(path, storage, dest):
+    with storage.open(path) as source, zipfile.ZipFile(source) as zf:
+        infos = zf.infolist()
+        if len(infos) > MAX_MEMBERS or sum(i.file_size for i in infos) > MAX_UNCOMPRESSED_SIZE:
+            raise ValueError("Archive too large to be unpacked")
+        for info in infos:
+            parts = info.filename.replace('\\', '/').split('/')
+            if info.filename.startswith('/') or '..' in parts:
+                continue
+            zf.extract(info, dest)
+
+
+def guess_build(root):
+    """The build command for the sources under `root`, None if there's nothing to build."""
+    files = []
+    for folder, dirs, names in os.walk(root):
+        dirs.sort()
+        files.extend(os.path.relpath(os.path.join(folder, n), root) for n in sorted(names))
+    makefiles = [f for f in files if os.path.basename(f).lower() in ('makefile', 'gnumakefile')
+                 or f.lower().endswith('.makefile')]
+    if makefiles:
+        makefile = min(makefiles, key=lambda f: f.count(os.sep))
+        return f"make -C {shlex.quote(os.path.dirname(makefile) or '.')} -f {shlex.quote(os.path.basename(makefile))}"
+
+    def sources(ext):
+        return ' '.join(shlex.quote(f) for f in files if f.lower().endswith(ext))
+
+    if sources('.cpp'):
+        return f"g++ -o main {sources('.cpp')}"
+    if sources('.c'):
+        return f"gcc -o main {sources('.c')} -lm"
+    if sources('.java'):
+        # the JVM reserves much more address space than it uses: keep it within the memory limit
+        return f"javac -J-Xmx512m -J-XX:CompressedClassSpaceSize=128m -d .classes {sources('.java')}"
+    if sources('.py'):
+        return f"{shlex.quote(sys.executable)} -m compileall -q ."
+    return None
+
+
+def _limits(recipe):
+    def apply():
+        cpu = int(recipe['cpu'])
+        memory = int(recipe['memory']) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (MAX_FILE_SIZE, MAX_FILE_SIZE))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    return apply if resource is not None else None
+
+
+def run_command(command, cwd, recipe, home):
+    """Run one step of a recipe; returns its JSON-friendly outcome."""
+    env = {'PATH': os.environ.get('PATH', os.defpath), 'HOME': home, 'TMPDIR': home, 'LANG': 'C.UTF-8'}
+    output_path = os.path.join(home, 'output')
+    start = time.monotonic()
+    with open(output_path, 'wb') as output:
+        process = subprocess.Popen(command, shell=True, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                                   stdout=output, stderr=subprocess.STDOUT,
+                                   start_new_session=True, preexec_fn=_limits(recipe))
+        try:
+            code = process.wait(timeout=recipe['timeout'])
+            status = 'ok' if code == 0 else 'failed'
+        except subprocess.TimeoutExpired:
+            code = None
+            status = 'timeout'
+        finally:
+            # whatever it left running (background jobs, a hung test) goes too
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError, AttributeError):
+                process.kill()
+            process.wait()
+    with open(output_path, 'rb') as f:
+        f.seek(max(os.path.getsize(output_path) - OUTPUT_LIMIT, 0))
+        tail = f.read().decode('utf-8', errors='replace')
+    if resource is not None and code in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+        status = 'timeout'  # out of CPU time (seen directly, or through the shell)
+    return {'command': command, 'status': status, 'exit': code,
+            'seconds': round(time.monotonic() - start, 2), 'output': tail}
+
+
+def grade_zip(path, recipe, storage):
+    """
+    Build and test the submission at `path` (a key of `storage`) following
+    `recipe`; returns a JSON-friendly dict with 'status' (one of STATUSES) and
+    the outcome of each step. Runs in a worker process.
+    """
+    result = {'checked': time.time(), 'build': None, 'test': None}
+    with tempfile.TemporaryDirectory(prefix='sce-unina-grade-') as tmp:
+        project, home = os.path.join(tmp, 'project'), os.path.join(tmp, 'home')
+        os.makedirs(home)
+        try:
+            _unpack(path, storage, project)
+        except (zipfile.BadZipFile, OSError, ValueError) as e:
+            return {**result, 'status': 'error', 'problems': [f"Can't unpack the archive ({e})"]}
+        os.makedirs(project, exist_ok=True)
+
+        build = guess_build(project) if recipe['build'] == 'auto' else recipe['build']
+        if build is None and recipe['test'] is None:
+            return {**result, 'status': 'skipped', 'problems': ["Nothing to build"]}
+        if build is not None:
+            result['build'] = run_command(build, project, recipe, home)
+            if result['build']['status'] != 'ok':
+                timeout = result['build']['status'] == 'timeout'
+                return {**result, 'status': 'timeout' if timeout else 'build-failed', 'problems': []}
+        if recipe['test'] is None:
+            return {**result, 'status': 'built', 'problems': []}
+        result['test'] = run_command(recipe['test'], project, recipe, home)
+        status = {'ok': 'passed', 'timeout': 'timeout'}.get(result['test']['status'], 'test-failed')
+        return {**result, 'status': status, 'problems': []}
+
+
+class GradingResults:
+    """
+    Grading results of one upload folder, by content and recipe. An
+    `exclusive` instance (the only process grading the folder, see
+    ValidationQueue) reads them all once and never looks at the disk again;
+    a shared one reads each result once, and looks for a missing one at most
+    every MISS_TTL seconds.
+    """
+
+    def __init__(self, upload_folder, exclusive=False):
+        self.upload_folder = upload_folder
+        self.results_dir = os.path.join(upload_folder, GRADING_DIR, 'results')
+        self.exclusive = exclusive
+        self._results = {}      # (sha256, recipe id) -> result
+        self._misses = {}       # (sha256, recipe id) -> when it was last found missing
+        if exclusive:
+            self._load()
+
+    def result_path(self, sha256, recipe_id):
+        return os.path.join(self.results_dir, sha256[:2], f'{sha256}.{recipe_id}.json')
+
+    def _load(self):
+        try:
+            prefixes = os.listdir(self.results_dir)
+        except FileNotFoundError:
+            return
+        for prefix in prefixes:
+            for name in os.listdir(os.path.join(self.results_dir, prefix)):
+                sha256, _, rest = name.partition('.')
+                if rest.endswith('.json'):
+                    self._read(sha256, rest[:-len('.json')])
+
+    def _read(self, sha256, recipe_id):
+        try:
+            with open(self.result_path(sha256, recipe_id)) as f:
+                result = self._results[(sha256, recipe_id)] = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def result(self, sha256, recipe_id):
+        """The grading result of `sha256` with recipe `recipe_id`, or None if it hasn't been graded (yet)."""
+        key = (sha256, recipe_id)
+        result = self._results.get(key)
+        if result is None and not self.exclusive:
+            now = time.monotonic()
+            if now - self._misses.get(key, -MISS_TTL) < MISS_TTL:
+                return None
+            result = self._read(sha256, recipe_id)
+            if result is None:
+                self._misses[key] = now
+        return result
+
+    def store(self, sha256, recipe_id, result):
+        path = self.result_path(sha256, recipe_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp, path)
+        self._results[(sha256, recipe_id)] = result
+
+
+def ungraded(records, results, recipes):
+    """(sha256, recipe id, recipe, record) of every submission in `records` still to be graded, each content once."""
+    seen = set()
+    for record in records:
+        sha256 = record['sha256']
+        if not sha256:
+            continue    # copied by hand, not committed: it has no blob
+        recipe_id, recipe = recipes.for_channel(record['teacher'])
+        if (sha256, recipe_id) in seen or results.result(sha256, recipe_id) is not None:
+            continue
+        seen.add((sha256, recipe_id))
+        yield sha256, recipe_id, recipe, record
+
+
+class Grader(threading.Thread):
+    """Daemon thread grading the submissions of a SubmissionIndex as they arrive, `workers` at a time."""
+
+    def __init__(self, index, results, recipes, workers=2, interval=2.0, blobs=None):
+        super().__init__(daemon=True, name='sce-unina-grader')
+        self.index = index
+        self.results = results
+        self.recipes = recipes
+        self.workers = workers
+        self.interval = interval
+        self.blobs = blobs or BlobStore(index.upload_folder)
+        self._slots = threading.BoundedSemaphore(workers)
+        self._running = set()   # (sha256, recipe id) being graded, shared with the done callbacks
+        self._running_lock = threading.Lock()
+        self._pool = None
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        while not self._stopping.is_set():
+            try:
+                self.dispatch()
+            except Exception:
+                log.exception("grading dispatch failed")
+            self._stopping.wait(self.interval)
+        self._pool.shutdown(wait=False)
+
+    def dispatch(self):
+        # oldest first: the order students handed in
+        for sha256, recipe_id, recipe, _ in ungraded(self.index.query('timestamp', 'asc'), self.results, self.recipes):
+            with self._running_lock:
+                if (sha256, recipe_id) in self._running:
+                    continue
+            if not self._slots.acquire(blocking=False):
+                return
+            storage, key = self.blobs.locate(sha256)
+            if not storage.exists(key):
+                self._slots.release()
+                continue
+            with self._running_lock:
+                self._running.add((sha256, recipe_id))
+            try:
+                future = self._pool.submit(grade_zip, key, recipe, storage)
+            except BrokenProcessPool:
+                # a worker died and took the pool with it: only this thread replaces it
+                self._pool.shutdown(wait=False)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                future = self._pool.submit(grade_zip, key, recipe, storage)
+            future.add_done_callback(lambda f, job=(sha256, recipe_id): self._done(job, f))
+
+    def _done(self, job, future):
+        try:
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                result = {'checked': time.time(), 'status': 'error', 'problems': [f"Grading crashed ({e})"]}
+            except Exception as e:
+                result = {'checked': time.time(), 'status': 'error', 'problems': [f"Grading failed ({e})"]}
+            self.results.store(*job, result)
+        except OSError:
+            log.exception("could not store the grading result of %s", job[0])
+        finally:
+            with self._running_lock:
+                self._running.discard(job)
+            self._slots.release()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCE-Unina build and test runner')
+    parser.add_argument('--upload-folder', type=str, default='uploads', help='Folder where the upload server stores files')
+    parser.add_argument('--session', type=str, default=None, help='Exam session (default: the active one)')
+    parser.add_argument('--recipes', type=str, default=None, help='JSON file with the build and test recipe of each channel')
+    parser.add_argument('--channel', type=str, default=None, help='Only grade this channel')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Submissions graded at the same time')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        recipes = load_recipes(args.recipes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    folder = session_folder(args.upload_folder, args.session)
+    index = SubmissionIndex(folder)
+    index.rebuild()
+    results = GradingResults(folder)
+    blobs = BlobStore(folder)
+    records = index.query('timestamp', 'asc', teacher=args.channel)
+    jobs = list(ungraded(records, results, recipes))
+    print(f"{len(records)} submissions, {len(jobs)} contents to grade (the rest are graded already, duplicates or not committed)")
+
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for sha256, recipe_id, recipe, record in jobs:
+            storage, key = blobs.locate(sha256)
+            futures[pool.submit(grade_zip, key, recipe, storage)] = (sha256, recipe_id, record)
+        for future in as_completed(futures):
+            sha256, recipe_id, record = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'checked': time.time(), 'status': 'error', 'problems': [f"Grading failed ({e})"]}
+            results.store(sha256, recipe_id, result)
+            print(f"{record['teacher']}/{record['filename']}: {result['status']}")
+
+    counts = {}
+    for record in records:
+        if record['sha256']:
+            result = results.result(record['sha256'], recipes.for_channel(record['teacher'])[0])
+            status = result['status'] if result else 'not graded'
+            counts[status] = counts.get(status, 0) + 1
+    print(f"Done in {time.monotonic() - start:.1f} s: " + ', '.join(f"{n} {s}" for s, n in sorted(counts.items())))
@@ -0,0 +1,436 @@
+"""
+Persistent index of the submissions stored under the upload folder.
+
+The index is a SQLite database (<upload folder>/.index.sqlite3, WAL mode) so
+that the upload server and the dashboard, which run as separate processes,
+can share it. The upload server records every file it commits; an
+IndexWatcher catches files added, replaced or removed by hand. The dashboard
+then sorts and paginates in SQL instead of walking the whole uploads/ tree.
+
+Every change gets a new, monotonically increasing `seq`, and removed files are
+kept as tombstones (deleted = 1), so readers can ask what changed since a
+given point.
+
+When the upload server and the dashboard run in the same process
+(sce_unina_unified.py), they share a SubmissionRegistry instead: the same
+index, also kept in memory, so that the dashboard's reads never touch the
+disk.
+"""
+
+import bisect
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from sce_unina_sessions import channel_dirs, submission_path
+
+INDEX_FILENAME = '.index.sqlite3'
+
+# Columns the dashboard may sort on, mapped to SQL expressions
+SORT_COLUMNS = {
+    'timestamp': 'mtime',
+    'surname': 'surname COLLATE NOCASE',
+    'name': 'name COLLATE NOCASE',
+    'student_id': 'student_id COLLATE NOCASE',
+    'teacher': 'teacher COLLATE NOCASE',
+}
+
+# The same orderings, on records held in memory (NOCASE only folds ASCII)
+_ASCII_FOLD = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+SORT_KEYS = {
+    'timestamp': lambda r: r['timestamp'],
+    'surname': lambda r: r['surname'].translate(_ASCII_FOLD),
+    'name': lambda r: r['name'].translate(_ASCII_FOLD),
+    'student_id': lambda r: r['student_id'].translate(_ASCII_FOLD),
+    'teacher': lambda r: r['teacher'].translate(_ASCII_FOLD),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    teacher    TEXT NOT NULL,
+    filename   TEXT NOT NULL,
+    surname    TEXT NOT NULL,
+    name       TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    mtime      REAL NOT NULL,
+    size       INTEGER NOT NULL,
+    sha256     TEXT,
+    seq        INTEGER NOT NULL,
+    deleted    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (teacher, filename)
+);
+CREATE INDEX IF NOT EXISTS submissions_seq ON submissions (seq);
+CREATE INDEX IF NOT EXISTS submissions_mtime ON submissions (deleted, mtime);
+"""
+
+log = logging.getLogger(__name__)
+
+
+def parse_submission_name(filename):
+    """
+    Split SURNAME_NAME_STUDENTID_*.zip into (surname, name, student_id).
+
+    Returns None for files that are not zips or do not follow the format.
+    """
+    if not filename.endswith('.zip'):
+        return None
+
+    parts = filename[:-4].split('_')
+    if len(parts) < 3:
+        return None
+
+    return parts[0], parts[1], parts[2]
+
+
+def _row_to_record(row):
+    return {
+        'timestamp': datetime.datetime.fromtimestamp(row['mtime']),
+        'surname': row['surname'],
+        'name': row['name'],
+        'student_id': row['student_id'],
+        'teacher': row['teacher'],
+        'filename': row['filename'],
+        'size': row['size'],
+        'sha256': row['sha256'],
+        'seq': row['seq'],
+        'deleted': bool(row['deleted']),
+        'download_path': f"{row['teacher']}/{row['filename']}"
+    }
+
+
+class SubmissionIndex:
+    """
+    SQLite-backed submission index for one upload folder.
+
+    With submissions in an object store, `remote` is the session's
+    ObjectBlobStore: the index (still a file in `upload_folder`) is built by
+    listing the store, and `discovered` is called with the SHA-256 of every
+    new or changed submission found there.
+    """
+
+    def __init__(self, upload_folder, remote=None, discovered=None):
+        self.upload_folder = upload_folder
+        self.path = os.path.join(upload_folder, INDEX_FILENAME)
+        self.remote = remote
+        self.discovered = discovered
+        self._local = threading.local()
+
+    def _conn(self):
+        # sqlite3 connections must not cross threads or fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(self.upload_folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _write(self, statements):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM submissions').fetchone()[0]
+            for sql, params in statements:
+                seq += 1
+                conn.execute(sql, params + (seq,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _upsert(teacher, filename, mtime, size, sha256):
+        parsed = parse_submission_name(filename)
+        if parsed is None:
+            return None
+        surname, name, student_id = parsed
+        return ("""
+            INSERT INTO submissions (teacher, filename, surname, name, student_id, mtime, size, sha256, seq, deleted)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+            ON CONFLICT (teacher, filename) DO UPDATE SET
+                mtime = excluded.mtime, size = excluded.size, sha256 = excluded.sha256,
+                seq = excluded.seq, deleted = 0
+        """, (teacher, filename, surname, name, student_id, mtime, size, sha256))
+
+    @staticmethod
+    def _tombstone(teacher, filename):
+        # seq is appended as the last parameter by _write()
+        return ("UPDATE submissions SET deleted = 1, seq = ?3 WHERE teacher = ?1 AND filename = ?2 AND deleted = 0",
+                (teacher, filename))
+
+    def record(self, teacher, filename, mtime, size, sha256=None):
+        """Add or update one submission (called by the upload server after each commit)."""
+        statement = self._upsert(teacher, filename, mtime, size, sha256)
+        if statement is not None:
+            self._write([statement])
+
+    def remove(self, teacher, filename):
+        self._write([self._tombstone(teacher, filename)])
+
+    def sync_teacher(self, teacher):
+        """Reconcile the index with the content of uploads/<teacher>/ (and its fan-out folders)."""
+        if self.remote is not None:
+            return self._sync_remote(teacher)
+        on_disk = {}
+        for path in channel_dirs(self.upload_folder, teacher):
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.name.endswith('.zip') and entry.is_file():
+                            st = entry.stat()
+                            on_disk[entry.name] = (st.st_mtime, st.st_size)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+        indexed = {
+            row['filename']: (row['mtime'], row['size'])
+            for row in self._conn().execute(
+                'SELECT filename, mtime, size FROM submissions WHERE teacher = ? AND deleted = 0', (teacher,))
+        }
+
+        statements = []
+        for filename, (mtime, size) in on_disk.items():
+            if indexed.get(filename) != (mtime, size):
+                statement = self._upsert(teacher, filename, mtime, size, None)
+                if statement is not None:
+                    statements.append(statement)
+        for filename in indexed.keys() - on_disk.keys():
+            statements.append(self._tombstone(teacher, filename))
+
+        if statements:
+            self._write(statements)
+
+    def _sync_remote(self, teacher):
+        prefix = self.remote.submission_key(teacher, '')
+        stored = {info.key[len(prefix):]: info for info in self.remote.storage.list(prefix)
+                  if info.key.endswith('.zip')}
+        indexed = {
+            row['filename']: (row['mtime'], row['size'])
+            for row in self._conn().execute(
+                'SELECT filename, mtime, size FROM submissions WHERE teacher = ? AND deleted = 0', (teacher,))
+        }
+
+        statements, found = [], []
+        for filename, info in stored.items():
+            if indexed.get(filename) != (info.mtime, info.size):
+                # listings don't carry metadata: one HEAD per new or replaced object
+                try:
+                    sha256 = self.remote.storage.stat(info.key).sha256
+                except FileNotFoundError:
+                    continue
+                statement = self._upsert(teacher, filename, info.mtime, info.size, sha256)
+                if statement is not None:
+                    statements.append(statement)
+                    if sha256:
+                        found.append(sha256)
+        for filename in indexed.keys() - stored.keys():
+            statements.append(self._tombstone(teacher, filename))
+
+        if statements:
+            self._write(statements)
+        if self.discovered is not None:
+            for sha256 in found:
+                self.discovered(sha256)
+
+    def file_path(self, teacher, filename):
+        """Location of a submission on disk (its key, in an object store)."""
+        if self.remote is not None:
+            return self.remote.submission_key(teacher, filename)
+        return submission_path(self.upload_folder, teacher, filename)
+
+    def teachers(self):
+        """Teacher folders currently present on disk."""
+        if self.remote is not None:
+            return [p for p in self.remote.storage.prefixes(self.remote.session + '/') if not p.startswith('.')]
+        try:
+            with os.scandir(self.upload_folder) as it:
+                return [e.name for e in it if not e.name.startswith('.') and e.is_dir()]
+        except FileNotFoundError:
+            return []
+
+    def rebuild(self):
+        """Full rescan of the upload folder."""
+        present = set(self.teachers())
+        indexed = {row[0] for row in self._conn().execute(
+            'SELECT DISTINCT teacher FROM submissions WHERE deleted = 0')}
+        for teacher in present | indexed:
+            self.sync_teacher(teacher)
+
+    def query(self, sort_by='timestamp', order='desc', limit=None, offset=0, teacher=None):
+        """One page of current submissions (optionally of one teacher), sorted server-side."""
+        column = SORT_COLUMNS.get(sort_by, SORT_COLUMNS['timestamp'])
+        direction = 'ASC' if order == 'asc' else 'DESC'
+        where, params = 'deleted = 0', ()
+        if teacher is not None:
+            where, params = 'deleted = 0 AND teacher = ?', (teacher,)
+        sql = f'SELECT * FROM submissions WHERE {where} ORDER BY {column} {direction}, teacher, filename'
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params += (limit, offset)
+        return [_row_to_record(row) for row in self._conn().execute(sql, params)]
+
+    def changes(self, since, limit=500):
+        """Submissions added, replaced or removed after sequence number `since`, oldest first."""
+        rows = self._conn().execute(
+            'SELECT * FROM submissions WHERE seq > ? ORDER BY seq LIMIT ?', (since, limit))
+        return [_row_to_record(row) for row in rows]
+
+    def channels(self):
+        """Teachers with at least one current submission."""
+        return [row[0] for row in self._conn().execute(
+            'SELECT DISTINCT teacher FROM submissions WHERE deleted = 0 ORDER BY teacher COLLATE NOCASE')]
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM submissions WHERE deleted = 0').fetchone()[0]
+
+    def version(self):
+        """Sequence number of the latest change; changes whenever the submission set does."""
+        return self._conn().execute('SELECT COALESCE(MAX(seq), 0) FROM submissions').fetchone()[0]
+
+
+class SubmissionRegistry(SubmissionIndex):
+    """
+    A SubmissionIndex also held in memory, for a single process serving both
+    uploads and the dashboard. Every write still goes to SQLite first (the
+    seq numbers, the tombstones and restarts work as before) and is then
+    applied in memory; queries, changes and counts are answered from memory.
+
+    Writes made by other processes are picked up whenever this one writes or
+    rebuilds (the IndexWatcher does every minute).
+    """
+
+    def __init__(self, upload_folder, remote=None, discovered=None):
+        super().__init__(upload_folder, remote, discovered)
+        self._lock = threading.Lock()
+        self._records = {}      # (teacher, filename) -> record, tombstones included
+        self._log = []          # records in seq order; superseded ones are skipped
+        self._seqs = []
+        self._sorted = {}       # (sort_by, order, teacher) -> current records, in that order
+        self._version = 0
+        self._pull()
+
+    def _pull(self):
+        """Apply what changed in SQLite since the last pull."""
+        with self._lock:
+            while True:
+                records = SubmissionIndex.changes(self, self._version)
+                for record in records:
+                    self._records[(record['teacher'], record['filename'])] = record
+                    self._log.append(record)
+                    self._seqs.append(record['seq'])
+                    self._version = record['seq']
+                if not records:
+                    break
+                self._sorted = {}
+            if len(self._log) > 2 * len(self._records) + 1000:
+                self._log = sorted(self._records.values(), key=lambda r: r['seq'])
+                self._seqs = [r['seq'] for r in self._log]
+
+    def _write(self, statements):
+        super()._write(statements)
+        self._pull()
+
+    def rebuild(self):
+        super().rebuild()
+        self._pull()
+
+    def query(self, sort_by='timestamp', order='desc', limit=None, offset=0, teacher=None):
+        key = (sort_by if sort_by in SORT_KEYS else 'timestamp', order == 'asc', teacher)
+        with self._lock:
+            records = self._sorted.get(key)
+            if records is None:
+                records = sorted((r for r in self._records.values()
+                                  if not r['deleted'] and (teacher is None or r['teacher'] == teacher)),
+                                 key=lambda r: (r['teacher'], r['filename']))
+                # stable: ties stay in (teacher, filename) order, as in SQL
+                records.sort(key=SORT_KEYS[key[0]], reverse=not key[1])
+                self._sorted[key] = records
+        if limit is None:
+            return records[offset:]
+        return records[offset:offset + limit]
+
+    def changes(self, since, limit=500):
+        with self._lock:
+            result = []
+            for record in self._log[bisect.bisect_right(self._seqs, since):]:
+                if self._records[(record['teacher'], record['filename'])] is record:
+                    result.append(record)
+                    if len(result) == limit:
+                        break
+            return result
+
+    def channels(self):
+        return sorted({r['teacher'] for r in self.query()}, key=lambda t: t.translate(_ASCII_FOLD))
+
+    def count(self):
+        return len(self.query())
+
+    def version(self):
+        return self._version
+
+
+class IndexWatcher(threading.Thread):
+    """
+    Keeps a SubmissionIndex in sync with files dropped into the upload folder by hand.
+
+    A portable, inotify-style poller: every `interval` seconds it only stats the
+    teacher directories (and their fan-out folders) and rescans those whose
+    mtime changed (a file was created, renamed or deleted in them). Every `full_scan_every` seconds it also
+    rescans everything, to catch files overwritten in place.
+    """
+
+    def __init__(self, index, interval=2.0, full_scan_every=60.0):
+        super().__init__(name='sce-unina-index-watcher', daemon=True)
+        self.index = index
+        self.interval = interval
+        self.full_scan_every = full_scan_every
+        self._seen = {}
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def poll(self, full=False):
+        if self.index.remote is not None:
+            # object stores have no directory mtimes: listing them is the cheapest check
+            self.index.rebuild()
+            return
+        if full:
+            self.index.rebuild()
+
+        current = {}
+        for teacher in self.index.teachers():
+            try:
+                current[teacher] = tuple(sorted(
+                    os.stat(path).st_mtime_ns
+                    for path in {os.path.join(self.index.upload_folder, teacher),
+                                 *channel_dirs(self.index.upload_folder, teacher)}))
+            except FileNotFoundError:
+                continue
+            if not full and self._seen.get(teacher) != current[teacher]:
+                self.index.sync_teacher(teacher)
+
+        if not full:
+            for teacher in self._seen.keys() - current.keys():
+                self.index.sync_teacher(teacher)
+        self._seen = current
+
+    def run(self):
+        last_full = 0.0
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            try:
+                full = now - last_full >= self.full_scan_every
+                self.poll(full=full)
+                if full:
+                    last_full = now
+            except (OSError, sqlite3.Error):
+                log.exception("submission index watcher failed")
+            self._stopping.wait(self.interval)
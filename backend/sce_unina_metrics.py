@@ -0,0 +1,299 @@
+"""
+Request metrics for the SCE-Unina Flask apps, exposed at /metrics in the
+Prometheus text format.
+
+Metrics(app_name).init_app(app) counts requests per route, method and status,
+tracks in-flight requests, request/response bytes and a latency histogram per
+route. Views can add per-stage timings (StageTimer) that feed a second
+histogram and the structured slow-request log: every request slower than
+`slow_threshold` seconds is logged as one JSON line on the 'sce_unina.slow'
+logger.
+
+When an app runs in several worker processes, set `shared_dir` to a directory
+common to all of them: each worker then publishes a snapshot of its counters
+there and /metrics reports their sum. Counters of recycled workers are kept,
+so totals never go backwards.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+slow_log = logging.getLogger('sce_unina.slow')
+
+# Counters of exited workers, summed, in the shared directory
+RETIRED = 'retired.json'
+
+_HELP = {
+    'sce_http_requests_total': ('counter', 'HTTP requests served.'),
+    'sce_http_requests_in_flight': ('gauge', 'HTTP requests currently being served.'),
+    'sce_http_request_bytes_total': ('counter', 'Request body bytes received.'),
+    'sce_http_response_bytes_total': ('counter', 'Response body bytes sent (when the length is known).'),
+    'sce_http_request_duration_seconds': ('histogram', 'Time from request start to the end of the response body.'),
+    'sce_stage_duration_seconds': ('histogram', 'Time spent in each stage of request handling.'),
+    'sce_admission_rejected_total': ('counter', 'Requests turned away by admission control.'),
+}
+
+
+class StageTimer:
+    """Accumulates wall-clock time per named stage: `with timer('write'): ...`."""
+
+    def __init__(self):
+        self.totals = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+class Metrics:
+    def __init__(self, app_name, slow_threshold=2.0, buckets=DEFAULT_BUCKETS, slow_exclude=(), shared_dir=None):
+        self.app_name = app_name
+        self.slow_threshold = slow_threshold
+        self.buckets = tuple(buckets)
+        self.slow_exclude = set(slow_exclude)
+        self.shared_dir = shared_dir
+        self._lock = threading.Lock()
+        self._values = {}       # (name, labels) -> float, for counters and gauges
+        self._histograms = {}   # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._dirty = False
+        self._publisher_pid = None
+
+    # -- recording -------------------------------------------------------
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            else:
+                h[len(self.buckets)] += 1
+            h[-1] += value
+
+    def record_stages(self, timer):
+        """Report a StageTimer of the current request (histogram + slow log)."""
+        route = self._route()
+        for stage, seconds in timer.totals.items():
+            self.observe('sce_stage_duration_seconds', (('app', self.app_name), ('route', route), ('stage', stage)), seconds)
+        stages = g.setdefault('_metrics_stages', {})
+        for stage, seconds in timer.totals.items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    # -- Flask integration -----------------------------------------------
+
+    @staticmethod
+    def _route():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    def init_app(self, app):
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def _before(self):
+        g._metrics_start = time.perf_counter()
+        self.inc('sce_http_requests_in_flight', (('app', self.app_name),))
+
+    def _after(self, response):
+        start = g.get('_metrics_start')
+        if start is None:
+            return response
+
+        route = self._route()
+        method = request.method
+        path = request.path
+        remote = request.remote_addr
+        received = request.content_length or 0
+        stages = g.get('_metrics_stages', {})
+
+        def finish():
+            duration = time.perf_counter() - start
+            sent = response.content_length or 0
+            app_label = ('app', self.app_name)
+            self.inc('sce_http_requests_in_flight', (app_label,), -1)
+            self.inc('sce_http_requests_total', (app_label, ('route', route), ('method', method),
+                                                 ('status', str(response.status_code))))
+            self.inc('sce_http_request_bytes_total', (app_label, ('route', route)), received)
+            self.inc('sce_http_response_bytes_total', (app_label, ('route', route)), sent)
+            self.observe('sce_http_request_duration_seconds', (app_label, ('route', route)), duration)
+
+            if duration >= self.slow_threshold and route not in self.slow_exclude:
+                slow_log.warning(json.dumps({
+                    'app': self.app_name, 'method': method, 'path': path, 'route': route,
+                    'status': response.status_code, 'duration_s': round(duration, 4),
+                    'stages_s': {k: round(v, 4) for k, v in stages.items()},
+                    'bytes_received': received, 'bytes_sent': sent, 'remote_addr': remote,
+                }))
+            self._maybe_publish()
+
+        # runs once the body has been sent, so streamed responses are timed fully;
+        # a passthrough body (send_file) would be handed to the server without it
+        response.direct_passthrough = False
+        response.call_on_close(finish)
+        return response
+
+    def view(self):
+        self._publish()
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    # -- multi-process aggregation ----------------------------------------
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                'values': [[name, labels, v] for (name, labels), v in self._values.items()],
+                'histograms': [[name, labels, list(h)] for (name, labels), h in self._histograms.items()],
+            }
+
+    def _maybe_publish(self):
+        """Mark the snapshot stale; a per-process thread publishes it within a second."""
+        if not self.shared_dir:
+            return
+        self._dirty = True
+        if self._publisher_pid != os.getpid():
+            self._publisher_pid = os.getpid()
+            threading.Thread(target=self._publish_loop, name='sce-unina-metrics', daemon=True).start()
+
+    def _publish_loop(self):
+        while True:
+            time.sleep(1.0)
+            if self._dirty:
+                self._publish()
+
+    def _publish(self):
+        if not self.shared_dir:
+            return
+        self._dirty = False
+        path = os.path.join(self.shared_dir, f'{os.getpid()}.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._snapshot(), f)
+        os.replace(tmp, path)
+
+    def _collect(self):
+        if not self.shared_dir:
+            return self._merge({}, {}, self._snapshot())
+
+        values, histograms = {}, {}
+        with open(os.path.join(self.shared_dir, '.lock'), 'w') as lock:
+            # one reader at a time folds the snapshots of exited workers into RETIRED
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired = self._load(RETIRED) or {'values': [], 'histograms': []}
+            retired_changed = False
+            for name in os.listdir(self.shared_dir):
+                if not name.endswith('.json') or name == RETIRED:
+                    continue
+                snapshot = self._load(name)
+                if snapshot is None:
+                    continue
+                if self._alive(int(name[:-5])):
+                    self._merge(values, histograms, snapshot)
+                    continue
+                # a recycled worker: keep its counters, drop its gauges
+                snapshot['values'] = [v for v in snapshot['values'] if _HELP[v[0]][0] != 'gauge']
+                retired = self._merge_snapshots(retired, snapshot)
+                retired_changed = True
+                os.unlink(os.path.join(self.shared_dir, name))
+            if retired_changed:
+                tmp = os.path.join(self.shared_dir, RETIRED + '.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump(retired, f)
+                os.replace(tmp, os.path.join(self.shared_dir, RETIRED))
+        return self._merge(values, histograms, retired)
+
+    def _load(self, name):
+        try:
+            with open(os.path.join(self.shared_dir, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _alive(pid):
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @staticmethod
+    def _merge(values, histograms, snapshot):
+        for n, l, v in snapshot['values']:
+            key = (n, tuple(map(tuple, l)))
+            values[key] = values.get(key, 0) + v
+        for n, l, h in snapshot['histograms']:
+            key = (n, tuple(map(tuple, l)))
+            total = histograms.setdefault(key, [0] * len(h))
+            for i, x in enumerate(h):
+                total[i] += x
+        return values, histograms
+
+    def _merge_snapshots(self, a, b):
+        values, histograms = self._merge(*self._merge({}, {}, a), b)
+        return {'values': [[n, l, v] for (n, l), v in values.items()],
+                'histograms': [[n, l, h] for (n, l), h in histograms.items()]}
+
+    # -- exposition --------------------------------------------------------
+
+    def render(self):
+        values, histograms = self._collect()
+        lines = []
+        for name, (kind, help_text) in _HELP.items():
+            series = ([(k, v) for k, v in values.items() if k[0] == name] if kind != 'histogram'
+                      else [(k, h) for k, h in histograms.items() if k[0] == name])
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (_, labels), data in sorted(series):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {data:g}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), data[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{name}_bucket{_labels(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {data[-1]:g}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
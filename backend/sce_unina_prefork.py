@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+"""
+Pre-forking production runner for the SCE-Unina Flask apps.
+
+The parent process binds a single listening socket and forks N workers that
+all accept() on it, each one running a threaded Werkzeug server with the
+debugger off. Workers are recycled after a configurable number of requests
+and respawned if they die. SIGTERM/SIGINT on the parent stops accepting new
+connections and lets in-flight requests (e.g. uploads) finish before exiting.
+
+POSIX only (relies on os.fork).
+"""
+
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from werkzeug.serving import ThreadedWSGIServer
+
+
+class _DrainingServer(ThreadedWSGIServer):
+    # Non-daemon request threads: server_close() joins them, so a stopping
+    # worker waits for in-flight requests instead of killing them.
+    daemon_threads = False
+    block_on_close = True
+
+
+def _run_worker(app, host, port, fd, max_requests):
+    server = _DrainingServer(host, port, app, fd=fd)
+    stopping = threading.Event()
+    served = 0
+    lock = threading.Lock()
+
+    def stop(*_):
+        if not stopping.is_set():
+            stopping.set()
+            # shutdown() blocks until serve_forever() returns, never call it
+            # from the serving thread itself
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def counting_app(environ, start_response):
+        nonlocal served
+        with lock:
+            served += 1
+            if max_requests and served >= max_requests:
+                stop()
+        return app(environ, start_response)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.app = counting_app
+    # serve_forever() always ends with server_close(), which drains requests
+    server.serve_forever()
+
+
+def serve(app, host='0.0.0.0', port=5001, workers=None, max_requests=1000, graceful_timeout=30.0):
+    """
+    Run `app` on host:port across `workers` pre-forked processes.
+
+    - workers: number of processes (default: one per CPU core).
+    - max_requests: recycle a worker after roughly this many requests (0 = never).
+      A small random jitter avoids recycling every worker at the same moment.
+    - graceful_timeout: seconds to wait for workers to drain on shutdown before
+      they are killed.
+    """
+    if not hasattr(os, 'fork'):
+        raise RuntimeError("prefork mode requires a POSIX system (os.fork)")
+
+    workers = workers or os.cpu_count() or 1
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=socket.SOMAXCONN)
+    fd = sock.fileno()
+
+    children = {}
+    stopping = False
+
+    def request_stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    def spawn():
+        limit = max_requests + random.randint(0, max_requests // 10) if max_requests else 0
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(app, host, port, fd, limit)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f" * Serving on http://{host}:{port} with {workers} worker processes (pid {os.getpid()})", file=sys.stderr)
+
+    try:
+        while not stopping:
+            while len(children) < workers and not stopping:
+                spawn()
+
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+
+            started = children.pop(pid, None)
+            # avoid a tight respawn loop if workers crash on startup
+            if started is not None and time.monotonic() - started < 1.0:
+                time.sleep(1.0)
+    finally:
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                children.pop(pid, None)
+
+        deadline = time.monotonic() + graceful_timeout
+        while children and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+        sock.close()
+        print(" * Server stopped.", file=sys.stderr)
@@ -0,0 +1,123 @@
+"""
+Delivery of files on disk (the exam, submissions) without pushing their bytes through Python.
+
+FileSender.send() builds the response for one file in the configured mode:
+
+- 'python': the worker reads the file and writes it out (the default);
+- 'sendfile': the worker only sends the headers, the body goes from the page
+  cache to the socket with sendfile(2), Range requests included;
+- 'x-accel-redirect': the response only carries an X-Accel-Redirect header
+  and nginx serves the file (and its ranges) from an internal location;
+- 'x-sendfile': the same with an X-Sendfile header, for Apache mod_xsendfile
+  or lighttpd.
+
+In the last three modes a worker busy with downloads only handles metadata,
+leaving the CPU to upload handling.
+"""
+
+import os
+import mimetypes
+from urllib.parse import quote
+
+from werkzeug.exceptions import NotFound
+from werkzeug.wrappers import Response
+
+MODES = ('python', 'sendfile', 'x-accel-redirect', 'x-sendfile')
+
+# Read size when the socket isn't available and the body is sent by the server
+READ_SIZE = 64 * 1024
+
+
+class FileBody:
+    """
+    WSGI body sending bytes [start, stop) of an open file.
+
+    Under Werkzeug's server the socket is in the environ: an empty first chunk
+    makes the server send the status line and headers, then the range goes out
+    with socket.sendfile() (which falls back to plain writes on TLS sockets).
+    Elsewhere the file is read in chunks like any other body.
+    """
+
+    def __init__(self, file, start, stop, sock=None):
+        self.file = file
+        self.start = start
+        self.stop = stop
+        self.sock = sock
+
+    def __iter__(self):
+        if self.sock is None:
+            self.file.seek(self.start)
+            remaining = self.stop - self.start
+            while remaining > 0:
+                data = self.file.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+            return
+
+        yield b''
+        if self.stop > self.start:
+            self.sock.sendfile(self.file, self.start, self.stop - self.start)
+
+    def close(self):
+        self.file.close()
+
+
+class FileSender:
+    def __init__(self, mode='python', accel_prefix='/_sce_files/'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown file delivery mode: {mode}")
+        self.mode = mode
+        self.accel_prefix = accel_prefix
+
+    @property
+    def offloaded(self):
+        """Whether file bodies bypass Python (the 'python' mode keeps each caller's own response)."""
+        return self.mode != 'python'
+
+    def send(self, req, path, mimetype=None, download_name=None):
+        """
+        Response for the file at `path` to the Werkzeug request `req`, as an
+        attachment named `download_name` if given. Raises NotFound if it isn't a file.
+        """
+        name = download_name or os.path.basename(path)
+        response = Response(mimetype=mimetype or mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        if download_name:
+            try:
+                download_name.encode('ascii')
+                response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+            except UnicodeEncodeError:
+                response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+
+        path = os.path.abspath(path)
+        if self.mode in ('x-accel-redirect', 'x-sendfile'):
+            if not os.path.isfile(path):
+                raise NotFound()
+            # the proxy handles conditional and Range requests itself
+            if self.mode == 'x-accel-redirect':
+                response.headers['X-Accel-Redirect'] = self.accel_prefix.rstrip('/') + quote(path)
+            else:
+                response.headers['X-Sendfile'] = path
+            return response
+
+        try:
+            f = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise NotFound()
+        try:
+            st = os.fstat(f.fileno())
+            response.content_length = st.st_size
+            response.last_modified = st.st_mtime
+            response.set_etag(f'{st.st_mtime_ns:x}-{st.st_size:x}-{st.st_ino:x}')
+            response = response.make_conditional(req, accept_ranges=True, complete_length=st.st_size)
+        except BaseException:
+            f.close()
+            raise
+
+        start, stop = 0, st.st_size
+        if response.status_code == 206:
+            start, stop = response.content_range.start, response.content_range.stop
+        socket = req.environ.get('werkzeug.socket') if self.mode == 'sendfile' else None
+        response.response = FileBody(f, start, stop, socket)
+        return response
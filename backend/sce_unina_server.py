@@ -1,17 +1,516 @@
 #! /usr/bin/env python3
 
-from flask import Flask, request, send_file, abort
+from flask import Flask, Response, request, abort, jsonify
+from collections import namedtuple
+from urllib.parse import quote
+import io
 import re
 import os
+import gzip
+import json
+import time
+import hashlib
+import secrets
+import tempfile
+import functools
+import threading
+import logging
+import sqlite3
 import argparse
 
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, File, Data, Epilogue
+
+from sce_unina_prefork import serve
+from sce_unina_index import SubmissionIndex
+from sce_unina_blobs import BlobStore
+from sce_unina_metrics import Metrics, StageTimer
+from sce_unina_admission import Admission, Overloaded
+from sce_unina_validation import ValidationQueue
+from sce_unina_sendfile import FileSender, MODES as FILE_DELIVERY_MODES
+from sce_unina_durability import Durability, Journal, MODES as DURABILITY_MODES
+from sce_unina_chunks import ManifestStore, chunk_digest, delta_plan, valid_manifest
+from sce_unina_storage import ObjectBlobStore, StorageError, open_storage, write_session
+import sce_unina_sessions as sessions
+
 app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+# Prometheus metrics at /metrics; requests slower than the threshold are logged on 'sce_unina.slow'
+METRICS = Metrics('sce_unina_server')
+METRICS.init_app(app)
 
 # Allowed file extensions for download
 ALLOWED_EXTENSIONS = {'.pdf', '.doc', '.docx', '.rtf', '.zip'}
 FILE_PATH = ''  # Will be set from argument
 
 UPLOAD_FOLDER = 'uploads'
+# Shared object store the submissions are committed to (--storage); None keeps them in UPLOAD_FOLDER
+STORAGE = None
+
+# Request bodies are read and written to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Uploads up to this size are kept in memory until committed: a re-upload of
+# content that is already stored then costs no disk write at all
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+# Default cap on the size of an upload request (overridable with --max-upload-size)
+app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024
+
+# Limits on concurrent uploads (overridable from the command line, per worker process)
+UPLOAD_ADMISSION = Admission()
+
+# Whether an upload is answered only once it is on disk (see sce_unina_durability.py)
+DURABILITY = Durability()
+
+# MIME types of the allowed exam formats
+EXAM_MIMETYPES = {
+    '.pdf': 'application/pdf',
+    '.doc': 'application/msword',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.rtf': 'application/rtf',
+    '.zip': 'application/zip'
+}
+
+ExamSnapshot = namedtuple('ExamSnapshot', 'path ext mimetype mtime mtime_ns size data gzipped etag disposition')
+
+
+class ExamCache:
+    """
+    Keeps the exam file in an immutable in-memory snapshot.
+
+    The snapshot holds the file bytes, a strong ETag (SHA-256 of the content),
+    the Content-Disposition header and, if enabled, a pre-gzipped copy. The file
+    is stat()ed at most once every `check_interval` seconds and re-read only when
+    its mtime or size changes; readers always see either the old or the new
+    snapshot, never a partially loaded one.
+    """
+
+    def __init__(self, check_interval=1.0, gzip_enabled=False):
+        self.check_interval = check_interval
+        self.gzip_enabled = gzip_enabled
+        self._snapshot = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return the current snapshot for `path`, or None if the file does not exist."""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.path == path and time.monotonic() - self._checked < self.check_interval:
+            return snapshot
+
+        with self._lock:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._snapshot = None
+                return None
+
+            snapshot = self._snapshot
+            if (snapshot is None or snapshot.path != path
+                    or snapshot.mtime_ns != st.st_mtime_ns or snapshot.size != st.st_size):
+                snapshot = self._load(path)
+                self._snapshot = snapshot
+            self._checked = time.monotonic()
+            return snapshot
+
+    def _load(self, path):
+        ext = os.path.splitext(path)[1].lower()
+        name = os.path.basename(path)
+        mimetype = EXAM_MIMETYPES.get(ext)
+
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            # don't bother reading files we are going to refuse anyway
+            data = f.read() if mimetype else b''
+
+        gzipped = gzip.compress(data, mtime=0) if self.gzip_enabled and data else None
+        try:
+            name.encode('ascii')
+            disposition = f'attachment; filename="{name}"'
+        except UnicodeEncodeError:
+            disposition = f"attachment; filename*=UTF-8''{quote(name)}"
+
+        return ExamSnapshot(
+            path=path,
+            ext=ext,
+            mimetype=mimetype,
+            mtime=st.st_mtime,
+            mtime_ns=st.st_mtime_ns,
+            size=st.st_size,
+            data=data,
+            gzipped=gzipped,
+            etag=hashlib.sha256(data).hexdigest(),
+            disposition=disposition
+        )
+
+
+EXAM_CACHE = ExamCache()
+
+# How the exam body is sent ('python' serves the in-memory snapshot, see sce_unina_sendfile.py)
+FILE_SENDER = FileSender()
+
+
+class UploadError(Exception):
+    """A client error in an upload request, carrying the message and HTTP status to return."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def parse_submission_filename(raw_filename):
+    """
+    Normalize an uploaded filename and extract its channel.
+
+    Expects SURNAME_NAME_STUDENTID_CHANNEL.zip and returns (filename, channel).
+    Raises UploadError if the name is empty or not a .zip.
+    """
+    if raw_filename == '':
+        raise UploadError("No selected file", 400)
+
+    if not raw_filename.endswith('.zip'):
+        raise UploadError("Only .zip files are allowed", 415)
+
+    # normalize filename and avoid path traversal
+    filename = os.path.basename(raw_filename)
+
+    # Attempt to parse channel from filename with expected format:
+    # SURNAME_NAME_STUDENTID_CHANNEL.zip
+    name_no_ext = os.path.splitext(filename)[0]
+    # Try splitting from the right to be resilient to extra underscores in names
+    parts = name_no_ext.rsplit('_', 2)
+    if len(parts) == 3:
+        # head, studentid, channel
+        _, studentid, channel_raw = parts
+    else:
+        # fallback: take last segment as channel
+        channel_raw = parts[-1]
+
+    # sanitize channel token
+    channel_candidate = re.sub(r'[^A-Za-z0-9_-]', '', channel_raw).strip()
+    if not channel_candidate:
+        channel_candidate = 'unknown'
+
+    # Basic mapping: use sanitized candidate as channel name (no fuzzy mapping)
+    return filename, channel_candidate
+
+
+def submission_path(channel, filename, stages=None):
+    """Final location of a submission, creating its channel (or fan-out) folder if needed."""
+    stages = stages or StageTimer()
+    path = sessions.submission_path(UPLOAD_FOLDER, channel, filename)
+    with stages('makedirs'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+_index = None
+
+# The dashboard's in-memory index and validation queue, when both run in one process (sce_unina_unified.py)
+SUBMISSIONS = None
+VALIDATION = None
+
+
+def submission_index():
+    """Submission index shared with the dashboard, opened on first use."""
+    global _index
+    if SUBMISSIONS is not None:
+        return SUBMISSIONS
+    if _index is None or _index.upload_folder != UPLOAD_FOLDER:
+        _index = SubmissionIndex(UPLOAD_FOLDER)
+    return _index
+
+
+def validation_queue():
+    if VALIDATION is not None:
+        return VALIDATION
+    return ValidationQueue(UPLOAD_FOLDER)
+
+
+def blob_store():
+    return BlobStore(UPLOAD_FOLDER)
+
+
+def submission_store():
+    """Where committed submissions and their versions are: the blob store, or the object store with --storage."""
+    if STORAGE is not None:
+        return ObjectBlobStore(STORAGE, os.path.basename(UPLOAD_FOLDER))
+    return blob_store()
+
+
+def commit_submission(source, channel, filename, sha256, size, stages=None):
+    """
+    Store a fully received submission and make it the current version of
+    uploads/<channel>/<filename>, then record it in the submission index.
+
+    This is the single commit point shared by every upload path. `source` is
+    either a temporary file on the upload folder's filesystem or the content
+    as bytes. The content goes to the blob store (deduplicated by SHA-256),
+    the channel path is atomically re-pointed at it, the version is logged
+    and the content is queued for background validation. Time spent in each
+    step is added to the `stages` StageTimer, if given. Returns the final path.
+
+    With DURABILITY enabled the submission is journaled, and the blob and the
+    journal are flushed to disk before anything else happens: once this
+    returns, a crash can't lose it (replay_journal() redoes the rest).
+    """
+    stages = stages or StageTimer()
+    if STORAGE is not None:
+        return commit_to_storage(source, channel, filename, sha256, size, stages)
+    store = blob_store()
+    # the journal line stays until a checkpoint finds all of this on disk
+    with DURABILITY.commit(UPLOAD_FOLDER) as journal:
+        with stages('store'):
+            blob, _ = store.put(source, sha256)
+        if journal is not None:
+            with stages('journal'):
+                journal.append(sha256, channel, filename, size)
+            with stages('fsync'):
+                # the blob's data and name (and its prefix folder's, if new), the journal line and its name
+                DURABILITY.sync([blob, journal.path, os.path.dirname(blob), store.root, UPLOAD_FOLDER])
+        path = submission_path(channel, filename, stages)
+        with stages('publish'):
+            store.publish(sha256, path)
+            store.record_version(channel, filename, sha256, size)
+
+        try:
+            with stages('index'):
+                submission_index().record(channel, filename, os.stat(path).st_mtime, size, sha256)
+        except sqlite3.Error:
+            # the dashboard's watcher will pick the file up anyway
+            log.exception("could not index %s", path)
+
+        try:
+            # only a job file: the checks themselves run in the background
+            with stages('enqueue'):
+                validation_queue().enqueue(sha256)
+        except OSError:
+            log.exception("could not queue %s for validation", path)
+
+    return path
+
+
+def replay_journal():
+    """
+    Redo what a crash may have lost of the journaled submissions of the
+    session (the channel link, the version log, the index entry, the
+    validation job), make it durable and start new journals. Runs once at
+    startup, before any upload is accepted. The journals only hold what was
+    accepted since the last checkpoint: submissions already in place are
+    left alone, so a file deleted by hand before that doesn't come back.
+    Returns the number of submissions repaired.
+    """
+    latest = {}
+    for entry in Journal.entries(UPLOAD_FOLDER):
+        latest[(entry['channel'], entry['filename'])] = entry
+    if not latest:
+        return 0
+
+    store = blob_store()
+    repaired = 0
+    for (channel, filename), entry in latest.items():
+        sha256 = entry['sha256']
+        if not store.has(sha256):
+            log.error("journaled submission %s/%s (%s) has no blob, it is lost", channel, filename, sha256)
+            continue
+        path = submission_path(channel, filename)
+        versions = store.versions(channel, filename)
+        logged = bool(versions) and versions[-1]['sha256'] == sha256
+        try:
+            st = os.stat(path)
+            # a link to the blob, or the copy made when another submission links it
+            current = (os.path.samestat(st, os.stat(store.blob_path(sha256)))
+                       or logged and st.st_size == entry['size'])
+        except FileNotFoundError:
+            current = False
+        if not current:
+            store.publish(sha256, path, mtime=entry['time'])
+        if not logged:
+            store.record_version(channel, filename, sha256, entry['size'], mtime=entry['time'])
+        repaired += not (current and logged)
+        # both are no-ops when already done
+        submission_index().record(channel, filename, os.stat(path).st_mtime, entry['size'], sha256)
+        validation_queue().enqueue(sha256)
+
+    # the derived state is now on disk: the journals aren't needed any more
+    if hasattr(os, 'sync'):
+        os.sync()
+    Journal.truncate(UPLOAD_FOLDER)
+    return repaired
+
+
+def commit_to_storage(source, channel, filename, sha256, size, stages):
+    """
+    commit_submission() with a shared object store: the content is uploaded
+    once as a blob, then copied server-side to <session>/<channel>/<filename>.
+    Indexing and validation are left to the dashboard, which lists the store.
+    Returns the object key.
+    """
+    store = submission_store()
+    with stages('store'):
+        store.put(source, sha256)
+    key = store.submission_key(channel, filename)
+    with stages('publish'):
+        store.publish(sha256, key)
+        store.record_version(channel, filename, sha256, size)
+    return key
+
+
+def admission_controlled(view):
+    """
+    Run an upload view only once UPLOAD_ADMISSION grants it a slot.
+
+    Requests that are not admitted get 429/503 with Retry-After before any of
+    their body is read; the time spent queued is reported as the 'queue' stage.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        client = request.remote_addr
+        stages = StageTimer()
+        try:
+            with stages('queue'):
+                granted = UPLOAD_ADMISSION.acquire(client)
+        except Overloaded as e:
+            METRICS.inc('sce_admission_rejected_total', (('app', METRICS.app_name), ('status', str(e.status))))
+            return e.message, e.status, {'Retry-After': str(e.retry_after)}
+        finally:
+            METRICS.record_stages(stages)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            UPLOAD_ADMISSION.release(client, granted)
+    return wrapper
+
+
+def format_upload_message(filename, channel):
+    return f"Upload received and saved as {filename} in channel '{channel}'. using '{channel}'"
+
+
+class AtomicUpload:
+    """
+    Receive a submission, computing SHA-256 and size on the fly.
+
+    Content is kept in memory up to UPLOAD_SPOOL_SIZE, then spilled to a hidden
+    temporary file in the blob store. commit() hands it to commit_submission(),
+    so readers never see a partially written file; abort() (or leaving the
+    `with` block without committing) discards it.
+    """
+
+    def __init__(self, channel, filename, max_size=None, stages=None):
+        self.channel = channel
+        self.filename = filename
+        self.max_size = max_size
+        self.stages = stages or StageTimer()
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.path = None
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.tmp_path = None
+        self.committed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise UploadError("Uploaded file is too large", 413)
+        with self.stages('hash'):
+            self.sha256.update(data)
+
+        if self.file is None:
+            if self.size <= UPLOAD_SPOOL_SIZE:
+                self.buffer.write(data)
+                return
+            with self.stages('write'):
+                fd, self.tmp_path = tempfile.mkstemp(dir=blob_store().tmp_dir(), prefix='.', suffix='.part')
+                self.file = os.fdopen(fd, 'wb')
+                self.file.write(self.buffer.getbuffer())
+            self.buffer = None
+        with self.stages('write'):
+            self.file.write(data)
+
+    def commit(self):
+        if self.file is None:
+            source = self.buffer.getvalue()
+        else:
+            with self.stages('write'):
+                self.file.close()
+            source = self.tmp_path
+        self.path = commit_submission(source, self.channel, self.filename,
+                                      self.sha256.hexdigest(), self.size, self.stages)
+        self.committed = True
+
+    def abort(self):
+        if self.file is None:
+            return
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self.committed:
+            self.abort()
+
+
+class MultipartUpload:
+    """
+    Incremental (sans-IO) receiver for a multipart/form-data upload body.
+
+    Body chunks are passed to feed() as they arrive and feed(None) marks the end
+    of the body. The first part named 'file' is streamed into an AtomicUpload at
+    its channel path as soon as its headers are parsed; everything else is
+    discarded. Memory use is bounded by the chunk size, whatever the upload size.
+    Time spent parsing, naming and writing goes to the `stages` StageTimer.
+    """
+
+    def __init__(self, content_type, max_size=None, stages=None):
+        mimetype, options = parse_options_header(content_type or '')
+        if mimetype != 'multipart/form-data' or not options.get('boundary'):
+            raise UploadError("No file part in the request", 400)
+
+        self.decoder = MultipartDecoder(options['boundary'].encode('latin-1'),
+                                        max_form_memory_size=4 * UPLOAD_CHUNK_SIZE)
+        self.max_size = max_size
+        self.stages = stages or StageTimer()
+        self.writer = None
+        self.filename = None
+        self.channel = None
+        self._receiving = False
+        self.complete = False
+
+    def feed(self, data):
+        try:
+            with self.stages('parse'):
+                self.decoder.receive_data(data)
+            while not self.complete:
+                with self.stages('parse'):
+                    event = self.decoder.next_event()
+                if event is NEED_DATA:
+                    break
+                if isinstance(event, File) and event.name == 'file' and self.writer is None:
+                    with self.stages('filename'):
+                        self.filename, self.channel = parse_submission_filename(event.filename)
+                    self.writer = AtomicUpload(self.channel, self.filename, self.max_size, self.stages)
+                    self._receiving = True
+                elif isinstance(event, Data) and self._receiving:
+                    self.writer.write(event.data)
+                    self._receiving = event.more_data
+                elif isinstance(event, Epilogue):
+                    self.complete = True
+        except ValueError:
+            raise UploadError("Malformed multipart body", 400)
+
+        if self.complete and self.writer is None:
+            raise UploadError("No file part in the request", 400)
+
+    def close(self):
+        if self.writer is not None and not self.writer.committed:
+            self.writer.abort()
 
 """
 @app.route('/upload', methods=['POST'])
@@ -30,6 +529,7 @@ def upload():
 """
 
 @app.route('/upload', methods=['POST'])
+@admission_controlled
 def upload():
     """
     Handle a multipart POST upload (form field 'file') and route the file into a channel subfolder.
@@ -38,83 +538,462 @@ def upload():
 
     - Accepts only files with a .zip extension (returns 415 otherwise).
     - Expects filename format: SURNAME_NAME_STUDENTID_CHANNEL.zip (parser is resilient to extra underscores).
-    - Extracts and sanitizes the CHANNEL token (keeps letters, digits, underscores, dashes).
     - Extracts CHANNEL token and performs basic sanitization (keeps letters, digits, underscores, dashes).
-    - Creates uploads/<channel>/ if needed and saves the uploaded file there.
-    - Returns 200 with an informative message on success, or appropriate 4xx on error.
+    - Streams the request body once, in UPLOAD_CHUNK_SIZE chunks, into an AtomicUpload that hashes
+      it on the fly and spools it in memory up to UPLOAD_SPOOL_SIZE, then in the blob store's tmp
+      folder; only once the whole body has been received does commit_submission() store the blob
+      and point uploads/<channel>/<filename> at it, so a half-written upload is never visible.
+    - Rejects bodies larger than MAX_CONTENT_LENGTH with 413.
+    - Returns 200 with an informative message (and the SHA-256 in X-Upload-SHA256) on success,
+      or appropriate 4xx on error.
     
     Security:
 
     Uses os.path.basename and token sanitization to prevent path traversal. Only basic cleaning is performed; no fuzzy mapping is applied.
     """
-    if 'file' not in request.files:
-        return "No file part in the request", 400
+    max_size = app.config['MAX_CONTENT_LENGTH']
+    stages = StageTimer()
+    receiver = None
+    try:
+        receiver = MultipartUpload(request.headers.get('Content-Type'), max_size, stages)
+        stream = request.stream
+        while not receiver.complete:
+            with stages('receive'):
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            receiver.feed(chunk or None)
+        receiver.writer.commit()
+    except UploadError as e:
+        return e.message, e.status
+    finally:
+        if receiver is not None:
+            receiver.close()
+        METRICS.record_stages(stages)
 
-    file = request.files['file']
-    if file.filename == '':
-        return "No selected file", 400
+    return (format_upload_message(receiver.filename, receiver.channel), 200,
+            {'X-Upload-SHA256': receiver.writer.sha256.hexdigest()})
 
-    if not file.filename.endswith('.zip'):
-        return "Only .zip files are allowed", 415
 
-    # normalize filename and avoid path traversal
-    filename = os.path.basename(file.filename)
+class ResumableUpload:
+    """
+    On-disk state of a resumable upload session.
 
-    # Attempt to parse channel from filename with expected format:
-    # SURNAME_NAME_STUDENTID_CHANNEL.zip
-    name_no_ext = os.path.splitext(filename)[0]
-    # Try splitting from the right to be resilient to extra underscores in names
-    parts = name_no_ext.rsplit('_', 2)
-    if len(parts) == 3:
-        # head, studentid, channel
-        _, studentid, channel_raw = parts
-    else:
-        # fallback: take last segment as channel
-        channel_raw = parts[-1]
+    Each session is a pair of files in RESUMABLE_FOLDER: <id>.json with the
+    declared filename, channel, size and optional SHA-256, and <id>.part with
+    the bytes received so far. The acknowledged offset is simply the size of
+    the .part file, so a session survives dropped connections and server
+    restarts. Sessions that received no chunk for longer than RESUMABLE_TTL
+    are removed.
+    """
 
-    # sanitize channel token
-    channel_candidate = re.sub(r'[^A-Za-z0-9_-]', '', channel_raw).strip()
-    if not channel_candidate:
-        channel_candidate = 'unknown'
+    ID_RE = re.compile(r'^[0-9a-f]{32}$')
 
-    # Basic mapping: use sanitized candidate as channel name (no fuzzy mapping)
-    mapped_channel = channel_candidate
-    note = f"using '{mapped_channel}'"
+    def __init__(self, upload_id, meta):
+        self.id = upload_id
+        self.meta = meta
+        self.part_path = os.path.join(resumable_folder(), upload_id + '.part')
+        self.meta_path = os.path.join(resumable_folder(), upload_id + '.json')
+
+    @classmethod
+    def create(cls, filename, channel, size, sha256=None):
+        upload_id = secrets.token_hex(16)
+        session = cls(upload_id, {'filename': filename, 'channel': channel, 'size': size,
+                                  'sha256': sha256, 'created': time.time()})
+        open(session.part_path, 'wb').close()
+        tmp = session.meta_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(session.meta, f)
+        os.replace(tmp, session.meta_path)
+        return session
+
+    @classmethod
+    def load(cls, upload_id):
+        if not cls.ID_RE.match(upload_id):
+            return None
+        try:
+            with open(os.path.join(resumable_folder(), upload_id + '.json')) as f:
+                return cls(upload_id, json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    @property
+    def size(self):
+        return self.meta['size']
+
+    def offset(self):
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            return 0
+
+    def status(self):
+        return {'upload_id': self.id, 'filename': self.meta['filename'], 'channel': self.meta['channel'],
+                'size': self.size, 'offset': self.offset()}
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+# Seconds of inactivity after which a resumable upload session is garbage-collected
+RESUMABLE_TTL = 6 * 3600
+_last_resumable_gc = 0.0
+
+
+def resumable_folder():
+    path = os.path.join(UPLOAD_FOLDER, '.resumable')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def gc_resumable_uploads(force=False):
+    """Remove abandoned resumable sessions (runs at most once a minute unless forced)."""
+    global _last_resumable_gc
+    now = time.time()
+    if not force and now - _last_resumable_gc < 60:
+        return
+    _last_resumable_gc = now
+
+    # a session's files go together, by its last activity: every chunk moves the .part's mtime,
+    # while the .json is only written at init
+    folder = resumable_folder()
+    files, last_activity = {}, {}
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        upload_id = name.partition('.')[0]
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+        files.setdefault(upload_id, []).append(path)
+        last_activity[upload_id] = max(last_activity.get(upload_id, 0.0), mtime)
+    for upload_id, paths in files.items():
+        if now - last_activity[upload_id] > RESUMABLE_TTL:
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    """
+    Start a resumable upload.
+
+    Expects a JSON body {"filename": "SURNAME_NAME_STUDENTID_CHANNEL.zip", "size": <bytes>,
+    "sha256": <optional hex digest>}. The filename goes through the same parsing as /upload.
+    Returns 201 with {"upload_id", "offset", "size", "chunk_size"}.
+    """
+    gc_resumable_uploads()
+
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    if not isinstance(size, int) or size < 0:
+        return "Missing or invalid 'size'", 400
+    if size > app.config['MAX_CONTENT_LENGTH']:
+        return "Uploaded file is too large", 413
 
-    # create channel subfolder and save file
-    channel_dir = os.path.join(UPLOAD_FOLDER, mapped_channel)
-    os.makedirs(channel_dir, exist_ok=True)
-    file_path = os.path.join(channel_dir, filename)
-    file.save(file_path)
+    try:
+        filename, channel = parse_submission_filename(str(data.get('filename', '')))
+    except UploadError as e:
+        return e.message, e.status
 
-    return f"Upload received and saved as {filename} in channel '{mapped_channel}'. {note}", 200
+    session = ResumableUpload.create(filename, channel, size, data.get('sha256'))
+    return jsonify(**session.status(), chunk_size=UPLOAD_CHUNK_SIZE * 16), 201
+
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Return the state of a resumable upload, in particular the last acknowledged byte offset."""
+    session = ResumableUpload.load(upload_id)
+    if session is None:
+        abort(404, description="Unknown upload session.")
+    return jsonify(session.status())
+
+
+@app.route('/upload/<upload_id>', methods=['PUT'])
+@admission_controlled
+def upload_chunk(upload_id):
+    """
+    Write the request body at ?offset=N of a resumable upload.
+
+    The offset may not go past the bytes already received (409 with the current
+    offset otherwise), so a client can always resume from the last acknowledged
+    byte. Bytes received before a dropped connection are kept.
+    """
+    session = ResumableUpload.load(upload_id)
+    if session is None:
+        abort(404, description="Unknown upload session.")
+
+    offset = request.args.get('offset', type=int)
+    current = session.offset()
+    if offset is None or offset < 0 or offset > current:
+        return jsonify(**session.status(), error="Offset mismatch"), 409
+
+    stages = StageTimer()
+    stream = request.stream
+    written = 0
+    with open(session.part_path, 'r+b') as f:
+        f.seek(offset)
+        try:
+            while True:
+                with stages('receive'):
+                    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if offset + written + len(chunk) > session.size:
+                    return jsonify(**session.status(), error="Chunk goes past the declared size"), 413
+                with stages('write'):
+                    f.write(chunk)
+                written += len(chunk)
+        finally:
+            f.truncate(offset + written)
+            METRICS.record_stages(stages)
+
+    return jsonify(session.status())
+
+
+@app.route('/upload/<upload_id>/complete', methods=['POST'])
+@admission_controlled
+def upload_complete(upload_id):
+    """
+    Verify a resumable upload (size and, if declared, SHA-256) and commit it into
+    uploads/<channel>/ exactly like /upload does.
+    """
+    session = ResumableUpload.load(upload_id)
+    if session is None:
+        abort(404, description="Unknown upload session.")
+
+    if session.offset() != session.size:
+        return jsonify(**session.status(), error="Upload is incomplete"), 409
+
+    stages = StageTimer()
+    digest = hashlib.sha256()
+    with stages('hash'), open(session.part_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+
+    expected = session.meta.get('sha256')
+    if expected and expected.lower() != sha256:
+        session.discard()
+        return jsonify(error="Checksum mismatch, upload discarded", sha256=sha256), 422
+
+    filename, channel = session.meta['filename'], session.meta['channel']
+    commit_submission(session.part_path, channel, filename, sha256, session.size, stages)
+    session.discard()
+    METRICS.record_stages(stages)
+
+    return format_upload_message(filename, channel), 200, {'X-Upload-SHA256': sha256}
+
+
+# Bytes of the previous version copied at a time when rebuilding a delta upload
+DELTA_COPY_SIZE = 1024 * 1024
+
+
+def delta_path(delta_id):
+    # next to the resumable sessions, so the same garbage collection applies
+    return os.path.join(resumable_folder(), delta_id + '.delta.json')
+
+
+def load_delta(delta_id):
+    if not ResumableUpload.ID_RE.match(delta_id):
+        return None
+    try:
+        with open(delta_path(delta_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def discard_delta(delta_id):
+    try:
+        os.unlink(delta_path(delta_id))
+    except FileNotFoundError:
+        pass
+
+
+@app.route('/upload/delta', methods=['POST'])
+@admission_controlled
+def upload_delta_init():
+    """
+    Start a delta re-upload of a file submitted before.
+
+    Expects a JSON body {"filename", "size", "sha256", "chunks": [[digest, size], ...]}, the chunks
+    of the new zip as cut by sce_unina_chunks.py. Returns 404 if there is no previous version of
+    that file (send it to /upload instead), else 201 with {"delta_id", "base" (SHA-256 of the
+    previous version), "missing" (indexes of the chunks the server doesn't have), "missing_size"}.
+    """
+    gc_resumable_uploads()
+
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    sha256 = str(data.get('sha256', '')).lower()
+    chunks = data.get('chunks')
+    if not isinstance(size, int) or size < 0:
+        return "Missing or invalid 'size'", 400
+    if size > app.config['MAX_CONTENT_LENGTH']:
+        return "Uploaded file is too large", 413
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        return "Missing or invalid 'sha256'", 400
+    if not valid_manifest(chunks, size):
+        return "Invalid 'chunks'", 400
+
+    try:
+        filename, channel = parse_submission_filename(str(data.get('filename', '')))
+    except UploadError as e:
+        return e.message, e.status
+
+    store = submission_store()
+    versions = store.versions(channel, filename)
+    if not versions:
+        abort(404, description="No previous submission of this file.")
+    base = versions[-1]['sha256']
+    stages = StageTimer()
+    try:
+        with stages('chunk'):
+            base_chunks = ManifestStore(UPLOAD_FOLDER).load(base, *store.locate(base))
+    except FileNotFoundError:
+        abort(404, description="No previous submission of this file.")
+    finally:
+        METRICS.record_stages(stages)
+
+    missing = [i for kind, i, _ in delta_plan(chunks, base_chunks) if kind == 'new']
+    delta_id = secrets.token_hex(16)
+    tmp = delta_path(delta_id) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'filename': filename, 'channel': channel, 'size': size, 'sha256': sha256,
+                   'base': base, 'chunks': chunks, 'created': time.time()}, f)
+    os.replace(tmp, delta_path(delta_id))
+    return jsonify(delta_id=delta_id, base=base, missing=missing,
+                   missing_size=sum(chunks[i][1] for i in missing)), 201
+
+
+@app.route('/upload/delta/<delta_id>', methods=['POST'])
+@admission_controlled
+def upload_delta_commit(delta_id):
+    """
+    Receive the missing chunks of a delta upload (the request body, concatenated in the order
+    of "missing"), rebuild the new zip from them and the previous version, verify it (every
+    chunk, the size and the SHA-256) and commit it exactly like /upload does. If the previous
+    version is gone meanwhile, answers 409 with every chunk in "missing".
+    """
+    meta = load_delta(delta_id)
+    if meta is None:
+        abort(404, description="Unknown upload session.")
+
+    store = submission_store()
+    storage, key = store.locate(meta['base'])
+    chunks = meta['chunks']
+    stages = StageTimer()
+    stream = request.stream
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=blob_store().tmp_dir(), prefix='.', suffix='.delta')
+    committed = False
+    try:
+        try:
+            with os.fdopen(fd, 'wb') as out, storage.open(key) as base:
+                base_chunks = ManifestStore(UPLOAD_FOLDER).load(meta['base'], storage, key)
+                for kind, where, size in delta_plan(chunks, base_chunks):
+                    if kind == 'base':
+                        base.seek(where)
+                        while size:
+                            with stages('read'):
+                                data = base.read(min(DELTA_COPY_SIZE, size))
+                            if not data:
+                                raise UploadError("Previous version changed, start again", 409)
+                            size -= len(data)
+                            with stages('hash'):
+                                digest.update(data)
+                            with stages('write'):
+                                out.write(data)
+                        continue
+
+                    data = b''
+                    with stages('receive'):
+                        while len(data) < size:
+                            piece = stream.read(size - len(data))
+                            if not piece:
+                                raise UploadError("Missing chunk data", 400)
+                            data += piece
+                    with stages('hash'):
+                        if chunk_digest(data) != chunks[where][0]:
+                            raise UploadError(f"Chunk {where} doesn't match its digest", 422)
+                        digest.update(data)
+                    with stages('write'):
+                        out.write(data)
+                if stream.read(1):
+                    raise UploadError("More data than the missing chunks", 400)
+        except (FileNotFoundError, StorageError):
+            # the previous version was deleted, or replaced in the object store while it was read:
+            # without it every chunk is missing
+            discard_delta(delta_id)
+            return jsonify(error="Previous version is gone, upload the file again.",
+                           missing=list(range(len(chunks)))), 409
+
+        if digest.hexdigest() != meta['sha256']:
+            raise UploadError("Checksum mismatch, upload discarded", 422)
+        commit_submission(tmp_path, meta['channel'], meta['filename'], meta['sha256'], meta['size'], stages)
+        committed = True
+    except UploadError as e:
+        discard_delta(delta_id)
+        return e.message, e.status
+    finally:
+        if not committed:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+        METRICS.record_stages(stages)
+
+    discard_delta(delta_id)
+    # the next resubmission can be planned against this version without chunking it
+    ManifestStore(UPLOAD_FOLDER).put(meta['sha256'], chunks)
+    return (format_upload_message(meta['filename'], meta['channel']), 200,
+            {'X-Upload-SHA256': meta['sha256']})
 
 @app.route('/get_exam', methods=['GET'])
 def get_exam():
-    if not os.path.exists(FILE_PATH):
+    """
+    Serve the exam file from the in-memory ExamCache.
+
+    Supports conditional GET (If-None-Match / If-Modified-Since -> 304), byte
+    ranges (Range -> 206) and, when enabled with --gzip-exam, a pre-compressed
+    gzip representation for clients that accept it (full downloads only).
+    """
+    return exam_response(request)
+
+
+def exam_response(req):
+    """The /get_exam response for a Werkzeug request (also used by the asyncio server)."""
+    exam = EXAM_CACHE.get(FILE_PATH)
+    if exam is None:
         abort(404, description="Exam file not found.")
 
-    _, ext = os.path.splitext(FILE_PATH)
-    ext = ext.lower()
+    if exam.mimetype is None:
+        abort(415, description=f"Unsupported file format: {exam.ext}")
 
-    if ext not in ALLOWED_EXTENSIONS:
-        abort(415, description=f"Unsupported file format: {ext}")
+    if FILE_SENDER.offloaded:
+        # straight from the file on disk, never the gzip copy: the worker only sends headers
+        return FILE_SENDER.send(req, exam.path, exam.mimetype, os.path.basename(exam.path))
 
-    # Guess MIME type based on extension
-    mimetypes = {
-        '.pdf': 'application/pdf',
-        '.doc': 'application/msword',
-        '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        '.rtf': 'application/rtf',
-        '.zip': 'application/zip'
-    }
+    use_gzip = (exam.gzipped is not None and 'Range' not in req.headers
+                and 'gzip' in req.accept_encodings)
+    body = exam.gzipped if use_gzip else exam.data
 
-    return send_file(
-        FILE_PATH,
-        mimetype=mimetypes.get(ext, 'application/octet-stream'),
-        as_attachment=True,
-        download_name=os.path.basename(FILE_PATH)
-    )
+    response = Response(body, mimetype=exam.mimetype)
+    response.headers['Content-Disposition'] = exam.disposition
+    response.set_etag(exam.etag + '-gz' if use_gzip else exam.etag)
+    response.last_modified = exam.mtime
+    if exam.gzipped is not None:
+        response.vary.add('Accept-Encoding')
+    if use_gzip:
+        response.content_encoding = 'gzip'
+
+    return response.make_conditional(req, accept_ranges=True, complete_length=len(body))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='SCE-Unina Flask Server')
@@ -122,11 +1001,74 @@ if __name__ == '__main__':
     parser.add_argument('--port', type=int, default=5001, help='Port number')
     parser.add_argument('--file', type=str, default='traccia.pdf', help='Path to exam file')
     parser.add_argument('--upload-folder', type=str, default='uploads', help='Folder to store uploaded files')
+    parser.add_argument('--session', type=str, default=None,
+                        help='Exam session the uploads go to, a folder inside the upload folder (default: today\'s date)')
+    parser.add_argument('--fanout', type=int, default=0,
+                        help='Hex digits of the filename hash used as sub-folder of each channel, for new sessions (0 = none)')
+    parser.add_argument('--storage', type=str, default=None,
+                        help='Commit submissions to a shared object store, s3://bucket/prefix[?endpoint_url=URL] (default: the upload folder)')
+    parser.add_argument('--max-upload-size', type=int, default=200, help='Maximum size of an upload request in MB')
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default='none',
+                        help="When an upload is answered: 'none' right away, 'file' after flushing it to disk, "
+                             "'group' after flushing it with the uploads of the same few milliseconds")
+    parser.add_argument('--group-commit-interval', type=float, default=5.0,
+                        help='Milliseconds the group committer waits for more uploads before flushing (durability group)')
+    parser.add_argument('--gzip-exam', action='store_true', help='Also keep a gzip-compressed copy of the exam file for clients that accept it')
+    parser.add_argument('--file-delivery', choices=FILE_DELIVERY_MODES, default=FILE_SENDER.mode,
+                        help="How the exam is sent: 'sendfile' from the page cache, or headers for a front proxy (nginx, Apache)")
+    parser.add_argument('--accel-prefix', type=str, default=FILE_SENDER.accel_prefix,
+                        help='Internal nginx location serving absolute paths (x-accel-redirect mode)')
+    parser.add_argument('--mode', choices=['dev', 'prefork'], default='dev',
+                        help="'dev' runs the Flask development server, 'prefork' runs several worker processes on a shared socket")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes (prefork mode)')
+    parser.add_argument('--max-requests', type=int, default=1000, help='Recycle a worker after this many requests, 0 = never (prefork mode)')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0, help='Seconds to let in-flight requests finish on shutdown (prefork mode)')
+    parser.add_argument('--slow-request-threshold', type=float, default=2.0, help='Log requests taking longer than this many seconds')
+    parser.add_argument('--max-concurrent-uploads', type=int, default=UPLOAD_ADMISSION.max_active,
+                        help='Uploads written to disk at the same time, per worker process (0 = no admission control)')
+    parser.add_argument('--upload-queue', type=int, default=UPLOAD_ADMISSION.max_queued,
+                        help='Uploads allowed to wait for a slot before new ones get 503, per worker process')
+    parser.add_argument('--upload-queue-timeout', type=float, default=UPLOAD_ADMISSION.queue_timeout,
+                        help='Seconds an upload may wait for a slot before getting 503')
+    parser.add_argument('--max-uploads-per-client', type=int, default=UPLOAD_ADMISSION.per_client,
+                        help='Concurrent uploads allowed from one IP address, 0 = unlimited')
 
     args = parser.parse_args()
     FILE_PATH = args.file
-    UPLOAD_FOLDER = args.upload_folder
+    try:
+        # everything below (blobs, index, validation, resumable uploads) lives in the session folder
+        UPLOAD_FOLDER = sessions.start_session(args.upload_folder, args.session, args.fanout)
+        if args.storage:
+            # the upload folder only holds in-progress uploads then
+            STORAGE = open_storage(args.storage)
+            write_session(STORAGE, os.path.basename(UPLOAD_FOLDER))
+    except (ValueError, RuntimeError, StorageError) as e:
+        parser.error(str(e))
+    if sessions.unmigrated(args.upload_folder):
+        log.warning("%s still has channels outside any session, the dashboard won't show them: "
+                    "move them with `python sce_unina_sessions.py --upload-folder %s migrate --session NAME`",
+                    args.upload_folder, args.upload_folder)
+    app.config['MAX_CONTENT_LENGTH'] = args.max_upload_size * 1024 * 1024
+    METRICS.slow_threshold = args.slow_request_threshold
+    UPLOAD_ADMISSION = Admission(args.max_concurrent_uploads, args.upload_queue,
+                                 args.upload_queue_timeout, args.max_uploads_per_client)
+    FILE_SENDER = FileSender(args.file_delivery, args.accel_prefix)
+    DURABILITY = Durability(args.durability, args.group_commit_interval / 1000)
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # Ensure uploads dir exists
+    gc_resumable_uploads(force=True)
+    repaired = replay_journal()
+    if repaired:
+        log.warning("recovered %d submissions from the journal after an unclean shutdown", repaired)
+
+    # Load the exam file before forking workers so they share the buffer
+    EXAM_CACHE.gzip_enabled = args.gzip_exam
+    EXAM_CACHE.get(FILE_PATH)
 
-    app.run(host=args.host, port=args.port, threaded=True, debug=True)
+    if args.mode == 'prefork':
+        # every worker publishes its counters here, /metrics sums them
+        METRICS.shared_dir = tempfile.mkdtemp(prefix='sce-unina-metrics-')
+        serve(app, host=args.host, port=args.port, workers=args.workers,
+              max_requests=args.max_requests, graceful_timeout=args.graceful_timeout)
+    else:
+        app.run(host=args.host, port=args.port, threaded=True, debug=True)
 
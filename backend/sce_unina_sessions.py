@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+"""
+Exam sessions: one self-contained folder per session under the upload folder.
+
+    uploads/
+      .current-session          name of the active session
+      2024-06-18/               a session (it has a .layout.json)
+        .layout.json            {"fanout": 0}
+        .index.sqlite3, .blobs/, .versions/, .validation/, ...
+        Tramontana/ROSSI_MARIO_N12345_Tramontana.zip
+
+Everything that used to live directly in the upload folder (submissions,
+index, blob store, validation jobs) lives in the session folder instead, so
+each session stays as small as one exam and the dashboard only ever looks at
+one of them. The upload server starts (or resumes) a session named after the
+current date, or the one given with --session, and makes it the active one.
+
+With a fan-out of N, submissions go one level deeper, in a folder named after
+the first N hex digits of the SHA-1 of their filename
+(Tramontana/3f/ROSSI_...zip), so that no directory holds more than a few
+hundred files however many students a channel has.
+
+Flat trees from before sessions are moved into a session with
+`python sce_unina_sessions.py --upload-folder uploads migrate --session NAME`.
+"""
+
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import datetime
+
+POINTER_FILE = '.current-session'
+LAYOUT_FILE = '.layout.json'
+
+# Largest supported fan-out (hex digits): 2 already means 256 folders per channel
+MAX_FANOUT = 3
+
+_SESSION_NAME = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]*')
+
+_fanouts = {}       # session folder -> fan-out, the layout never changes once written
+
+
+def valid_session_name(name):
+    return bool(name) and _SESSION_NAME.fullmatch(name) is not None
+
+
+def default_session_name():
+    return datetime.date.today().isoformat()
+
+
+def _write_atomic(path, text):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def is_session(folder):
+    return os.path.isfile(os.path.join(folder, LAYOUT_FILE))
+
+
+def sessions(upload_folder):
+    """Names of the sessions in `upload_folder`, oldest name first."""
+    try:
+        with os.scandir(upload_folder) as it:
+            return sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir() and is_session(e.path))
+    except FileNotFoundError:
+        return []
+
+
+def unmigrated(upload_folder):
+    """Channel folders of a flat tree from before sessions, left directly in `upload_folder`."""
+    try:
+        with os.scandir(upload_folder) as it:
+            return sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir() and not is_session(e.path))
+    except FileNotFoundError:
+        return []
+
+
+def create_session(upload_folder, name, fanout=0):
+    """Create session `name` if it doesn't exist yet and return its folder. An existing session keeps its layout."""
+    if not valid_session_name(name):
+        raise ValueError(f"Invalid session name: {name!r}")
+    if not 0 <= fanout <= MAX_FANOUT:
+        raise ValueError(f"Fan-out must be between 0 and {MAX_FANOUT}")
+    folder = os.path.join(upload_folder, name)
+    os.makedirs(folder, exist_ok=True)
+    if not is_session(folder):
+        _write_atomic(os.path.join(folder, LAYOUT_FILE), json.dumps({'fanout': fanout}))
+    return folder
+
+
+def activate_session(upload_folder, name):
+    _write_atomic(os.path.join(upload_folder, POINTER_FILE), name + '\n')
+
+
+def start_session(upload_folder, name=None, fanout=0):
+    """Create (or resume) session `name`, today's date by default, make it the active one and return its folder."""
+    name = name or default_session_name()
+    folder = create_session(upload_folder, name, fanout)
+    activate_session(upload_folder, name)
+    return folder
+
+
+def current_session(upload_folder):
+    """The active session: the one the upload server last started, else the most recently changed one, else None."""
+    try:
+        with open(os.path.join(upload_folder, POINTER_FILE)) as f:
+            name = f.read().strip()
+        if valid_session_name(name) and is_session(os.path.join(upload_folder, name)):
+            return name
+    except OSError:
+        pass
+    names = sessions(upload_folder)
+    if not names:
+        return None
+    return max(names, key=lambda n: os.stat(os.path.join(upload_folder, n)).st_mtime_ns)
+
+
+def session_folder(upload_folder, name=None):
+    """
+    Folder of session `name` (the active one by default). A tree without
+    sessions (not migrated yet) is its own folder.
+    """
+    name = name or current_session(upload_folder)
+    if name is None:
+        return upload_folder
+    if not valid_session_name(name):
+        raise ValueError(f"Invalid session name: {name!r}")
+    return os.path.join(upload_folder, name)
+
+
+def fanout(folder):
+    """Fan-out of the session in `folder` (0 for trees without sessions)."""
+    value = _fanouts.get(folder)
+    if value is None:
+        try:
+            with open(os.path.join(folder, LAYOUT_FILE)) as f:
+                value = _fanouts[folder] = int(json.load(f).get('fanout', 0))
+        except (OSError, ValueError):
+            return 0
+    return value
+
+
+def bucket(filename, width):
+    return hashlib.sha1(filename.encode('utf-8')).hexdigest()[:width]
+
+
+def channel_dirs(folder, channel):
+    """The folders holding the submissions of `channel` (the channel folder itself, or its fan-out buckets)."""
+    channel_dir = os.path.join(folder, channel)
+    width = fanout(folder)
+    if not width:
+        return [channel_dir]
+    try:
+        with os.scandir(channel_dir) as it:
+            return [e.path for e in it if len(e.name) == width and e.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def submission_path(folder, channel, filename):
+    """Location of <channel>/<filename> in the session in `folder`."""
+    width = fanout(folder)
+    if width:
+        return os.path.join(folder, channel, bucket(filename, width), filename)
+    return os.path.join(folder, channel, filename)
+
+
+def migrate(upload_folder, name, fanout_width=0):
+    """
+    Move a flat upload folder (channels, index, blob store... directly in it)
+    into new session `name`, re-laid with `fanout_width`. Returns the number
+    of submissions moved.
+
+    Everything is renamed within the same filesystem, so blob hard links and
+    the index (which stores channel and filename, not paths) stay valid.
+    """
+    if not valid_session_name(name):
+        raise ValueError(f"Invalid session name: {name!r}")
+    if not 0 <= fanout_width <= MAX_FANOUT:
+        raise ValueError(f"Fan-out must be between 0 and {MAX_FANOUT}")
+    folder = os.path.join(upload_folder, name)
+    if os.path.exists(folder):
+        raise ValueError(f"{folder} already exists")
+
+    entries = []
+    with os.scandir(upload_folder) as it:
+        for e in it:
+            if e.name == POINTER_FILE or (e.is_dir() and is_session(e.path)):
+                continue
+            entries.append(e.name)
+    if not entries:
+        raise ValueError(f"Nothing to migrate in {upload_folder}")
+
+    # the layout is written last: until then the folder isn't a session, and a failed run can be resumed by hand
+    os.makedirs(folder)
+    for entry in entries:
+        os.rename(os.path.join(upload_folder, entry), os.path.join(folder, entry))
+
+    moved = 0
+    for channel in entries:
+        channel_dir = os.path.join(folder, channel)
+        if channel.startswith('.') or not os.path.isdir(channel_dir):
+            continue
+        for filename in os.listdir(channel_dir):
+            if not filename.endswith('.zip'):
+                continue
+            if fanout_width:
+                dest_dir = os.path.join(channel_dir, bucket(filename, fanout_width))
+                os.makedirs(dest_dir, exist_ok=True)
+                os.rename(os.path.join(channel_dir, filename), os.path.join(dest_dir, filename))
+            moved += 1
+
+    create_session(upload_folder, name, fanout_width)
+    if current_session(upload_folder) in (None, name):
+        activate_session(upload_folder, name)
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCE-Unina exam sessions')
+    parser.add_argument('--upload-folder', type=str, default='uploads', help='Folder where the upload server stores files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='List the sessions, the active one marked with *')
+    migrate_parser = subparsers.add_parser('migrate', help='Move a flat upload folder into a new session')
+    migrate_parser.add_argument('--session', type=str, default=None, help='Session name (default: today)')
+    migrate_parser.add_argument('--fanout', type=int, default=0, help='Hex digits of the filename hash used as sub-folder (0 = none)')
+    activate_parser = subparsers.add_parser('activate', help='Make a session the active one')
+    activate_parser.add_argument('session')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        active = current_session(args.upload_folder)
+        for name in sessions(args.upload_folder):
+            print(f"{'*' if name == active else ' '} {name}")
+    elif args.command == 'migrate':
+        name = args.session or default_session_name()
+        try:
+            moved = migrate(args.upload_folder, name, args.fanout)
+        except (ValueError, OSError) as e:
+            sys.exit(str(e))
+        print(f"Moved {moved} submissions to session {name}")
+    elif args.command == 'activate':
+        if not is_session(os.path.join(args.upload_folder, args.session)):
+            sys.exit(f"No session {args.session} in {args.upload_folder}")
+        activate_session(args.upload_folder, args.session)
+    sys.exit(0)
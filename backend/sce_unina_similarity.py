@@ -0,0 +1,389 @@
+#! /usr/bin/env python3
+"""
+Code similarity across submissions with MinHash and LSH.
+
+Each submission is read in place (only its source members), normalized
+(comments dropped, identifiers, numbers and string literals replaced by
+placeholders, so renaming variables doesn't hide a copy) and turned into the
+set of its token 5-grams. A MinHash signature of that set estimates the
+Jaccard similarity with any other submission; signatures are split into
+bands and hashed into buckets (LSH), so only submissions sharing a bucket are
+compared instead of all n² pairs.
+
+Signatures depend only on content: they are cached in
+<upload folder>/.similarity/ by SHA-256 and a new upload costs one signature.
+NumPy is used when available to compute them; the pure Python fallback gives
+identical signatures, only slower.
+"""
+
+import os
+import re
+import sys
+import zlib
+import random
+import struct
+import hashlib
+import zipfile
+import logging
+import argparse
+import threading
+import contextlib
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from sce_unina_blobs import BlobStore
+from sce_unina_validation import SOURCE_EXTENSIONS
+from sce_unina_sessions import session_folder, submission_path
+
+log = logging.getLogger(__name__)
+
+SIMILARITY_DIR = '.similarity'
+
+# MinHash/LSH parameters: 32 bands of 4 rows make pairs above ~0.45 Jaccard likely candidates
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+
+# Source members larger than this are skipped (generated or data files)
+MAX_SOURCE_SIZE = 1024 * 1024
+
+_PRIME = (1 << 61) - 1
+_MASK = 0xFFFFFFFF
+_rng = random.Random(20240601)
+_PERMUTATIONS = [(_rng.randrange(1, 1 << 32), _rng.randrange(0, 1 << 32)) for _ in range(NUM_PERM)]
+_SIGNATURE = struct.Struct(f'<{NUM_PERM}I')
+
+_COMMENTS = {
+    'c': re.compile(r'/\*.*?\*/|//[^\n]*', re.S),
+    'hash': re.compile(r'#[^\n]*'),
+    'percent': re.compile(r'%[^\n]*'),
+}
+_COMMENT_STYLE = {'.c': 'c', '.h': 'c', '.cpp': 'c', '.java': 'c', '.py': 'hash', '.makefile': 'hash', '.m': 'percent'}
+
+_TOKEN = re.compile(r'''
+    (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<number>\d[\w.]*)
+  | (?P<symbol>\S)
+''', re.X)
+
+KEYWORDS = {
+    # C / C++ / Java
+    'auto', 'break', 'case', 'char', 'class', 'const', 'continue', 'default', 'do', 'double', 'else', 'enum',
+    'extends', 'extern', 'final', 'float', 'for', 'goto', 'if', 'implements', 'import', 'include', 'int',
+    'interface', 'long', 'new', 'private', 'protected', 'public', 'return', 'short', 'signed', 'sizeof',
+    'static', 'struct', 'super', 'switch', 'this', 'throw', 'throws', 'try', 'catch', 'typedef', 'union',
+    'unsigned', 'void', 'volatile', 'while', 'bool', 'boolean', 'template', 'typename', 'namespace', 'using',
+    'delete', 'virtual', 'override', 'null', 'nullptr', 'true', 'false',
+    # Python
+    'and', 'as', 'assert', 'async', 'await', 'def', 'del', 'elif', 'except', 'finally', 'from', 'global',
+    'in', 'is', 'lambda', 'nonlocal', 'not', 'or', 'pass', 'raise', 'with', 'yield', 'None', 'True', 'False',
+    # MATLAB
+    'end', 'function', 'elseif', 'otherwise', 'parfor',
+}
+
+
+def _source_kind(name):
+    if os.path.basename(name).lower() == 'makefile':
+        return '.makefile'
+    ext = os.path.splitext(name)[1].lower()
+    return ext if ext in SOURCE_EXTENSIONS else None
+
+
+def tokens(text, kind):
+    """Normalized tokens of a source file: keywords and symbols kept, everything else a placeholder."""
+    style = _COMMENT_STYLE.get(kind)
+    if style:
+        text = _COMMENTS[style].sub(' ', text)
+    for match in _TOKEN.finditer(text):
+        group = match.lastgroup
+        if group == 'string':
+            yield 'S'
+        elif group == 'number':
+            yield 'N'
+        elif group == 'word':
+            word = match.group()
+            yield word if word in KEYWORDS else 'V'
+        else:
+            yield match.group()
+
+
+def shingles(path, storage=None):
+    """Hashed token 5-grams of every source file in the zip at `path` (a key of `storage`, if given), empty if none."""
+    result = set()
+    try:
+        with (contextlib.nullcontext(path) if storage is None else storage.open(path)) as source, \
+                zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                kind = _source_kind(info.filename)
+                if kind is None or info.is_dir() or info.file_size > MAX_SOURCE_SIZE:
+                    continue
+                try:
+                    text = zf.read(info).decode('utf-8', errors='replace')
+                except (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError, EOFError):
+                    continue
+                toks = list(tokens(text, kind))
+                for i in range(max(len(toks) - SHINGLE_SIZE + 1, 1 if toks else 0)):
+                    result.add(zlib.crc32(' '.join(toks[i:i + SHINGLE_SIZE]).encode()))
+    except (zipfile.BadZipFile, OSError):
+        pass
+    return result
+
+
+def minhash(values):
+    """MinHash signature (NUM_PERM 32-bit values) of a non-empty set of 32-bit hashes."""
+    if np is not None:
+        x = np.fromiter(values, dtype=np.uint64, count=len(values))
+        a = np.array([p[0] for p in _PERMUTATIONS], dtype=np.uint64)[:, None]
+        b = np.array([p[1] for p in _PERMUTATIONS], dtype=np.uint64)[:, None]
+        signature = np.full(NUM_PERM, _MASK, dtype=np.uint64)
+        # a, b and x are below 2**32, so a * x + b never overflows 64 bits
+        for start in range(0, len(x), 8192):
+            block = (a * x[start:start + 8192] + b) % np.uint64(_PRIME) & np.uint64(_MASK)
+            signature = np.minimum(signature, block.min(axis=1))
+        return [int(v) for v in signature]
+    return [min(((a * v + b) % _PRIME) & _MASK for v in values) for a, b in _PERMUTATIONS]
+
+
+def compute_signature(path, storage=None):
+    """Packed signature of the zip at `path`, or b'' if it has no source code. Runs in a worker process."""
+    values = shingles(path, storage)
+    return _SIGNATURE.pack(*minhash(values)) if values else b''
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+class SignatureStore:
+    """Signatures cached on disk by content SHA-256."""
+
+    def __init__(self, upload_folder):
+        self.root = os.path.join(upload_folder, SIMILARITY_DIR, f'minhash-{NUM_PERM}-{SHINGLE_SIZE}')
+
+    def _path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def get(self, sha256):
+        """The unpacked signature, () if the content has no source code, None if not computed yet."""
+        try:
+            with open(self._path(sha256), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return _SIGNATURE.unpack(data) if data else ()
+
+    def put(self, sha256, packed):
+        path = self._path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(packed)
+        os.replace(tmp, path)
+        return _SIGNATURE.unpack(packed) if packed else ()
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SimilarityIndex:
+    """
+    Incremental LSH index over the current submissions of an upload folder.
+
+    unsigned() lists the submissions whose signature isn't computed yet and
+    sign() computes them in a process pool; update() takes the submission
+    index records and moves changed submissions between buckets, reading only
+    the stored signatures. pairs() lists the candidate pairs above a
+    similarity threshold.
+    """
+
+    def __init__(self, upload_folder, remote=None):
+        self.upload_folder = upload_folder
+        self.store = SignatureStore(upload_folder)
+        # with submissions in an object store, `remote` is its ObjectBlobStore
+        self.remote = remote
+        self.blobs = remote or BlobStore(upload_folder)
+        self.pending = 0        # submissions of the last update() still without a signature
+        self._items = {}        # (teacher, filename) -> (sha256, record, signature)
+        self._buckets = {}      # (band, rows) -> set of keys
+        self._lock = threading.Lock()
+
+    def _bands(self, signature):
+        for band in range(BANDS):
+            yield band, tuple(signature[band * ROWS:(band + 1) * ROWS])
+
+    def _remove(self, key):
+        _, _, signature = self._items.pop(key)
+        for bucket in self._bands(signature):
+            members = self._buckets.get(bucket)
+            if members is not None:
+                members.discard(key)
+                if not members:
+                    del self._buckets[bucket]
+
+    def _current(self, records):
+        """{(teacher, filename): (sha256, record, path)} for `records`; call with the lock held."""
+        current = {}
+        for r in records:
+            key = (r['teacher'], r['filename'])
+            sha256 = r.get('sha256')
+            if self.remote is not None:
+                # objects committed by the upload servers always carry their SHA-256
+                if sha256:
+                    current[key] = (sha256, r, self.remote.submission_key(r['teacher'], r['filename']))
+                continue
+            path = submission_path(self.upload_folder, r['teacher'], r['filename'])
+            if not sha256:
+                # a file copied in by hand: hash it once, then it's cached like any other
+                known = self._items.get(key)
+                try:
+                    sha256 = known[0] if known and known[1]['timestamp'] == r['timestamp'] else _file_sha256(path)
+                except OSError:
+                    continue
+            current[key] = (sha256, r, path)
+        return current
+
+    def unsigned(self, records):
+        """[(sha256, storage, key)] of the contents in `records` without a stored signature, each once."""
+        with self._lock:
+            current = self._current(records)
+            missing = {}
+            for key, (sha256, r, path) in current.items():
+                if sha256 in missing or key in self._items or self.store.get(sha256) is not None:
+                    continue
+                storage, blob = self.blobs.locate(sha256)
+                if storage.exists(blob):
+                    missing[sha256] = (storage, blob)
+                else:
+                    # no blob (a file copied in by hand): read the submission itself
+                    missing[sha256] = (self.remote.storage if self.remote is not None else None, path)
+            return [(sha256, storage, key) for sha256, (storage, key) in missing.items()]
+
+    def sign(self, jobs, pool):
+        """Compute and store the signatures of unsigned() `jobs` with `pool`."""
+        signatures = pool.map(compute_signature, [key for _, _, key in jobs], [storage for _, storage, _ in jobs])
+        for (sha256, _, _), packed in zip(jobs, signatures):
+            self.store.put(sha256, packed)
+
+    def update(self, records):
+        with self._lock:
+            current = self._current(records)
+            for key in [k for k in self._items if k not in current or self._items[k][0] != current[k][0]]:
+                self._remove(key)
+
+            pending = 0
+            for key, (sha256, r, path) in current.items():
+                if key in self._items:
+                    continue
+                signature = self.store.get(sha256)
+                if signature is None:
+                    pending += 1
+                    continue
+                self._items[key] = (sha256, r, signature)
+                if signature:
+                    for bucket in self._bands(signature):
+                        self._buckets.setdefault(bucket, set()).add(key)
+            self.pending = pending
+
+    def pairs(self, threshold=0.5):
+        """[(similarity, record_a, record_b)] for candidate pairs at or above `threshold`, most similar first."""
+        with self._lock:
+            candidates = set()
+            for members in self._buckets.values():
+                if len(members) > 1:
+                    candidates.update(combinations(sorted(members), 2))
+
+            result = []
+            for a, b in candidates:
+                _, record_a, sig_a = self._items[a]
+                _, record_b, sig_b = self._items[b]
+                if record_a['student_id'] and record_a['student_id'] == record_b['student_id']:
+                    # the same student in two channels/sessions
+                    continue
+                score = similarity(sig_a, sig_b)
+                if score >= threshold:
+                    result.append((score, record_a, record_b))
+        result.sort(key=lambda p: (-p[0], p[1]['filename'], p[2]['filename']))
+        return result
+
+
+class Signer(threading.Thread):
+    """Daemon thread signing the submissions of an index as they arrive and keeping a SimilarityIndex up to date."""
+
+    def __init__(self, index, similarity, workers=1, interval=2.0):
+        super().__init__(daemon=True, name='sce-unina-signer')
+        self.index = index
+        self.similarity = similarity
+        self.workers = workers
+        self.interval = interval
+        self._pool = None
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Stop signing; a batch already running finishes and is stored."""
+        self._stopping.set()
+
+    def run(self):
+        version = None
+        while not self._stopping.is_set():
+            try:
+                current = self.index.version()
+                if current != version or self.similarity.pending:
+                    self.dispatch()
+                    version = current
+            except Exception:
+                log.exception("similarity signing failed")
+            self._stopping.wait(self.interval)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def dispatch(self):
+        records = self.index.query('teacher', 'asc')
+        jobs = self.similarity.unsigned(records)
+        if jobs:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            try:
+                self.similarity.sign(jobs, self._pool)
+            except BrokenProcessPool:
+                # a worker died (e.g. out of memory): start over with a fresh pool next round
+                self._pool.shutdown(wait=False)
+                self._pool = None
+                raise
+        self.similarity.update(records)
+
+
+if __name__ == '__main__':
+    from sce_unina_index import SubmissionIndex
+
+    parser = argparse.ArgumentParser(description='SCE-Unina similarity report')
+    parser.add_argument('--upload-folder', type=str, default='uploads', help='Folder where the upload server stores files')
+    parser.add_argument('--session', type=str, default=None, help='Exam session (default: the active one)')
+    parser.add_argument('--threshold', type=float, default=0.5, help='Minimum estimated similarity to report (0-1)')
+    parser.add_argument('--workers', type=int, default=None, help='Processes computing signatures')
+    args = parser.parse_args()
+
+    folder = session_folder(args.upload_folder, args.session)
+    index = SubmissionIndex(folder)
+    index.rebuild()
+    records = index.query('teacher', 'asc')
+    engine = SimilarityIndex(folder)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        engine.sign(engine.unsigned(records), pool)
+    engine.update(records)
+    for score, a, b in engine.pairs(args.threshold):
+        print(f"{score:6.1%}  {a['teacher']}/{a['filename']}  {b['teacher']}/{b['filename']}")
+    sys.exit(0)
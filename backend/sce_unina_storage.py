@@ -0,0 +1,425 @@
+"""
+Storage backends for submissions.
+
+By default submissions live in the upload folder on the local disk. With
+`--storage s3://bucket/prefix` the upload servers commit them to an
+S3-compatible object store (AWS S3, MinIO, Ceph...) instead, so that several
+upload front-ends can share it; the dashboard then lists the store to build
+its index and reads archives with ranged GETs. Local state (the SQLite index,
+validation results, similarity signatures, in-progress uploads) stays in the
+upload folder of each node.
+
+Both backends address content by key ('<session>/<channel>/<filename>',
+'<session>/.blobs/<aa>/<sha256>'...) and offer the same small interface:
+stat, open (a seekable file object), get_range, put_file, put_bytes, list and
+prefixes (one level of a key prefix, like a directory), copy and delete.
+LocalStorage('') uses plain paths as keys, which is how the rest of the code
+reads local files through the same interface.
+
+The S3 backend needs boto3 (`pip install boto3`); it is only imported when an
+s3:// storage is configured. Any S3-compatible server works, e.g. for tests:
+
+    moto_server -p 9000
+    python sce_unina_server.py --storage 's3://sce-unina?endpoint_url=http://127.0.0.1:9000'
+"""
+
+import io
+import os
+import time
+import secrets
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs, quote
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+ObjectInfo = namedtuple('ObjectInfo', 'key size mtime etag sha256')
+
+# Pointer to the active session, at the root of the store
+SESSION_KEY = '.current-session'
+
+# Multipart uploads are sent in parts of this size (S3 requires at least 5 MiB but for the last one)
+PART_SIZE = 8 * 1024 * 1024
+# Ranged reads of an object fetch at least this much
+READAHEAD = 256 * 1024
+# Lifetime of presigned download URLs, in seconds
+URL_EXPIRY = 300
+
+
+class StorageError(OSError):
+    """A storage backend failed (I/O error, object store unreachable...)."""
+
+
+class ObjectNotFound(StorageError, FileNotFoundError):
+    """No object with that key."""
+
+
+class LocalStorage:
+    """Keys are paths relative to `root` (or plain paths when root is '')."""
+
+    remote = False
+
+    def __init__(self, root=''):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key) if self.root else key
+
+    def stat(self, key):
+        try:
+            st = os.stat(self.path(key))
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+        return ObjectInfo(key, st.st_size, st.st_mtime, f'{st.st_mtime_ns:x}-{st.st_size:x}', None)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def open(self, key):
+        try:
+            return open(self.path(key), 'rb')
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+
+    def get_range(self, key, start, stop):
+        with self.open(key) as f:
+            f.seek(start)
+            return f.read(stop - start)
+
+    def get_bytes(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    def put_file(self, key, path, metadata=None):
+        """Move the file at `path` to `key` (same filesystem)."""
+        dest = self.path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+
+    def put_bytes(self, key, data, metadata=None):
+        dest = self.path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = f'{dest}.{secrets.token_hex(4)}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, dest)
+
+    def list(self, prefix):
+        """Objects directly under `prefix` (which ends with '/'), not in its sub-prefixes."""
+        try:
+            with os.scandir(self.path(prefix)) as it:
+                entries = [(e.name, e.stat()) for e in it if e.is_file()]
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        return [ObjectInfo(prefix + name, st.st_size, st.st_mtime, f'{st.st_mtime_ns:x}-{st.st_size:x}', None)
+                for name, st in sorted(entries)]
+
+    def prefixes(self, prefix):
+        """Names of the sub-prefixes ("folders") directly under `prefix`."""
+        try:
+            with os.scandir(self.path(prefix)) as it:
+                return sorted(e.name for e in it if e.is_dir())
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    def copy(self, src, dst, metadata=None):
+        dest = self.path(dst)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = f'{dest}.{secrets.token_hex(4)}.tmp'
+        os.link(self.path(src), tmp)
+        os.replace(tmp, dest)
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key, download_name=None):
+        """A URL clients can download `key` from directly, or None (local files are served by the apps)."""
+        return None
+
+
+class S3Storage:
+    """An S3-compatible bucket, all keys under `prefix`."""
+
+    remote = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None):
+        if boto3 is None:
+            raise RuntimeError("The S3 storage backend needs boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # clients can't be pickled: worker processes make their own
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None or self._local.pid != os.getpid():
+            session = boto3.session.Session()
+            client = session.client('s3', endpoint_url=self.endpoint_url, region_name=self.region,
+                                    config=Config(retries={'max_attempts': 5, 'mode': 'standard'}))
+            self._local.client = client
+            self._local.pid = os.getpid()
+        return client
+
+    def _call(self, key, method, **kwargs):
+        try:
+            return getattr(self.client, method)(Bucket=self.bucket, **kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                raise ObjectNotFound(key)
+            raise StorageError(f"{method} {key}: {e}")
+        except Exception as e:
+            # connection errors and the like
+            raise StorageError(f"{method} {key}: {e}")
+
+    def stat(self, key):
+        head = self._call(key, 'head_object', Key=self.prefix + key)
+        return ObjectInfo(key, head['ContentLength'], head['LastModified'].timestamp(),
+                          head['ETag'].strip('"'), head.get('Metadata', {}).get('sha256'))
+
+    def exists(self, key):
+        try:
+            self.stat(key)
+            return True
+        except ObjectNotFound:
+            return False
+
+    def open(self, key):
+        info = self.stat(key)
+        return io.BufferedReader(RangeReader(self, key, info.size, info.etag), READAHEAD)
+
+    def get_range(self, key, start, stop, etag=None):
+        if stop <= start:
+            return b''
+        kwargs = {'IfMatch': etag} if etag else {}
+        body = self._call(key, 'get_object', Key=self.prefix + key, Range=f'bytes={start}-{stop - 1}', **kwargs)['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def get_bytes(self, key):
+        body = self._call(key, 'get_object', Key=self.prefix + key)['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def put_file(self, key, path, metadata=None):
+        """
+        Upload the file at `path` (then delete it). Large files go as a
+        multipart upload, one PART_SIZE part in memory at a time.
+        """
+        extra = {'Metadata': metadata} if metadata else {}
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if size <= PART_SIZE:
+                self._call(key, 'put_object', Key=self.prefix + key, Body=f.read(), **extra)
+            else:
+                upload_id = self._call(key, 'create_multipart_upload', Key=self.prefix + key, **extra)['UploadId']
+                try:
+                    parts = []
+                    for number, chunk in enumerate(iter(lambda: f.read(PART_SIZE), b''), 1):
+                        part = self._call(key, 'upload_part', Key=self.prefix + key, UploadId=upload_id,
+                                          PartNumber=number, Body=chunk)
+                        parts.append({'PartNumber': number, 'ETag': part['ETag']})
+                    self._call(key, 'complete_multipart_upload', Key=self.prefix + key, UploadId=upload_id,
+                               MultipartUpload={'Parts': parts})
+                except BaseException:
+                    try:
+                        self._call(key, 'abort_multipart_upload', Key=self.prefix + key, UploadId=upload_id)
+                    except StorageError:
+                        pass
+                    raise
+        os.unlink(path)
+
+    def put_bytes(self, key, data, metadata=None):
+        extra = {'Metadata': metadata} if metadata else {}
+        self._call(key, 'put_object', Key=self.prefix + key, Body=data, **extra)
+
+    def _pages(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        try:
+            yield from paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix, Delimiter='/')
+        except ClientError as e:
+            raise StorageError(f"list {prefix}: {e}")
+
+    def list(self, prefix):
+        skip = len(self.prefix)
+        return [ObjectInfo(obj['Key'][skip:], obj['Size'], obj['LastModified'].timestamp(), obj['ETag'].strip('"'), None)
+                for page in self._pages(prefix) for obj in page.get('Contents', ())]
+
+    def prefixes(self, prefix):
+        skip = len(self.prefix + prefix)
+        return [p['Prefix'][skip:].rstrip('/') for page in self._pages(prefix) for p in page.get('CommonPrefixes', ())]
+
+    def copy(self, src, dst, metadata=None):
+        """Server-side copy: no bytes go through this process. `metadata` replaces the source's."""
+        extra = {'Metadata': metadata, 'MetadataDirective': 'REPLACE'} if metadata else {}
+        self._call(src, 'copy_object', Key=self.prefix + dst,
+                   CopySource={'Bucket': self.bucket, 'Key': self.prefix + src}, **extra)
+
+    def delete(self, key):
+        self._call(key, 'delete_object', Key=self.prefix + key)
+
+    def url(self, key, download_name=None):
+        params = {'Bucket': self.bucket, 'Key': self.prefix + key}
+        if download_name:
+            params['ResponseContentDisposition'] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=URL_EXPIRY)
+
+
+class RangeReader(io.RawIOBase):
+    """Read-only, seekable view of an object; every read is a ranged GET (buffered by the caller)."""
+
+    def __init__(self, storage, key, size, etag=None):
+        super().__init__()
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        stop = min(self.position + len(buffer), self.size)
+        if stop <= self.position:
+            return 0
+        # If-Match: an object replaced meanwhile fails instead of mixing two versions
+        data = self.storage.get_range(self.key, self.position, stop, self.etag)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def readall(self):
+        # one GET for the rest, instead of RawIOBase's small reads
+        data = self.storage.get_range(self.key, self.position, self.size, self.etag)
+        self.position += len(data)
+        return data
+
+
+LOCAL = LocalStorage()
+
+
+def open_storage(url):
+    """
+    Storage for a --storage URL: s3://bucket[/prefix][?endpoint_url=...&region=...].
+    Credentials come from the usual AWS environment variables or config files.
+    """
+    parts = urlsplit(url)
+    if parts.scheme != 's3' or not parts.netloc:
+        raise ValueError(f"Unsupported storage URL: {url} (expected s3://bucket/prefix)")
+    query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+    return S3Storage(parts.netloc, parts.path, query.get('endpoint_url'), query.get('region'))
+
+
+class ObjectBlobStore:
+    """
+    The BlobStore layout in an object store, for one session: blobs under
+    <session>/.blobs/, the latest version of each submission at
+    <session>/<channel>/<filename> (a server-side copy carrying its SHA-256
+    as metadata) and one small object per version under <session>/.versions/.
+    """
+
+    def __init__(self, storage, session):
+        self.storage = storage
+        self.session = session
+
+    def blob_key(self, sha256):
+        return f'{self.session}/.blobs/{sha256[:2]}/{sha256}'
+
+    def submission_key(self, channel, filename):
+        return f'{self.session}/{channel}/{filename}'
+
+    def locate(self, sha256):
+        return self.storage, self.blob_key(sha256)
+
+    def has(self, sha256):
+        return self.storage.exists(self.blob_key(sha256))
+
+    def put(self, source, sha256):
+        """Store a temporary file (deleted afterwards) or bytes under its SHA-256; returns (key, newly stored)."""
+        key = self.blob_key(sha256)
+        if self.has(sha256):
+            if isinstance(source, str):
+                os.unlink(source)
+            return key, False
+        if isinstance(source, str):
+            self.storage.put_file(key, source)
+        else:
+            self.storage.put_bytes(key, source)
+        return key, True
+
+    def publish(self, sha256, key):
+        self.storage.copy(self.blob_key(sha256), key, metadata={'sha256': sha256})
+
+    def _versions_prefix(self, channel, filename):
+        return f'{self.session}/.versions/{channel}/{filename}/'
+
+    def record_version(self, channel, filename, sha256, size, mtime=None):
+        # objects can't be appended to: one empty object per version, everything in its name
+        time_ns = time.time_ns() if mtime is None else int(mtime * 1e9)
+        self.storage.put_bytes(f'{self._versions_prefix(channel, filename)}{time_ns:020d}.{sha256}.{size}', b'')
+
+    def versions(self, channel, filename):
+        """Submitted versions of a file, oldest first (same records as BlobStore.versions)."""
+        result = []
+        prefix = self._versions_prefix(channel, filename)
+        for info in self.storage.list(prefix):
+            try:
+                time_ns, sha256, size = info.key[len(prefix):].split('.')
+                result.append({'time': int(time_ns) / 1e9, 'sha256': sha256, 'size': int(size)})
+            except ValueError:
+                continue
+        return result
+
+
+def read_session(storage):
+    """The session the upload servers are writing to, or None."""
+    try:
+        return storage.get_bytes(SESSION_KEY).decode().strip() or None
+    except ObjectNotFound:
+        return None
+
+
+def write_session(storage, name):
+    storage.put_bytes(SESSION_KEY, name.encode() + b'\n')
+
@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+"""
+Upload server and dashboard in a single process.
+
+sce_unina_server.py and sce_unina_dashboard.py normally run as two processes
+that only share the upload folder: each resolves its own (the server relative
+to the working directory, the dashboard to its source file) and the dashboard
+finds new submissions by polling the SQLite index and the disk. Here both
+Flask apps are served by one process, from one validated configuration, and
+share one in-memory SubmissionRegistry and validation queue: an upload
+updates them directly and the dashboard's pages, API and live feeds are
+answered from memory.
+
+The dashboard is mounted under --admin-prefix (default /admin) on the upload
+port, or at the root of its own --dashboard-port:
+
+    python sce_unina_unified.py --file traccia.pdf --upload-folder uploads
+    python sce_unina_unified.py --file traccia.pdf --port 5001 --dashboard-port 5002
+
+Prefork workers can't share memory: use the two servers for that.
+"""
+
+import os
+import logging
+import argparse
+import threading
+
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.serving import make_server
+
+import sce_unina_server as server
+import sce_unina_dashboard as dashboard
+from sce_unina_admission import Admission
+from sce_unina_grading import load_recipes
+from sce_unina_durability import Durability, MODES as DURABILITY_MODES
+from sce_unina_sendfile import FileSender, MODES as FILE_DELIVERY_MODES
+from sce_unina_sessions import start_session, unmigrated
+from sce_unina_storage import StorageError, open_storage, write_session
+
+log = logging.getLogger(__name__)
+
+# First path segments taken by the upload server's routes: the dashboard can't be mounted there
+UPLOAD_ROUTES = {'upload', 'get_exam', 'metrics'}
+
+
+def check_config(args):
+    """Everything wrong with the command line, as a list of messages (empty if it can be served)."""
+    errors = []
+    if not os.path.isfile(args.file) or not os.access(args.file, os.R_OK):
+        errors.append(f"Exam file {args.file} doesn't exist or can't be read")
+    if os.path.exists(args.upload_folder) and not os.path.isdir(args.upload_folder):
+        errors.append(f"Upload folder {args.upload_folder} is not a folder")
+    elif os.path.isdir(args.upload_folder) and not os.access(args.upload_folder, os.W_OK | os.X_OK):
+        errors.append(f"Upload folder {args.upload_folder} is not writable")
+    if args.dashboard_port is not None:
+        if args.dashboard_port == args.port:
+            errors.append("--dashboard-port must differ from --port (leave it out to serve both on one port)")
+    else:
+        prefix = args.admin_prefix
+        if not prefix.startswith('/') or prefix.endswith('/') or '//' in prefix:
+            errors.append(f"Invalid --admin-prefix {prefix!r}: it must look like /admin")
+        elif prefix.split('/')[1] in UPLOAD_ROUTES:
+            errors.append(f"--admin-prefix {prefix!r} would hide the upload server's /{prefix.split('/')[1]}")
+    if args.max_upload_size <= 0:
+        errors.append("--max-upload-size must be positive")
+    if args.validate_workers < 0:
+        errors.append("--validate-workers can't be negative")
+    if args.grade_workers < 0:
+        errors.append("--grade-workers can't be negative")
+    try:
+        load_recipes(args.recipes)
+    except ValueError as e:
+        errors.append(str(e))
+    return errors
+
+
+def configure(args):
+    """Set up both modules' globals from `args`; returns the shared registry. Raises ValueError on bad settings."""
+    upload_folder = os.path.abspath(args.upload_folder)
+    storage = None
+    try:
+        folder = start_session(upload_folder, args.session, args.fanout)
+        if args.storage:
+            storage = open_storage(args.storage)
+            write_session(storage, os.path.basename(folder))
+    except (RuntimeError, StorageError) as e:
+        raise ValueError(str(e)) from e
+    if unmigrated(upload_folder):
+        log.warning("%s still has channels outside any session, the dashboard won't show them: "
+                    "move them with `python sce_unina_sessions.py --upload-folder %s migrate --session NAME`",
+                    upload_folder, upload_folder)
+
+    server.FILE_PATH = os.path.abspath(args.file)
+    server.UPLOAD_FOLDER = folder
+    server.STORAGE = storage
+    server.app.config['MAX_CONTENT_LENGTH'] = args.max_upload_size * 1024 * 1024
+    server.UPLOAD_ADMISSION = Admission(args.max_concurrent_uploads, args.upload_queue,
+                                        args.upload_queue_timeout, args.max_uploads_per_client)
+    server.FILE_SENDER = FileSender(args.file_delivery, args.accel_prefix)
+    server.DURABILITY = Durability(args.durability, args.group_commit_interval / 1000)
+    server.METRICS.slow_threshold = args.slow_request_threshold
+    server.EXAM_CACHE.gzip_enabled = args.gzip_exam
+
+    # the dashboard shows exactly the session uploads go to
+    dashboard.UPLOAD_FOLDER = upload_folder
+    dashboard.SESSION = os.path.basename(folder)
+    dashboard.STORAGE = storage
+    dashboard.FILE_SENDER = server.FILE_SENDER
+    dashboard.VALIDATE_WORKERS = args.validate_workers
+    dashboard.RECIPES = load_recipes(args.recipes) if args.recipes is not None else None
+    dashboard.GRADE_WORKERS = args.grade_workers
+    dashboard.METRICS.slow_threshold = args.slow_request_threshold
+    dashboard.IN_MEMORY_INDEX = True
+
+    # one registry: loaded (and reconciled with the disk) here, then updated by every upload
+    server.SUBMISSIONS = dashboard.submission_index()
+    server.VALIDATION = dashboard.validation_queue()
+    return server.SUBMISSIONS
+
+
+def serve(args):
+    if args.dashboard_port is None:
+        app = DispatcherMiddleware(server.app, {args.admin_prefix: dashboard.app})
+        log.info("Uploads on http://%s:%d/, dashboard on http://%s:%d%s/dashboard",
+                 args.host, args.port, args.host, args.port, args.admin_prefix)
+    else:
+        app = server.app
+        admin = make_server(args.host, args.dashboard_port, dashboard.app, threaded=True)
+        threading.Thread(target=admin.serve_forever, name='sce-unina-dashboard', daemon=True).start()
+        log.info("Uploads on http://%s:%d/, dashboard on http://%s:%d/dashboard",
+                 args.host, args.port, args.host, args.dashboard_port)
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCE-Unina upload server and dashboard in one process')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Host IP address')
+    parser.add_argument('--port', type=int, default=5001, help='Port of the upload server (and of the dashboard, under --admin-prefix)')
+    parser.add_argument('--dashboard-port', type=int, default=None,
+                        help='Serve the dashboard at the root of this port instead of under --admin-prefix')
+    parser.add_argument('--admin-prefix', type=str, default='/admin', help='Path the dashboard is mounted at on the upload port')
+    parser.add_argument('--file', type=str, default='traccia.pdf', help='Path to exam file')
+    parser.add_argument('--upload-folder', type=str, default='uploads', help='Folder to store uploaded files')
+    parser.add_argument('--session', type=str, default=None,
+                        help='Exam session the uploads go to, a folder inside the upload folder (default: today\'s date)')
+    parser.add_argument('--fanout', type=int, default=0,
+                        help='Hex digits of the filename hash used as sub-folder of each channel, for new sessions (0 = none)')
+    parser.add_argument('--storage', type=str, default=None,
+                        help='Commit submissions to a shared object store, s3://bucket/prefix[?endpoint_url=URL] (default: the upload folder)')
+    parser.add_argument('--max-upload-size', type=int, default=200, help='Maximum size of an upload request in MB')
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default='none',
+                        help="When an upload is answered: 'none' right away, 'file' after flushing it to disk, "
+                             "'group' after flushing it with the uploads of the same few milliseconds")
+    parser.add_argument('--group-commit-interval', type=float, default=5.0,
+                        help='Milliseconds the group committer waits for more uploads before flushing (durability group)')
+    parser.add_argument('--gzip-exam', action='store_true', help='Also keep a gzip-compressed copy of the exam file for clients that accept it')
+    parser.add_argument('--file-delivery', choices=FILE_DELIVERY_MODES, default='python',
+                        help="How the exam and downloads are sent: 'sendfile' from the page cache, or headers for a front proxy (nginx, Apache)")
+    parser.add_argument('--accel-prefix', type=str, default='/_sce_files/',
+                        help='Internal nginx location serving absolute paths (x-accel-redirect mode)')
+    parser.add_argument('--validate-workers', type=int, default=dashboard.VALIDATE_WORKERS,
+                        help='Processes validating new submissions in the background (0 = none)')
+    parser.add_argument('--recipes', type=str, default=None,
+                        help='JSON file with the build and test recipe of each channel (see sce_unina_grading.py)')
+    parser.add_argument('--grade-workers', type=int, default=dashboard.GRADE_WORKERS,
+                        help='Processes building and testing new submissions in the background (0 = none)')
+    parser.add_argument('--slow-request-threshold', type=float, default=2.0, help='Log requests taking longer than this many seconds')
+    parser.add_argument('--max-concurrent-uploads', type=int, default=server.UPLOAD_ADMISSION.max_active,
+                        help='Uploads written to disk at the same time (0 = no admission control)')
+    parser.add_argument('--upload-queue', type=int, default=server.UPLOAD_ADMISSION.max_queued,
+                        help='Uploads allowed to wait for a slot before new ones get 503')
+    parser.add_argument('--upload-queue-timeout', type=float, default=server.UPLOAD_ADMISSION.queue_timeout,
+                        help='Seconds an upload may wait for a slot before getting 503')
+    parser.add_argument('--max-uploads-per-client', type=int, default=server.UPLOAD_ADMISSION.per_client,
+                        help='Concurrent uploads allowed from one IP address, 0 = unlimited')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    errors = check_config(args)
+    if errors:
+        parser.error('\n  '.join(errors))
+    try:
+        registry = configure(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    server.gc_resumable_uploads(force=True)
+    repaired = server.replay_journal()
+    if repaired:
+        log.warning("recovered %d submissions from the journal after an unclean shutdown", repaired)
+    server.EXAM_CACHE.get(server.FILE_PATH)
+    log.info("Session %s: %d submissions", dashboard.SESSION, registry.count())
+
+    try:
+        serve(args)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,353 @@
+#! /usr/bin/env python3
+"""
+Background validation of committed submissions.
+
+The upload server only drops a job file in <upload folder>/.validation/queue/
+for every newly committed content (keyed by its SHA-256), so validation never
+adds latency to an upload. A Validator (run by the dashboard, or standalone
+with `python sce_unina_validation.py`) picks jobs up, checks the blob in a
+process pool and writes the outcome to .validation/results/<aa>/<sha256>.json:
+
+- every member is read back and its CRC-32 verified;
+- declared sizes are checked against a total size and compression ratio
+  limit first, so a zip bomb is rejected without being decompressed;
+- the archive must contain at least one source file.
+
+Jobs are claimed by renaming them into .validation/running/; claims left
+behind by a process that died are put back in the queue on the next start, so
+jobs survive restarts. Results depend only on content, so identical
+resubmissions are validated once.
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import logging
+import zipfile
+import argparse
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sce_unina_blobs import BlobStore
+from sce_unina_sessions import session_folder
+
+log = logging.getLogger(__name__)
+
+VALIDATION_DIR = '.validation'
+
+# Extensions counted as source files (same list as the DEUS upload form), plus Makefiles
+SOURCE_EXTENSIONS = {'.py', '.java', '.c', '.cpp', '.m', '.h', '.makefile'}
+
+# Zip bomb guards, checked on the sizes declared in the central directory
+MAX_MEMBERS = 10000
+MAX_UNCOMPRESSED_SIZE = 512 * 1024 * 1024
+MAX_COMPRESSION_RATIO = 100
+# Members smaller than this are not subject to the ratio check (tiny files compress very well)
+RATIO_MIN_SIZE = 1024 * 1024
+
+READ_SIZE = 1024 * 1024
+
+
+def validate_zip(path, storage=None):
+    """
+    Check the zip at `path` (a key of `storage`, if given); returns a
+    JSON-friendly dict with 'status' ('ok', 'warning' or 'error'), 'problems'
+    and some statistics. Runs in a worker process.
+    """
+    errors, warnings = [], []
+    result = {'checked': time.time(), 'members': 0, 'sources': 0, 'uncompressed_size': 0, 'ratio': 0.0}
+
+    def finish():
+        result['status'] = 'error' if errors else 'warning' if warnings else 'ok'
+        result['problems'] = errors + warnings
+        return result
+
+    try:
+        source = path if storage is None else storage.open(path)
+        zf = zipfile.ZipFile(source)
+    except (zipfile.BadZipFile, OSError) as e:
+        errors.append(f"Not a valid zip archive ({e})")
+        return finish()
+
+    with zf, (contextlib.nullcontext() if storage is None else source):
+        infos = [i for i in zf.infolist() if not i.is_dir()]
+        total = sum(i.file_size for i in infos)
+        compressed = sum(i.compress_size for i in infos)
+        result.update(members=len(infos), uncompressed_size=total,
+                      ratio=round(total / compressed, 1) if compressed else 0.0)
+
+        if not infos:
+            errors.append("Empty archive")
+            return finish()
+        if len(infos) > MAX_MEMBERS:
+            errors.append(f"Too many files ({len(infos)})")
+            return finish()
+        if total > MAX_UNCOMPRESSED_SIZE:
+            errors.append(f"Uncompressed size too large ({total} bytes), possible zip bomb")
+            return finish()
+        for info in infos:
+            if info.file_size >= RATIO_MIN_SIZE and info.file_size > MAX_COMPRESSION_RATIO * max(info.compress_size, 1):
+                errors.append(f"{info.filename}: compression ratio too high, possible zip bomb")
+                return finish()
+
+        # sizes are sane: reading every member back is bounded, and verifies its CRC-32
+        for info in infos:
+            try:
+                with zf.open(info) as f:
+                    while f.read(READ_SIZE):
+                        pass
+            except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+                errors.append(f"{info.filename}: corrupt ({e})")
+            except (NotImplementedError, RuntimeError) as e:
+                # unsupported compression method or encrypted member
+                errors.append(f"{info.filename}: unreadable ({e})")
+
+        names = [i.filename for i in infos]
+        unsafe = [n for n in names if n.startswith('/') or '..' in n.replace('\\', '/').split('/')]
+        if unsafe:
+            warnings.append(f"Unsafe paths in archive: {', '.join(unsafe[:5])}")
+
+        sources = [n for n in names if os.path.splitext(n)[1].lower() in SOURCE_EXTENSIONS
+                   or os.path.basename(n).lower() == 'makefile']
+        result['sources'] = len(sources)
+        if not sources:
+            warnings.append("No source files")
+
+    return finish()
+
+
+class ValidationQueue:
+    """
+    The on-disk job queue and results of one upload folder.
+
+    An `exclusive` queue belongs to the only process queueing and validating
+    the folder's submissions (sce_unina_unified.py): it reads every result
+    once and then answers status() from memory.
+    """
+
+    def __init__(self, upload_folder, exclusive=False):
+        self.upload_folder = upload_folder
+        self.root = os.path.join(upload_folder, VALIDATION_DIR)
+        self.queue_dir = os.path.join(self.root, 'queue')
+        self.running_dir = os.path.join(self.root, 'running')
+        self.results_dir = os.path.join(self.root, 'results')
+        self._results = {}      # sha256 -> result, results never change once written
+        self.exclusive = exclusive
+        self._pending = set()
+        if exclusive:
+            self._load()
+
+    def _load(self):
+        try:
+            prefixes = os.listdir(self.results_dir)
+        except FileNotFoundError:
+            prefixes = []
+        for prefix in prefixes:
+            for name in os.listdir(os.path.join(self.results_dir, prefix)):
+                if name.endswith('.json'):
+                    self._read(name[:-len('.json')])
+        self._pending.update(self.pending())
+        try:
+            self._pending.update(name.partition('.')[0] for name in os.listdir(self.running_dir))
+        except FileNotFoundError:
+            pass
+
+    def result_path(self, sha256):
+        return os.path.join(self.results_dir, sha256[:2], sha256 + '.json')
+
+    def enqueue(self, sha256):
+        """Queue `sha256` for validation, unless it already has a result."""
+        if sha256 in self._results if self.exclusive else os.path.exists(self.result_path(sha256)):
+            return
+        self._pending.add(sha256)
+        os.makedirs(self.queue_dir, exist_ok=True)
+        # creating an empty file is atomic, and idempotent for resubmissions
+        open(os.path.join(self.queue_dir, sha256), 'a').close()
+
+    def pending(self):
+        try:
+            return sorted(os.listdir(self.queue_dir))
+        except FileNotFoundError:
+            return []
+
+    def claim(self, sha256):
+        """Move a queued job to running/; False if another process took it first."""
+        os.makedirs(self.running_dir, exist_ok=True)
+        try:
+            os.rename(os.path.join(self.queue_dir, sha256),
+                      os.path.join(self.running_dir, f'{sha256}.{os.getpid()}'))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def release(self, sha256):
+        os.unlink(os.path.join(self.running_dir, f'{sha256}.{os.getpid()}'))
+        self._pending.discard(sha256)
+
+    def is_pending(self, sha256):
+        if self.exclusive:
+            return sha256 in self._pending
+        if os.path.exists(os.path.join(self.queue_dir, sha256)):
+            return True
+        try:
+            return any(name.startswith(sha256 + '.') for name in os.listdir(self.running_dir))
+        except FileNotFoundError:
+            return False
+
+    def recover(self):
+        """Put back in the queue the jobs claimed by processes that are gone."""
+        try:
+            names = os.listdir(self.running_dir)
+        except FileNotFoundError:
+            return
+        os.makedirs(self.queue_dir, exist_ok=True)
+        for name in names:
+            sha256, _, pid = name.partition('.')
+            if pid.isdigit() and _alive(int(pid)):
+                continue
+            try:
+                os.replace(os.path.join(self.running_dir, name), os.path.join(self.queue_dir, sha256))
+            except FileNotFoundError:
+                pass
+
+    def store(self, sha256, result):
+        path = self.result_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp, path)
+        self._results[sha256] = result
+
+    def _read(self, sha256):
+        try:
+            with open(self.result_path(sha256)) as f:
+                result = self._results[sha256] = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def result(self, sha256):
+        """The validation result of `sha256`, or None if it hasn't been validated (yet)."""
+        result = self._results.get(sha256)
+        if result is None and not self.exclusive:
+            result = self._read(sha256)
+        return result
+
+    def status(self, sha256):
+        """Summary for display: {'status': ..., 'problems': [...]}, status 'pending' or 'unknown' if no result."""
+        if not sha256:
+            return {'status': 'unknown', 'problems': []}
+        result = self.result(sha256)
+        if result is not None:
+            return {'status': result['status'], 'problems': result['problems']}
+        return {'status': 'pending' if self.is_pending(sha256) else 'unknown', 'problems': []}
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Validator(threading.Thread):
+    """Daemon thread feeding queued jobs to a process pool, `workers` at a time."""
+
+    def __init__(self, queue, workers=2, interval=1.0, blobs=None):
+        super().__init__(daemon=True, name='sce-unina-validator')
+        self.queue = queue
+        self.workers = workers
+        self.interval = interval
+        # the blobs to check: the upload folder's, or an ObjectBlobStore
+        self.blobs = blobs or BlobStore(queue.upload_folder)
+        self._slots = threading.BoundedSemaphore(workers)
+        self._pool = None
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Stop taking new jobs; the ones already running finish and store their result."""
+        self._stopping.set()
+
+    def run(self):
+        self.queue.recover()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        while not self._stopping.is_set():
+            try:
+                self.dispatch()
+            except Exception:
+                log.exception("validation dispatch failed")
+            self._stopping.wait(self.interval)
+        self._pool.shutdown(wait=False)
+
+    def dispatch(self):
+        for sha256 in self.queue.pending():
+            if not self._slots.acquire(blocking=False):
+                return
+            if not self.queue.claim(sha256):
+                self._slots.release()
+                continue
+            storage, key = self.blobs.locate(sha256)
+            if not storage.exists(key):
+                # nothing left to validate
+                self.queue.release(sha256)
+                self._slots.release()
+                continue
+            try:
+                future = self._pool.submit(validate_zip, key, storage)
+            except BrokenProcessPool:
+                # a worker died and took the pool with it: only this thread replaces it
+                self._pool.shutdown(wait=False)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                future = self._pool.submit(validate_zip, key, storage)
+            future.add_done_callback(lambda f, sha256=sha256: self._done(sha256, f))
+
+    def _done(self, sha256, future):
+        try:
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                # a worker died (e.g. out of memory): don't retry that content forever
+                result = {'checked': time.time(), 'status': 'error', 'problems': [f"Validation crashed ({e})"]}
+            except Exception as e:
+                result = {'checked': time.time(), 'status': 'error', 'problems': [f"Validation failed ({e})"]}
+            self.queue.store(sha256, result)
+            self.queue.release(sha256)
+        except OSError:
+            log.exception("could not store the validation result of %s", sha256)
+        finally:
+            self._slots.release()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCE-Unina submission validator')
+    parser.add_argument('--upload-folder', type=str, default='uploads', help='Folder where the upload server stores files')
+    parser.add_argument('--session', type=str, default=None, help='Exam session (default: the active one)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Validation processes')
+    parser.add_argument('--all', action='store_true',
+                        help='Also queue every stored submission that has no result yet, then keep running')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    folder = session_folder(args.upload_folder, args.session)
+    queue = ValidationQueue(folder)
+    if args.all:
+        blobs_root = BlobStore(folder).root
+        for prefix in os.listdir(blobs_root) if os.path.isdir(blobs_root) else []:
+            if len(prefix) == 2:
+                for sha256 in os.listdir(os.path.join(blobs_root, prefix)):
+                    queue.enqueue(sha256)
+
+    validator = Validator(queue, args.workers)
+    validator.start()
+    try:
+        validator.join()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,133 @@
+"""
+Random-access reading of submitted zips, for browsing them in the dashboard.
+
+listing(path) parses only the archive's central directory (the end of the
+file) and caches the result keyed by (path, mtime, size), so browsing a large
+submission again costs no disk reads at all. read_member() then seeks straight
+to one member's local header and reads just that member's bytes: the rest of
+the archive is never touched.
+
+Both also take an optional storage (see sce_unina_storage.py) for archives
+in an object store, `path` being then the object's key: the same reads are
+done as ranged GETs and listings are cached by the object's ETag.
+"""
+
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict, namedtuple
+
+# Listings kept in memory (least recently used ones are dropped first)
+CACHE_SIZE = 256
+
+Member = namedtuple('Member', 'name size compress_size method offset crc flags is_dir date_time')
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class MemberError(Exception):
+    """A member that can't be shown (too large, encrypted, corrupt...)."""
+
+
+class MemberNotFound(MemberError):
+    """No such file in the archive."""
+
+
+def _key(st, path):
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def _stat_key(path, storage):
+    if storage is None:
+        return _key(os.stat(path), path)
+    info = storage.stat(path)
+    return (path, info.etag, info.size)
+
+
+def _open(path, storage):
+    return open(path, 'rb') if storage is None else storage.open(path)
+
+
+def listing(path, storage=None):
+    """
+    Members of the zip at `path` as a {name: Member} dict, in archive order.
+    Raises zipfile.BadZipFile if it isn't a zip, OSError if it can't be read.
+    """
+    return _listing(path, storage)[1]
+
+
+def _listing(path, storage=None):
+    key = _stat_key(path, storage)
+    with _cache_lock:
+        members = _cache.get(key)
+        if members is not None:
+            _cache.move_to_end(key)
+            return key, members
+
+    # ZipFile only reads the end-of-central-directory record and the central directory
+    with _open(path, storage) as f, zipfile.ZipFile(f) as zf:
+        members = {
+            info.filename: Member(info.filename, info.file_size, info.compress_size, info.compress_type,
+                                  info.header_offset, info.CRC, info.flag_bits, info.is_dir(), info.date_time)
+            for info in zf.infolist()
+        }
+
+    with _cache_lock:
+        _cache[key] = members
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return key, members
+
+
+def read_member(path, name, max_size, storage=None):
+    """
+    Uncompressed content of member `name`, read with a single seek. Members
+    larger than `max_size` bytes are refused.
+    """
+    for _ in range(3):
+        key, members = _listing(path, storage)
+        member = members.get(name)
+        if member is None or member.is_dir:
+            raise MemberNotFound("No such file in the archive")
+        if member.size > max_size:
+            raise MemberError("File too large to preview")
+        if member.flags & 0x1:
+            raise MemberError("File is encrypted")
+        if member.method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # rare in submissions: let zipfile deal with bzip2/lzma
+            with _open(path, storage) as f, zipfile.ZipFile(f) as zf:
+                return zf.read(name)
+
+        with _open(path, storage) as f:
+            current = _key(os.fstat(f.fileno()), path) if storage is None else _stat_key(path, storage)
+            if current != key:
+                # a new version was submitted since it was listed: list that one
+                continue
+            f.seek(member.offset)
+            header = f.read(_LOCAL_HEADER.size)
+            if len(header) != _LOCAL_HEADER.size or _LOCAL_HEADER.unpack(header)[0] != 0x04034b50:
+                raise MemberError("Corrupt archive (bad local header)")
+            name_length, extra_length = _LOCAL_HEADER.unpack(header)[-2:]
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            raw = f.read(member.compress_size)
+        break
+    else:
+        raise MemberError("Archive is changing, try again")
+
+    if member.method == zipfile.ZIP_STORED:
+        data = raw
+    else:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            # never inflate more than the declared size, whatever the data says
+            data = decompressor.decompress(raw, member.size + 1)
+        except zlib.error:
+            raise MemberError("Corrupt archive (bad compressed data)")
+    if len(data) != member.size or zlib.crc32(data) != member.crc:
+        raise MemberError("Corrupt archive (CRC mismatch)")
+    return data
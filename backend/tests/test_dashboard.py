@@ -0,0 +1,47 @@
+import os
+import re
+import shutil
+import zipfile
+import tempfile
+import unittest
+import subprocess
+
+import sce_unina_dashboard as dashboard
+
+
+@unittest.skipIf(shutil.which('node') is None, "node is needed to check the dashboard's script")
+class DashboardScriptTest(unittest.TestCase):
+    """The live-update script of the rendered dashboard must be valid JavaScript."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='sce-unina-test-')
+        self.addCleanup(shutil.rmtree, self.folder)
+        channel = os.path.join(self.folder, 'Tramontana')
+        os.makedirs(channel)
+        with zipfile.ZipFile(os.path.join(channel, 'ROSSI_MARIO_N86000001_Tramontana.zip'), 'w') as zf:
+            zf.writestr('main.c', 'int main(void) { return 0; }\n')
+
+        saved = dashboard.UPLOAD_FOLDER, dashboard.SESSION, dashboard.VALIDATE_WORKERS, dashboard.SIMILARITY_WORKERS
+        self.addCleanup(setattr, dashboard, 'SIMILARITY_WORKERS', saved[3])
+        self.addCleanup(setattr, dashboard, 'VALIDATE_WORKERS', saved[2])
+        self.addCleanup(setattr, dashboard, 'SESSION', saved[1])
+        self.addCleanup(setattr, dashboard, 'UPLOAD_FOLDER', saved[0])
+        # no background workers: a pool forking while node is spawned could hold its exec pipe open
+        dashboard.UPLOAD_FOLDER, dashboard.SESSION = self.folder, None
+        dashboard.VALIDATE_WORKERS = dashboard.SIMILARITY_WORKERS = 0
+
+    def test_script_parses(self):
+        response = dashboard.app.test_client().get('/dashboard')
+        self.assertEqual(response.status_code, 200)
+        scripts = re.findall(r'<script>(.*?)</script>', response.get_data(as_text=True), re.S)
+        self.assertTrue(scripts)
+        for script in scripts:
+            path = os.path.join(self.folder, 'page.js')
+            with open(path, 'w') as f:
+                f.write(script)
+            check = subprocess.run(['node', '--check', path], capture_output=True, text=True)
+            self.assertEqual(check.returncode, 0, check.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
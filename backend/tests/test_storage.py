@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    boto3 = mock_aws = None
+
+import sce_unina_storage as storage
+from sce_unina_storage import ObjectNotFound, open_storage
+
+
+@unittest.skipIf(mock_aws is None, "boto3 and moto are needed to test the S3 backend")
+class S3StorageTest(unittest.TestCase):
+    """The S3 backend against moto's in-process stand-in for S3."""
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                                           'AWS_DEFAULT_REGION': 'us-east-1'})
+        env.start()
+        self.addCleanup(env.stop)
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        boto3.client('s3').create_bucket(Bucket='sce-unina')
+        self.storage = open_storage('s3://sce-unina/exams')
+        self.folder = tempfile.mkdtemp(prefix='sce-unina-test-')
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def temp_file(self, data):
+        path = os.path.join(self.folder, 'upload.tmp')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_put_and_read(self):
+        data = bytes(range(256)) * 64
+        path = self.temp_file(data)
+        self.storage.put_file('a/sub.zip', path, {'sha256': 'abc'})
+        self.assertFalse(os.path.exists(path))
+        self.storage.put_bytes('a/note.txt', b'hello')
+
+        self.assertTrue(self.storage.exists('a/sub.zip'))
+        info = self.storage.stat('a/sub.zip')
+        self.assertEqual((info.size, info.sha256), (len(data), 'abc'))
+        self.assertEqual(self.storage.get_bytes('a/note.txt'), b'hello')
+        self.assertEqual(sorted(o.key for o in self.storage.list('a/')), ['a/note.txt', 'a/sub.zip'])
+
+        with self.storage.open('a/sub.zip') as f:
+            self.assertEqual(f.read(), data)
+            f.seek(1000)
+            self.assertEqual(f.read(10), data[1000:1010])
+            f.seek(-5, os.SEEK_END)
+            self.assertEqual(f.read(), data[-5:])
+        self.assertEqual(self.storage.get_range('a/sub.zip', 300, 600, info.etag), data[300:600])
+
+    def test_multipart_upload(self):
+        data = os.urandom(6 * 1024 * 1024)
+        with mock.patch.object(storage, 'PART_SIZE', 5 * 1024 * 1024):
+            self.storage.put_file('big.zip', self.temp_file(data))
+        self.assertEqual(self.storage.get_bytes('big.zip'), data)
+
+    def test_missing_and_deleted(self):
+        self.assertFalse(self.storage.exists('gone.zip'))
+        with self.assertRaises(ObjectNotFound):
+            self.storage.open('gone.zip')
+
+        self.storage.put_bytes('gone.zip', b'data')
+        self.storage.delete('gone.zip')
+        self.assertFalse(self.storage.exists('gone.zip'))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.get_bytes('gone.zip')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import * as vscode from 'vscode';
 import * as fs from 'fs';
 import * as path from 'path';
 import * as os from 'os';
+import * as crypto from 'crypto';
 
 import archiver from 'archiver';
 import fetch from 'node-fetch';
@@ -198,24 +199,98 @@ class HelpProvider implements vscode.TreeDataProvider<vscode.TreeItem> {
 
 /* -------------------- Upload Logic -------------------- */
 
+// Attempts made when the server answers 503/429 (busy) before giving up
+const UPLOAD_MAX_ATTEMPTS = 10;
+
+// Content-defined chunking, must match backend/sce_unina_chunks.py
+const CHUNK_MIN_SIZE = 2 * 1024;
+const CHUNK_MAX_SIZE = 64 * 1024;
+const CHUNK_MASK = (1 << 13) - 1;
+const CHUNK_GEAR = Array.from({ length: 256 }, (_, b) => crypto.createHash('sha256').update(Buffer.from([b])).digest().readUInt32LE(0));
+
+function chunkManifest(data: Buffer): [string, number][] {
+  const chunks: [string, number][] = [];
+  const add = (start: number, end: number) => {
+    chunks.push([crypto.createHash('sha256').update(data.subarray(start, end)).digest('hex').slice(0, 32), end - start]);
+  };
+  let h = 0;
+  let start = 0;
+  for (let i = 0; i < data.length; i++) {
+    h = ((h << 1) + CHUNK_GEAR[data[i]]) >>> 0;
+    const length = i + 1 - start;
+    if ((length >= CHUNK_MIN_SIZE && (h & CHUNK_MASK) === 0) || length === CHUNK_MAX_SIZE) {
+      add(start, i + 1);
+      start = i + 1;
+    }
+  }
+  if (start < data.length) add(start, data.length);
+  return chunks;
+}
+
+// Re-upload only the chunks that changed since the previous submission of the same file.
+// Returns false if the server can't do it (first submission, older server, busy...): send it all then.
+async function deltaUpload(baseUrl: string, zipPath: string, zipFileName: string): Promise<boolean> {
+  const data = await fs.promises.readFile(zipPath);
+  const chunks = chunkManifest(data);
+  const sha256 = crypto.createHash('sha256').update(data).digest('hex');
+
+  const init = await fetchWithTimeout(`${baseUrl}/upload/delta`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ filename: zipFileName, size: data.length, sha256, chunks })
+  }, 30000);
+  if (init.status !== 201) return false;
+  const delta = await init.json();
+
+  const offsets = [0];
+  for (const [, size] of chunks) offsets.push(offsets[offsets.length - 1] + size);
+  const missing = Buffer.concat(delta.missing.map((i: number) => data.subarray(offsets[i], offsets[i + 1])));
+
+  const response = await fetchWithTimeout(`${baseUrl}/upload/delta/${delta.delta_id}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/octet-stream' },
+    body: missing
+  }, 30000);
+  return response.ok;
+}
+
 async function uploadExamProject(folderPath: string, surname: string, name: string, studentID: string, teacher: string, progress?: vscode.Progress<{message?: string}>) {
 
   const zipFileName = `${surname}_${name}_${studentID}_${teacher}.zip`;
   const zipPath = path.join(folderPath, '..', zipFileName);
 
-  const serverUrl = `${await getServerUrl()}/upload`;
+  const baseUrl = await getServerUrl();
+  const serverUrl = `${baseUrl}/upload`;
 
   progress?.report({ message: "Creazione archivio ZIP..." });
   await zipFolder(folderPath, zipPath);
 
-  const form = new FormData();
-  form.append('file', fs.createReadStream(zipPath), { filename: zipFileName });
+  try {
+    try {
+      if (await deltaUpload(baseUrl, zipPath, zipFileName)) return;
+    } catch {
+      // fall back to a full upload
+    }
 
-  const headers = { ...form.getHeaders(), 'Content-Length': (await getFormDataLength(form)).toString() };
+    for (let attempt = 1; ; attempt++) {
+      // the form wraps a read stream, so every attempt needs a fresh one
+      const form = new FormData();
+      form.append('file', fs.createReadStream(zipPath), { filename: zipFileName });
 
-  try {
-    const response = await fetchWithTimeout(serverUrl, { method: 'POST', headers, body: form }, 30000);
-    if (!response.ok) throw new Error(await response.text());
+      const headers = { ...form.getHeaders(), 'Content-Length': (await getFormDataLength(form)).toString() };
+
+      const response = await fetchWithTimeout(serverUrl, { method: 'POST', headers, body: form }, 30000);
+      if (response.ok) return;
+
+      // the server is busy: wait as long as it asks (Retry-After) and try again
+      const busy = response.status === 503 || response.status === 429;
+      if (!busy || attempt >= UPLOAD_MAX_ATTEMPTS) throw new Error(await response.text());
+
+      const retryAfter = parseInt(response.headers.get('Retry-After') || '', 10);
+      const delay = Number.isFinite(retryAfter) && retryAfter > 0 ? retryAfter : 5;
+      progress?.report({ message: `Server occupato, nuovo tentativo tra ${delay} secondi...` });
+      await new Promise(resolve => setTimeout(resolve, delay * 1000));
+    }
   } finally {
     fs.unlink(zipPath, () => {});
   }